@@ -1,3 +1,5 @@
+# -*- encoding: utf-8 -*- 
+
 # Copyright (C) 2013 Jaakko Luttinen
 #
 # This program is free software: you can redistribute it and/or modify
@@ -19,9 +21,15 @@ Admin for `leffalippu`.
 """
 
 from django.contrib import admin
+from django.db.models import Count
 from leffalippu.models import *
+from leffalippu import pagination
+from leffalippu import forms
+from leffalippu import ticketimport
+from leffalippu import exports
 
 from django.http import Http404, HttpResponseRedirect, HttpResponse
+from django.http import StreamingHttpResponse
 from django.core.urlresolvers import reverse
 
 from django.contrib.admin.sites import AdminSite
@@ -29,12 +37,27 @@ from django.contrib.admin.sites import AdminSite
 from admin_views.admin import AdminViews
 
 class OrderedTicketsInline(admin.TabularInline):
+    """
+    Read-only tickets of the order. The price and the inventory counters are
+    computed when the tickets are reserved, so they can't be edited.
+    """
     model = OrderedTickets
-    extra = 0
+    readonly_fields = ('category', 'amount', 'price')
+    can_delete = False
+    max_num = 0
     #model = Order.tickets.through
 
 class OrderStatusInline(admin.TabularInline):
+    """
+    Read-only status of the order. Orders are closed with the pay and cancel
+    views, which keep the order state and the inventory counters in sync.
+    """
     model = OrderStatus
+    readonly_fields = ('status', 'date')
+    can_delete = False
+
+    def has_add_permission(self, request):
+        return False
 
 class TransactionInline(admin.TabularInline):
     model = Transaction
@@ -48,8 +71,30 @@ class PaidTicketInline(admin.TabularInline):
     model = PaidTicket
     extra = 0
 
+class OrderedTicketsAdmin(admin.ModelAdmin):
+    """
+    Read-only ordered tickets, see `OrderedTicketsInline`.
+    """
+    readonly_fields = ('order', 'category', 'amount', 'price')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 class OrderStatusAdmin(admin.ModelAdmin):
+    """
+    Read-only statuses, see `OrderStatusInline`.
+    """
     inlines = (PaidTicketInline,)
+    readonly_fields = ('order', 'status', 'date')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
     list_display = (
         'order',
         'date',
@@ -66,10 +111,18 @@ class OrderStatusAdmin(admin.ModelAdmin):
     #'input_transaction_hash',
         )
 
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(AdminViews):
+
+    admin_views = (
+        ('Import tickets', 'import_tickets'),
+        )
+
     list_display = (
         'name',
         'price',
+        'get_amount_total',
+        'get_amount_reserved',
+        'get_amount_available',
         )
 
     list_filter = (
@@ -79,6 +132,52 @@ class CategoryAdmin(admin.ModelAdmin):
         'name',
         )
     inlines = (TicketInline,)
+
+    def get_queryset(self, request):
+        return Category.objects.with_amount_available()
+
+    def get_amount_total(self, obj):
+        return obj.amount_total
+    get_amount_total.short_description = 'Total'
+    get_amount_total.admin_order_field = 'amount_total'
+
+    def get_amount_reserved(self, obj):
+        return obj.amount_reserved
+    get_amount_reserved.short_description = 'Reserved'
+    get_amount_reserved.admin_order_field = 'amount_reserved'
+
+    def get_amount_available(self, obj):
+        return obj.amount_available
+    get_amount_available.short_description = 'Available'
+    get_amount_available.admin_order_field = 'amount_available'
+
+    def import_tickets(self, request, **kwargs):
+        """
+        Upload a CSV or XLSX file of tickets.
+        """
+        result = None
+        error = None
+        if request.method == 'POST':
+            form = forms.TicketImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                upload = form.cleaned_data['file']
+                try:
+                    result = ticketimport.import_tickets(
+                        ticketimport.read_rows(upload, upload.name),
+                        category=form.cleaned_data['category'],
+                        dry_run=form.cleaned_data['dry_run'])
+                except ticketimport.TicketImportError as e:
+                    error = unicode(e)
+        else:
+            form = forms.TicketImportForm()
+
+        return render(request,
+                      'admin/import_tickets.html',
+                      {
+                          'form': form,
+                          'result': result,
+                          'error': error,
+                      })
     
 
 from django.conf.urls import patterns, include, url
@@ -92,54 +191,146 @@ class OrderAdmin(AdminViews):
     
     admin_views = (
         ('Manager', 'manager'),
+        ('Export', 'export'),
         )
 
     list_display = ('pk',
-                    #'encrypted_pk',
+                    'token',
                     'date', 
                     'email',
     #'ip',
                     'public_address',
                     'price_in_euros',
                     'price_satoshi',
-                    'orderstatus',
+                    'state',
         )
     list_filter = ('date',
-                   'orderstatus__status',)
-    search_fields = (#'encrypted_pk',
+                   'state',)
+    search_fields = ('=token',
                      'email',)
 
-    def manager(self, request, **kwargs):
-        # Open orders
-        open_order_list = Order.objects.filter(orderstatus=None)
+    """ Number of rows per page in the manager view """
+    manager_page_size = 50
 
-        # Cancelled orders
-        cancelled_order_list = Order.objects.filter(orderstatus__status=OrderStatus.CANCELLED)
-
-        # Expired orders
-        expired_order_list = Order.objects.filter(orderstatus__status=OrderStatus.EXPIRED)
+    def manager(self, request, **kwargs):
+        """
+        Dashboard of the tickets and the orders by status.
 
-        # All transactions
-        paid_order_list = Order.objects.filter(orderstatus__status=OrderStatus.PAID)
+        Each list is a keyset paginated page with its related rows prefetched
+        and the totals are SQL aggregates, so the number of queries doesn't
+        depend on the amount of data.
+        """
+        orders = Order.objects.select_related('orderstatus').prefetch_related(
+            'orderedtickets_set__category')
+        sections = (
+            ('open', u'Maksamattomat avoimet varaukset',
+             orders.filter(state=Order.OPEN)),
+            ('cancelled', u'Peruutetut varaukset',
+             orders.filter(state=Order.CANCELLED)),
+            ('expired', u'Erääntyneet varaukset',
+             orders.filter(state=Order.EXPIRED)),
+            ('paid', u'Maksetut ostokset',
+             orders.filter(state=Order.PAID).prefetch_related(
+                 'orderstatus__paidticket_set__ticket__category')),
+        )
 
-        # All tickets
-        ticket_list = Ticket.objects.all().order_by('expires')
+        # Number of orders by status
+        counts = dict(Order.objects.values_list('state').annotate(
+            count=Count('pk')).order_by())
+        statuses = {
+            'open': Order.OPEN,
+            'cancelled': Order.CANCELLED,
+            'expired': Order.EXPIRED,
+            'paid': Order.PAID,
+        }
+
+        order_sections = []
+        for (key, title, queryset) in sections:
+            (order_list, next_after) = self.manager_page(request, key, queryset)
+            order_sections.append({
+                'key': key,
+                'title': title,
+                'count': counts.get(statuses[key], 0),
+                'order_list': order_list,
+                'next_url': (self.manager_url(request, key, next_after)
+                             if next_after is not None else None),
+                'first_url': self.manager_url(request, key, None),
+            })
+
+        # Tickets and their buyers
+        tickets = Ticket.objects.select_related('category',
+                                                'paidticket__orderstatus')
+        (ticket_list, next_after) = self.manager_page(request, 'tickets', tickets)
+
+        categories = list(Category.objects.with_totals().order_by('name'))
 
         return render(request, 
                       'admin/manager.html',
                       {
-                          'ticket_list':      ticket_list,
-                          'open_order_list': open_order_list,
-                          'cancelled_order_list': cancelled_order_list,
-                          'expired_order_list': expired_order_list,
-                          'paid_order_list': paid_order_list,
+                          'category_list': categories,
+                          'revenue': sum(c.revenue for c in categories),
+                          'ticket_list': ticket_list,
+                          'ticket_next_url': (
+                              self.manager_url(request, 'tickets', next_after)
+                              if next_after is not None else None),
+                          'ticket_first_url': self.manager_url(request,
+                                                               'tickets',
+                                                               None),
+                          'order_sections': order_sections,
+                      })
+
+    def export(self, request, **kwargs):
+        """
+        Stream a CSV export selected with the form.
+        """
+        if 'export' in request.GET:
+            form = forms.ExportForm(request.GET)
+            if form.is_valid():
+                data = form.cleaned_data
+                rows = exports.export_rows(data['export'],
+                                           start=data['start'],
+                                           end=data['end'],
+                                           status=data['status'] or None)
+                response = StreamingHttpResponse(exports.csv_lines(rows),
+                                                 content_type='text/csv')
+                response['Content-Disposition'] = (
+                    'attachment; filename="%s.csv"' % data['export'])
+                return response
+        else:
+            form = forms.ExportForm()
+
+        return render(request,
+                      'admin/export.html',
+                      {
+                          'form': form,
                       })
 
+    def manager_page(self, request, key, queryset):
+        after = pagination.parse_after(request.GET.get(key))
+        return pagination.keyset_page(queryset,
+                                      after=after,
+                                      size=self.manager_page_size)
+
+    def manager_url(self, request, key, after):
+        """
+        Query string of the manager view with the page of one list changed.
+
+        The page is the first one if `after` is None.
+        """
+        query = request.GET.copy()
+        if after is None:
+            query.pop(key, None)
+        else:
+            query[key] = after
+        return '?' + query.urlencode()
+
     def get_urls(self):
         urls = super(OrderAdmin, self).get_urls()
         my_urls = patterns('',
             url(r'^(?P<order_id>.+)/pay/$', self.admin_site.admin_view(self.pay_view),
                 name='leffalippu_order_pay'),
+            url(r'^(?P<order_id>.+)/cancel/$', self.admin_site.admin_view(self.cancel_view),
+                name='leffalippu_order_cancel'),
         )
         return my_urls + urls
 
@@ -157,6 +348,17 @@ class OrderAdmin(AdminViews):
         except Order.DoesNotExist:
             raise Http404
 
+    def cancel_view(self, request, order_id):
+        """
+        Cancel an open order.
+        """
+        try:
+            order = Order.objects.get(id=order_id)
+        except Order.DoesNotExist:
+            raise Http404
+        order.cancel()
+        return HttpResponseRedirect(reverse('admin:manager'))
+
 
 class TransactionAdmin(admin.ModelAdmin):
     list_display = (
@@ -202,6 +404,9 @@ class TicketAdmin(admin.ModelAdmin):
     search_fields = (
         'number',
         )
+
+    list_select_related = ('category',
+                           'paidticket__orderstatus__order')
     
     ## def get_status(self, obj):
     ##     return '%s' % obj.paidticket.orderstatus.get_status_display()
@@ -220,13 +425,52 @@ class PaidTicketAdmin(admin.ModelAdmin):
         )
     search_fields = (
         'ticket__number',
-    #'orderstatus__order__encrypted_pk',
+        '=orderstatus__order__token',
         )
+    list_select_related = ('ticket',
+                           'orderstatus__order')
     def get_order(self, obj):
         return '%s' % obj.orderstatus.order
     get_order.short_description = 'Order'
     get_order.admin_order_field = 'orderstatus__order'
 
+class PaymentAddressAdmin(admin.ModelAdmin):
+    list_display = (
+        'address',
+        'date',
+        'order',
+        'claimed',
+        )
+
+    list_filter = (
+        'claimed',
+        )
+
+    search_fields = (
+        'address',
+        )
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = (
+        'date',
+        'recipients',
+        'subject',
+        'sent',
+        'attempts',
+        'failed',
+        'next_attempt',
+        )
+
+    list_filter = (
+        'failed',
+        'date',
+        )
+
+    search_fields = (
+        'recipients',
+        'subject',
+        )
+
 ## class TicketAdmin(admin.ModelAdmin):
 ##     def get_urls(self):
 ##         urls = super(TicketAdmin, self).get_urls()
@@ -276,6 +520,9 @@ admin.site.register(Ticket, TicketAdmin)
 admin.site.register(OrderStatus, OrderStatusAdmin)
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(OrderedTickets)
+admin.site.register(OrderedTickets, OrderedTicketsAdmin)
 admin.site.register(PaidTicket, PaidTicketAdmin)
 admin.site.register(Transaction, TransactionAdmin)
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
+admin.site.register(ExchangeRate)
+admin.site.register(PaymentAddress, PaymentAddressAdmin)
@@ -0,0 +1,39 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+PostgreSQL backend with pooled connections, see leffalippu.dbpool.
+"""
+
+import psycopg2.extensions
+
+from django.db.backends.postgresql_psycopg2.base import *
+from django.db.backends.postgresql_psycopg2.base import (
+    DatabaseWrapper as PostgreSQLDatabaseWrapper)
+
+from leffalippu.dbpool import PooledDatabaseWrapperMixin
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, PostgreSQLDatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        connection = super(DatabaseWrapper, self).get_new_connection(
+            conn_params)
+        # The parent sets the isolation level only when it connects, so it
+        # may be missing if this thread got a pooled connection first
+        if not hasattr(self, 'isolation_level'):
+            self.isolation_level = self.settings_dict['OPTIONS'].get(
+                'isolation_level',
+                psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        return connection
@@ -0,0 +1,52 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Helpers for summarizing benchmark measurements.
+"""
+
+def percentile(values, p):
+    """
+    Return the p:th percentile (0-100) of sorted values.
+    """
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    i = int(k)
+    j = min(i + 1, len(values) - 1)
+    return values[i] + (values[j] - values[i]) * (k - i)
+
+def summarize(latencies):
+    """
+    Summarize latencies (in seconds) as a dictionary of milliseconds.
+    """
+    values = sorted(latencies)
+    n = len(values)
+    return {
+        'count': n,
+        'mean': 1000.0 * sum(values) / n if n else 0.0,
+        'p50': 1000.0 * percentile(values, 50),
+        'p95': 1000.0 * percentile(values, 95),
+        'p99': 1000.0 * percentile(values, 99),
+        'max': 1000.0 * values[-1] if n else 0.0,
+    }
+
+def format_summary(summary):
+    """
+    Format a latency summary as a single line.
+    """
+    return ("n=%(count)d mean=%(mean).1fms p50=%(p50).1fms p95=%(p95).1fms "
+            "p99=%(p99).1fms max=%(max).1fms" % summary)
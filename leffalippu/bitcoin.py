@@ -1,37 +1,47 @@
-
-raise Exception("IS THIS MODULE NEEDED?")
-
-import urllib2
-import simplejson
+import binascii
+import logging
+import os
+import urllib
 from django.conf import settings
 from django.core.urlresolvers import reverse
 
 from django.http import Http404, HttpResponseRedirect, HttpResponse
 
-from leffalippu.models import Order, Transaction
+from leffalippu.models import Order, Transaction, PaymentAddress
 
-from django.db.models import Sum
+from django.db import connections, transaction, IntegrityError
+from django.db.models import F
+from django.dispatch import Signal
+from django.utils import timezone
 
-import crypto
+from leffalippu import httpclient
+from leffalippu import metrics
+from leffalippu import parallel
+from leffalippu import rates
 
 from django.conf import settings
 
-callback_crypto = crypto.KeyCrypto(settings.CALLBACK_CHAR8KEY)
+logger = logging.getLogger(__name__)
+
+""" Sent when the number of unused payment addresses is below the watermark """
+address_pool_low = Signal(providing_args=['unused'])
 
 def get_json(url):
     """
-    Get JSON response from an URL and return it as a nested dictionary.
+    Get JSON response from an URL of the receive API and return it as a
+    nested dictionary.
     """
-    req = urllib2.Request(url)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    return simplejson.load(f)
+    return httpclient.get_json('blockchain_receive', url)
 
 def get_bitcoin_address(receiving_address, shared, callback_url):
     """
     Get a new bitcoin address and set a notifier for it.
     """
-    blockchain_url = 'https://blockchain.info/api/receive?method=create&address=%s&shared=%g&callback=%s' % (receiving_address, shared, callback_url)
+    blockchain_url = '%s?method=create&address=%s&shared=%g&callback=%s' % (
+        settings.BLOCKCHAIN_RECEIVE_URL,
+        receiving_address,
+        shared,
+        urllib.quote(callback_url, safe=''))
 
     try:
         blockchain_json = get_json(blockchain_url)
@@ -41,34 +51,19 @@ def get_bitcoin_address(receiving_address, shared, callback_url):
         print(e)
         return None
 
-def get_rate_mtgox():
-    """
-    Get EUR/BTC rate from mtgox.com
-    """
-    ticker_json = get_json('https://data.mtgox.com/api/1/BTCEUR/ticker')
-    if ticker_json['result'] != 'success':
-        raise Exception("Failed to get conversion rate from MtGox")
-    # Conversion rate: satoshi/cents
-    return float(ticker_json['return']['buy']['value'])
-
-def get_rate_blockchain():
-    """
-    Get EUR/BTC rate from blockchain.info
-    """
-    ticker_json = get_json('http://blockchain.info/ticker')
-    return ticker_json['EUR']['buy']
-
-def cents_to_satoshi(cents):
+def cents_to_satoshi(cents, rate=None):
     """
     Convert a value in euros (units=cents) to bitcoins (units=satoshi).
 
-    Satoshis are handled as long integers.
+    The EUR/BTC rate is the latest quote unless given. Satoshis are handled
+    as long integers.
     """
     try: 
+        if rate is None:
+            rate = rates.get_rate()
         # Conversion rate: satoshi/cents
         fee_fix = 1.0 - settings.BITCOIN_FEE/100.0
-        rate = long(1.0e6 / (fee_fix * get_rate_mtgox()))
-        #rate = long(1.0e6 / (fee_fix * get_rate_blockchain()))
+        rate = long(1.0e6 / (fee_fix * rate))
 
         # Price in bitcoins (satoshi units)
         satoshi = cents * rate
@@ -79,50 +74,214 @@ def cents_to_satoshi(cents):
     except:
         return None
 
+def callback_url(token):
+    """
+    URL which blockchain.info calls when the address of the token is paid.
+    """
+    # NOTE: This URL is not reversed so that the callbacks can use totally
+    # different URLs (for instance, when using SSL)
+    return (settings.CALLBACK_BASEURL +
+            "/callback/" +
+            token +
+            "/?secret=%s" % settings.CALLBACK_SECRET)
+
+def create_address(order=None):
+    """
+    Create a new payment address with a callback and add it to the pool.
+
+    If `order` is given, the address is claimed for it directly. Returns
+    the address or None if the receive API failed.
+    """
+    token = new_token()
+    return store_address(request_address(token), token, order=order)
+
+def new_token():
+    return binascii.hexlify(os.urandom(16))
+
+def request_address(token):
+    """
+    Get a new address from the receive API with a callback for the token.
+    """
+    shared = True
+    return get_bitcoin_address(settings.BITCOIN_ADDRESS,
+                               shared, # shared? True/False
+                               callback_url(token))
+
+def store_address(address, token, order=None):
+    """
+    Store an address from `request_address`, claimed for the order if given.
+
+    Returns the address, or None if there is no address.
+    """
+    if address is None:
+        return None
+    PaymentAddress.objects.create(address=address,
+                                  token=token,
+                                  order=order,
+                                  claimed=timezone.now() if order else None)
+    return address
+
+def fill_address_pool(size=None):
+    """
+    Create addresses until the pool has `size` unused addresses.
+
+    Returns the number of created addresses.
+    """
+    if size is None:
+        size = settings.ADDRESS_POOL_SIZE
+    created = 0
+    for i in range(size - count_unused_addresses()):
+        if create_address() is None:
+            break
+        created += 1
+    check_address_pool()
+    return created
+
+def count_unused_addresses():
+    return PaymentAddress.objects.filter(order=None).count()
+
+def check_address_pool():
+    """
+    Fire the low watermark alarm if the pool is running out of addresses.
+
+    Returns the number of unused addresses.
+    """
+    unused = count_unused_addresses()
+    if unused < settings.ADDRESS_POOL_LOW_WATERMARK:
+        logger.error("Only %d unused payment addresses left", unused)
+        address_pool_low.send(sender=PaymentAddress, unused=unused)
+    return unused
+
+def address_pool_metrics():
+    return [
+        ('leffalippu_payment_addresses_unused',
+         'gauge',
+         'Unused payment addresses in the pool.',
+         [('leffalippu_payment_addresses_unused', {},
+           count_unused_addresses())]),
+        ('leffalippu_payment_addresses_low_watermark',
+         'gauge',
+         'Unused payment addresses below which the pool alarm fires.',
+         [('leffalippu_payment_addresses_low_watermark', {},
+           settings.ADDRESS_POOL_LOW_WATERMARK)]),
+    ]
+
+metrics.REGISTRY.add_collector(address_pool_metrics)
+
+def claim_address(order):
+    """
+    Claim an unused address of the pool for an order.
+
+    The address is claimed with a single UPDATE, so concurrent checkouts get
+    different addresses. Returns the address or None if the pool is empty.
+    """
+    connection = connections[PaymentAddress.objects.db]
+    table = connection.ops.quote_name(PaymentAddress._meta.db_table)
+    unused = "SELECT id FROM %s WHERE order_id IS NULL ORDER BY id LIMIT 1" % table
+    if connection.vendor == 'postgresql':
+        unused += " FOR UPDATE SKIP LOCKED"
+    sql = ("UPDATE %s SET order_id = %%s, claimed = %%s "
+           "WHERE id = (%s) AND order_id IS NULL" % (table, unused))
+    now = connection.ops.value_to_db_datetime(timezone.now())
+    cursor = connection.cursor()
+    # Without row locks, a concurrent checkout may have claimed the same row
+    for attempt in range(3):
+        cursor.execute(sql, [order.pk, now])
+        if cursor.rowcount:
+            return PaymentAddress.objects.get(order=order).address
+    return None
+
+def release_address(order):
+    """
+    Return the address claimed for an order to the pool, for instance, when
+    the checkout failed.
+
+    The address is registered with the receive API, so it must not be
+    deleted with the order.
+    """
+    PaymentAddress.objects.filter(order=order).update(order=None,
+                                                      claimed=None)
+
 def create_payment(order):
     """
-    Create a bitcoin address and compute the price in bitcoins for an order.
+    Get a bitcoin address and compute the price in bitcoins for an order.
+
+    Normally, the address comes from the pool and the rate from the latest
+    quote. If the pool is empty or the quote is stale, the receive API and
+    the exchange rate providers are called while the customer waits. With
+    CHECKOUT_PARALLEL_LOOKUPS, these calls run concurrently, so the
+    checkout waits only for the slower one, at most CHECKOUT_LOOKUP_TIMEOUT
+    seconds. Results arriving after that are stored for later checkouts.
     """
     # Get payment address
-    # NOTE: HARDCODED URL..
-    encrypted_pk = callback_crypto.encrypt(order.pk)
-    secret = settings.CALLBACK_SECRET
-    url = (settings.CALLBACK_BASEURL +
-           "/callback/" + 
-           encrypted_pk +
-           "/?secret=%s" % secret)
-    print("Callback URL: %s" % url)
-    shared = True
-    address = get_bitcoin_address(settings.BITCOIN_ADDRESS,
-                                  shared, # shared? True/False
-                                  url)
+    address = claim_address(order)
+    token = None
+    if address is None:
+        # The pool is empty, so create an address while the customer waits
+        logger.error("Payment address pool is empty")
+        address_pool_low.send(sender=PaymentAddress, unused=0)
+        token = new_token()
+
+    try:
+        rate = rates.get_rate()
+    except rates.StaleRate:
+        logger.error("Exchange rate is stale, fetching it for the checkout")
+        rate = None
+
+    fetched = None
+    if not settings.CHECKOUT_PARALLEL_LOOKUPS:
+        if token is not None:
+            address = request_address(token)
+        if rate is None:
+            fetched = rates.fetch_rate()
+    elif token is not None or rate is None:
+        tasks = []
+        if token is not None:
+            tasks.append(parallel.Task(
+                request_address, token,
+                late=lambda address: store_address(address, token)))
+        if rate is None:
+            tasks.append(parallel.Task(
+                rates.fetch_rate,
+                late=lambda fetched: fetched and rates.store_rate(*fetched)))
+        results = parallel.run_all(tasks, settings.CHECKOUT_LOOKUP_TIMEOUT)
+        if token is not None:
+            address = results.pop(0)
+        if rate is None:
+            fetched = results.pop(0)
+
+    # The database is written in this thread, in the transaction of the
+    # request
+    if token is not None:
+        address = store_address(address, token, order=order)
+    if fetched is not None:
+        rate = rates.store_rate(*fetched).rate
 
     # Get price in bitcoins (units=satoshi)
-    price = cents_to_satoshi(order.price())
+    price = cents_to_satoshi(order.price(), rate) if rate else None
 
     if price is None or address is None:
         raise Exception()
 
     return (address, price)
     
-def callback(request, encrypted_pk):
+def callback(request, token):
     """
     A callback for blockchain.info payment system.
 
     The customer pays to the input address and blockchain.info forwards the
     payment to our destination address.
+
+    The callback is idempotent: a retried callback only updates the number
+    of confirmations. The paid amount of the order is kept as a running
+    sum, and paying the order (allocating the tickets) is left to
+    `process_payments` worker, so the response is fast regardless of the
+    amount of tickets.
     """
     
     if request.method != 'GET':
         raise Http404
     
-    try:
-        # Get the order
-        order_pk = callback_crypto.decrypt(encrypted_pk)
-        order = Order.objects.get(pk=order_pk)
-    except Order.DoesNotExist:
-        raise Http404
-
     # Parse the parameters
     try:
         # Received payment in satoshi
@@ -139,8 +298,8 @@ def callback(request, encrypted_pk):
         input_transaction_hash = request.GET['input_transaction_hash']
         # Custom parameter
         secret = request.GET['secret']
-    except KeyError:
-        print("Missing parameters in the callback")
+    except (KeyError, ValueError):
+        logger.warning("Missing parameters in the callback")
         raise Http404
 
     # Check SSL?
@@ -148,43 +307,77 @@ def callback(request, encrypted_pk):
     
     # Check secret
     if secret != settings.CALLBACK_SECRET:
-        print("Wrong secret key")
+        logger.warning("Wrong secret key in the callback")
         raise Http404
 
     # Enough confirmations?
     if confirmations < 0:
-        print("Not enough confirmations")
+        logger.warning("Not enough confirmations")
         raise Http404
-    
-    # Store the transaction
-    transaction = Transaction(order=order,
-                              value=value,
-                              input_address=input_address,
-                              destination_address=destination_address,
-                              confirmations=confirmations,
-                              transaction_hash=transaction_hash,
-                              input_transaction_hash=input_transaction_hash)
+
+    # Get the order of the payment address
     try:
-        transaction.save()
-    except Exception as e:
-        print(e)
+        order_pk = PaymentAddress.objects.filter(
+            token=token
+        ).values_list('order', flat=True)[0]
+    except IndexError:
+        raise Http404
+    if order_pk is None:
         raise Http404
 
-    print("Payment %.5fBTC received for %s" % (value*1e-8, order))
-    
-    # Check whether the order is now paid
-    total_paid = Transaction.objects.filter(order=order).aggregate(Sum('value'))['value__sum']
-    if total_paid >= order.price_satoshi:
-        try:
-            order.pay()
-        except:
-            # The order could not be set to paid state. Either the order has
-            # already expired or been cancelled, or there is a bug in the system
-            # such that there are not enough tickets available
-            #
-            # TODO/FIXME: Some error message to logs?
-            pass
+    # Store the transaction, or update the confirmations if this is a retry
+    with transaction.atomic():
+        stored = Transaction.objects.filter(
+            transaction_hash=transaction_hash
+        ).update(confirmations=confirmations)
+        if not stored:
+            try:
+                with transaction.atomic():
+                    Transaction.objects.create(
+                        order_id=order_pk,
+                        value=value,
+                        input_address=input_address,
+                        destination_address=destination_address,
+                        confirmations=confirmations,
+                        transaction_hash=transaction_hash,
+                        input_transaction_hash=input_transaction_hash)
+            except IntegrityError:
+                # A concurrent retry stored it first
+                Transaction.objects.filter(
+                    transaction_hash=transaction_hash
+                ).update(confirmations=confirmations)
+            else:
+                Order.objects.filter(pk=order_pk).update(
+                    amount_paid=F('amount_paid') + value)
+                logger.info("Payment %.5fBTC received for order %s",
+                            value*1e-8, order_pk)
 
     # Return *ok*
     return HttpResponse("*ok*")
-    
+
+def paid_orders():
+    """
+    Open orders which have received their full price.
+    """
+    return Order.objects.filter(state=Order.OPEN,
+                                price_satoshi__gt=0,
+                                amount_paid__gte=F('price_satoshi'))
+
+def process_payments(limit=100):
+    """
+    Pay the open orders which have received their full price.
+
+    Returns a tuple (number of paid orders, number of failures).
+    """
+    (paid, failed) = (0, 0)
+    for order in paid_orders().order_by('date')[:limit]:
+        try:
+            order.pay()
+            paid += 1
+        except Exception:
+            # The order could not be set to paid state. Either the order has
+            # been closed concurrently, or there is a bug in the system such
+            # that there are not enough tickets available
+            logger.exception("Order %s could not be paid", order.pk)
+            failed += 1
+    return (paid, failed)
@@ -0,0 +1,168 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Cache backends.
+
+`SharedFileCache` stores the entries as files in a directory shared by the
+worker processes of one host, so the cached data stays coherent between
+the workers without a cache server. Old entries are evicted in least
+recently used order and the hits and misses are counted for monitoring.
+"""
+
+import errno
+import fcntl
+import io
+import os
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache, pickle
+from django.core.files.move import file_move_safe
+
+# Hits and misses of this process by cache directory
+_stats_lock = threading.Lock()
+_stats = {}
+
+def count(location, hit):
+    with _stats_lock:
+        counts = _stats.setdefault(location, [0, 0])
+        counts[0 if hit else 1] += 1
+
+def cache_stats():
+    """
+    Return the hits and misses of this process by cache directory.
+    """
+    with _stats_lock:
+        return dict((location, {'hits': hits, 'misses': misses})
+                    for (location, (hits, misses)) in _stats.items())
+
+class SharedFileCache(FileBasedCache):
+    """
+    File-based cache with LRU eviction and hit/miss counters.
+
+    The modification time of an entry file is updated on every hit, and
+    when the cache is full, the least recently used fraction of the entries
+    (1/CULL_FREQUENCY) is removed. The directory is listed only on every
+    CULL_INTERVAL:th write, so the cache may temporarily exceed MAX_ENTRIES
+    by that much.
+
+    `add`, `incr` and `decr` are atomic between the processes, so they can
+    be used for locks and counters.
+    """
+
+    """ Number of writes between checks of the number of entries """
+    CULL_INTERVAL = 20
+
+    def __init__(self, dir, params):
+        super(SharedFileCache, self).__init__(dir, params)
+        self._writes = 0
+
+    def get(self, key, default=None, version=None):
+        missing = object()
+        value = super(SharedFileCache, self).get(key, missing, version)
+        hit = value is not missing
+        count(self._dir, hit)
+        if not hit:
+            return default
+        try:
+            os.utime(self._key_to_file(key, version), None)
+        except OSError:
+            # Removed by another process
+            pass
+        return value
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold an exclusive lock of the cache directory.
+        """
+        self._createdir()
+        with open(os.path.join(self._dir, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked():
+            try:
+                if self.has_key(key, version):
+                    return False
+            except IOError as e:
+                # Deleted after the exists check
+                if e.errno != errno.ENOENT:
+                    raise
+            self.set(key, value, timeout, version)
+            return True
+
+    def incr(self, key, delta=1, version=None):
+        """
+        Add delta to a number in the cache, keeping its expiry time.
+        """
+        fname = self._key_to_file(key, version)
+        with self._locked():
+            try:
+                with io.open(fname, 'rb') as f:
+                    if self._is_expired(f):
+                        raise ValueError("Key '%s' not found" % key)
+                    f.seek(0)
+                    expiry = pickle.load(f)
+                    value = pickle.loads(zlib.decompress(f.read()))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                raise ValueError("Key '%s' not found" % key)
+            value += delta
+            fd, tmp_path = tempfile.mkstemp(dir=self._dir)
+            renamed = False
+            try:
+                with io.open(fd, 'wb') as f:
+                    f.write(pickle.dumps(expiry, -1))
+                    f.write(zlib.compress(pickle.dumps(value), -1))
+                file_move_safe(tmp_path, fname, allow_overwrite=True)
+                renamed = True
+            finally:
+                if not renamed:
+                    os.remove(tmp_path)
+        return value
+
+    def stats(self):
+        return cache_stats().get(self._dir, {'hits': 0, 'misses': 0})
+
+    def _cull(self):
+        self._writes += 1
+        if (self._writes - 1) % self.CULL_INTERVAL:
+            return
+        filelist = self._list_cache_files()
+        num_entries = len(filelist)
+        if num_entries < self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            return self.clear()
+        used = []
+        for fname in filelist:
+            try:
+                used.append((os.path.getmtime(fname), fname))
+            except OSError:
+                pass
+        used.sort()
+        for (mtime, fname) in used[:num_entries // self._cull_frequency]:
+            self._delete(fname)
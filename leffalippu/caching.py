@@ -0,0 +1,108 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Versioned cache entries with stampede protection.
+
+Each cached value belongs to a named group whose version number is part of
+the cache key. Bumping the version invalidates all the entries of the
+group at once, the old entries are left to expire. Versions are at least
+the current time in milliseconds, so a version number is not reused even
+if the version has been evicted or the cache outlives the database.
+
+When an entry is missing, only one process rebuilds it while the others
+wait for it for a moment. Entries are also rebuilt a bit before they
+expire, with a probability that grows towards the expiry and with the
+time the rebuild takes, so that expensive entries are usually refreshed
+before anybody has to wait for them.
+"""
+
+import math
+import random
+import time
+
+from django.core.cache import cache
+
+VERSION_KEY = 'leffalippu:version:%s'
+
+""" Seconds a rebuild lock is held at most """
+LOCK_SECONDS = 10
+
+""" Seconds to wait for another process to rebuild a missing entry """
+LOCK_WAIT_SECONDS = 1.0
+
+""" Weight of the early rebuilding, 1 is the usual choice """
+EARLY_REBUILD_BETA = 1.0
+
+def _now_version():
+    return int(time.time() * 1000)
+
+def get_version(name):
+    """
+    Return the current version of a group.
+    """
+    key = VERSION_KEY % name
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _now_version(), None)
+        version = cache.get(key)
+    return version
+
+def get_versions(*names):
+    """
+    Return the versions of the groups as one string, for fragment cache
+    keys.
+    """
+    return '-'.join(str(get_version(name)) for name in names)
+
+def bump_version(name):
+    """
+    Invalidate the cached entries of a group.
+    """
+    version = max(get_version(name) + 1, _now_version())
+    cache.set(VERSION_KEY % name, version, None)
+
+def cached(name, timeout, build):
+    """
+    Return the cached value of a group, or build and cache it.
+    """
+    key = 'leffalippu:%s:%s' % (name, get_version(name))
+    lock_key = key + ':lock'
+    entry = cache.get(key)
+    if entry is not None:
+        (value, expires, duration) = entry
+        # Rebuild early with a probability, only one process at a time
+        early = -duration * EARLY_REBUILD_BETA * math.log(1.0 - random.random())
+        if time.time() + early < expires or not cache.add(lock_key, 1,
+                                                          LOCK_SECONDS):
+            return value
+    elif not cache.add(lock_key, 1, LOCK_SECONDS):
+        # Another process is building the value
+        deadline = time.time() + LOCK_WAIT_SECONDS
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+        # Took too long, build it here too
+    try:
+        start = time.time()
+        value = build()
+        duration = time.time() - start
+        cache.set(key, (value, time.time() + timeout, duration), timeout)
+    finally:
+        cache.delete(lock_key)
+    return value
@@ -0,0 +1,272 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Database connection pool.
+
+Django opens a new database connection for each request (or keeps one per
+thread with CONN_MAX_AGE). The pooled database backends in
+leffalippu.backends instead return the connection to a pool of the worker
+process when Django closes it, and the next request of any thread reuses
+it. The pool is configured with POOL dictionary of the database settings:
+
+    MAX_SIZE       maximum number of open connections (0 disables pooling)
+    IDLE_SECONDS   idle connections older than this are closed
+    CHECK_SECONDS  connections idle longer than this are checked with a
+                   query before they are reused
+    TIMEOUT        seconds to wait for a free connection when MAX_SIZE
+                   connections are in use
+"""
+
+import os
+import threading
+import time
+
+from django.db import OperationalError
+from django.db.backends.creation import NO_DB_ALIAS
+
+DEFAULTS = {
+    'MAX_SIZE': 10,
+    'IDLE_SECONDS': 300,
+    'CHECK_SECONDS': 30,
+    'TIMEOUT': 10,
+}
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+def is_usable(connection):
+    """
+    Check a raw DB-API connection with a trivial query.
+    """
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+class ConnectionPool(object):
+    """
+    Thread-safe, bounded pool of raw DB-API connections.
+
+    Idle connections are reused in last-in first-out order, so a few warm
+    connections serve most of the requests and the rest time out.
+    """
+
+    def __init__(self, max_size=10, idle_seconds=300, check_seconds=30,
+                 timeout=10):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.check_seconds = check_seconds
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        # Pairs of idle connections and the times they were released
+        self.idle = []
+        self.closed = False
+        # Number of open connections, both idle and in use
+        self.size = 0
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0}
+
+    def acquire(self, connect):
+        """
+        Return an idle connection or a new one from `connect` function.
+
+        Raises OperationalError if no connection is released within the
+        timeout.
+        """
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while True:
+                self._close_expired()
+                if self.idle:
+                    (connection, released) = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    connection = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise OperationalError("No database connection was "
+                                           "released in %s seconds"
+                                           % self.timeout)
+                self.condition.wait(remaining)
+
+        # Checks and connecting are done without holding the lock
+        if connection is not None:
+            if (time.time() - released < self.check_seconds
+                or is_usable(connection)):
+                self._count('reused')
+                return connection
+            _close(connection)
+            self._count('discarded')
+        try:
+            connection = connect()
+        except:
+            self._forget()
+            raise
+        self._count('created')
+        return connection
+
+    def release(self, connection):
+        """
+        Return a connection to the pool after rolling back any open
+        transaction.
+        """
+        try:
+            connection.rollback()
+        except Exception:
+            self.discard(connection)
+            return
+        with self.condition:
+            if not self.closed:
+                self.idle.append((connection, time.time()))
+                self.condition.notify()
+                return
+        self.discard(connection)
+
+    def discard(self, connection):
+        """
+        Close a connection that is not returned to the pool.
+        """
+        _close(connection)
+        self._count('discarded')
+        self._forget()
+
+    def close(self):
+        """
+        Close the idle connections. Connections in use are closed when they
+        are released.
+        """
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.closed = True
+        for (connection, released) in idle:
+            _close(connection)
+
+    def _close_expired(self):
+        # The oldest connections are first
+        limit = time.time() - self.idle_seconds
+        while self.idle and self.idle[0][1] < limit:
+            (connection, released) = self.idle.pop(0)
+            self.size -= 1
+            self.stats['discarded'] += 1
+            _close(connection)
+
+    def _forget(self):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def _count(self, name):
+        with self.condition:
+            self.stats[name] += 1
+
+# Pools of this process by database alias
+_pools_lock = threading.Lock()
+_pools = {}
+
+def get_pool(alias, settings_dict):
+    """
+    Return the pool of the database alias, or None if pooling is disabled.
+
+    A new pool is made if the connection settings changed, for instance,
+    when a test database is created, or if the process was forked.
+    """
+    options = dict(DEFAULTS, **(settings_dict.get('POOL') or {}))
+    if alias == NO_DB_ALIAS or options['MAX_SIZE'] <= 0:
+        return None
+    key = (os.getpid(),
+           tuple(settings_dict.get(name) for name in ('NAME', 'USER', 'HOST',
+                                                      'PORT')),
+           tuple(sorted(options.items())))
+    with _pools_lock:
+        (old_key, pool) = _pools.get(alias, (None, None))
+        if old_key == key:
+            return pool
+        if pool is not None and old_key[0] == key[0]:
+            pool.close()
+        pool = ConnectionPool(max_size=options['MAX_SIZE'],
+                              idle_seconds=options['IDLE_SECONDS'],
+                              check_seconds=options['CHECK_SECONDS'],
+                              timeout=options['TIMEOUT'])
+        _pools[alias] = (key, pool)
+        return pool
+
+def close_pools():
+    """
+    Close the idle connections of all pools of this process, for instance,
+    before dropping a database.
+    """
+    with _pools_lock:
+        pools = [pool for (key, pool) in _pools.values()]
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+def pool_stats():
+    """
+    Return the connection counts of the pools of this process by alias.
+    """
+    with _pools_lock:
+        pools = list(_pools.items())
+    stats = {}
+    for (alias, (key, pool)) in pools:
+        with pool.condition:
+            stats[alias] = dict(pool.stats,
+                                open=pool.size,
+                                idle=len(pool.idle))
+    return stats
+
+class PooledDatabaseWrapperMixin(object):
+    """
+    Mixin for a database wrapper taking its connections from the pool and
+    releasing them to the pool when Django closes them.
+    """
+
+    pool = None
+
+    def get_new_connection(self, conn_params):
+        parent = super(PooledDatabaseWrapperMixin, self)
+        self.pool = get_pool(self.alias, self.settings_dict)
+        if self.pool is None:
+            return parent.get_new_connection(conn_params)
+        return self.pool.acquire(
+            lambda: parent.get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool = self.pool
+        self.pool = None
+        if pool is None:
+            return super(PooledDatabaseWrapperMixin, self)._close()
+        if self.in_atomic_block:
+            # Django keeps referring to a connection closed in a
+            # transaction, so it can't be reused
+            pool.discard(self.connection)
+        elif self.errors_occurred and not self.is_usable():
+            pool.discard(self.connection)
+        else:
+            pool.release(self.connection)
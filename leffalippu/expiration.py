@@ -0,0 +1,121 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Expiration of open orders that have not been paid in time.
+"""
+
+import datetime
+import time
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from leffalippu.models import (Order, OrderStatus, OrderedTickets, Inventory,
+                               OutgoingEmail)
+
+def unpaid(orders):
+    """
+    Leave out the orders which have received their full price.
+
+    Such orders are waiting for `bitcoin.process_payments` to give them the
+    tickets, so they must not be expired.
+    """
+    return orders.exclude(price_satoshi__gt=0,
+                          amount_paid__gte=F('price_satoshi'))
+
+def expired_orders(now=None, lookback=True):
+    """
+    Return the open unpaid orders that should be expired.
+
+    If `lookback` is True, only the orders placed within
+    EXPIRATION_LOOKBACK_HOURS before the expiration time are considered, so
+    the lookup is a bounded range scan of the (state, date) index no matter
+    how many old orders there are.
+    """
+    if now is None:
+        now = timezone.now()
+    latest_date = now - datetime.timedelta(minutes=settings.EXPIRATION_MINUTES)
+    orders = unpaid(Order.objects.filter(state=Order.OPEN,
+                                         date__lt=latest_date))
+    if lookback:
+        earliest_date = latest_date - datetime.timedelta(
+            hours=settings.EXPIRATION_LOOKBACK_HOURS)
+        orders = orders.filter(date__gte=earliest_date)
+    return orders.order_by('date')
+
+def expire_batch(order_pks):
+    """
+    Expire the given open orders and release their tickets.
+
+    The statuses and the emails to the customers are created with one INSERT
+    each, the states of the orders are set with one UPDATE and the inventory
+    counters are updated in the same transaction. Orders which have received
+    their full price meanwhile are skipped. If some of the orders were
+    closed concurrently, the orders are expired one by one instead, which
+    also copies the existing statuses to the states of the orders.
+
+    Returns the number of expired orders.
+    """
+    try:
+        with transaction.atomic():
+            order_pks = list(unpaid(Order.objects.filter(pk__in=order_pks))
+                             .values_list('pk', flat=True))
+            OrderStatus.objects.bulk_create([
+                OrderStatus(order_id=order_pk,
+                            status=OrderStatus.EXPIRED)
+                for order_pk in order_pks
+            ])
+            Order.objects.filter(pk__in=order_pks).update(
+                state=Order.EXPIRED)
+            amounts = OrderedTickets.objects.filter(
+                order__in=order_pks
+            ).values('category').annotate(amount=Sum('amount'))
+            for row in amounts:
+                Inventory.objects.release(row['category'], row['amount'])
+            OutgoingEmail.objects.bulk_create([
+                OutgoingEmail.objects.create_email('email/expire.txt',
+                                                   {
+                                                       'order': order,
+                                                   },
+                                                   [order.email])
+                for order in Order.objects.filter(pk__in=order_pks)
+            ])
+        return len(order_pks)
+    except IntegrityError:
+        return sum(1 for order in unpaid(Order.objects.filter(pk__in=order_pks))
+                   if order.expire())
+
+def expire_orders(now=None, lookback=True, batch_size=500):
+    """
+    Expire all open orders that have not been paid in time.
+
+    Returns a tuple (number of expired orders, elapsed seconds).
+    """
+    start = time.time()
+    orders = expired_orders(now=now, lookback=lookback)
+    expired = 0
+    while True:
+        order_pks = list(orders.values_list('pk', flat=True)[:batch_size])
+        count = expire_batch(order_pks) if order_pks else 0
+        expired += count
+        # Stop if nothing could be expired, so that orders which fail to
+        # expire are not selected again forever
+        if len(order_pks) < batch_size or count == 0:
+            break
+    return (expired, time.time() - start)
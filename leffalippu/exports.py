@@ -0,0 +1,170 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+CSV exports of the sales for accounting.
+
+The rows are read as value tuples in keyset chunks and written to CSV one
+at a time, so an export of any size is streamed without keeping it in
+memory.
+"""
+
+import csv
+import datetime
+
+from django.utils import timezone
+
+from leffalippu.models import Order, OrderedTickets, PaidTicket, Transaction
+from leffalippu import pagination
+
+""" Number of rows fetched per query """
+CHUNK_SIZE = 2000
+
+""" Status filters and the corresponding order states """
+STATUSES = (
+    ('open', Order.OPEN),
+    ('paid', Order.PAID),
+    ('cancelled', Order.CANCELLED),
+    ('expired', Order.EXPIRED),
+)
+
+class Export(object):
+    """
+    Definition of an export.
+
+    `columns` lists (header, field) pairs, `date_field` is filtered by the
+    date range and `status_field` is the state of the related order.
+    """
+
+    def __init__(self, model, columns, date_field, status_field):
+        self.model = model
+        self.columns = columns
+        self.date_field = date_field
+        self.status_field = status_field
+
+    def queryset(self, start=None, end=None, status=None):
+        queryset = self.model.objects.all()
+        if start is not None:
+            queryset = queryset.filter(**{
+                self.date_field + '__gte': start_of_day(start),
+            })
+        if end is not None:
+            queryset = queryset.filter(**{
+                self.date_field + '__lt': start_of_day(end + datetime.timedelta(days=1)),
+            })
+        if status is not None:
+            queryset = queryset.filter(**{
+                self.status_field: dict(STATUSES)[status],
+            })
+        return queryset
+
+EXPORTS = {
+    'orders': Export(
+        Order,
+        (('date', 'date'),
+         ('email', 'email'),
+         ('total_cents', 'total_cents'),
+         ('price_satoshi', 'price_satoshi'),
+         ('amount_paid', 'amount_paid'),
+         ('status', 'orderstatus__status'),
+         ('status_date', 'orderstatus__date')),
+        date_field='date',
+        status_field='state'),
+    'orderedtickets': Export(
+        OrderedTickets,
+        (('order', 'order'),
+         ('order_date', 'order__date'),
+         ('category', 'category__name'),
+         ('amount', 'amount'),
+         ('price', 'price'),
+         ('status', 'order__orderstatus__status')),
+        date_field='order__date',
+        status_field='order__state'),
+    'paidtickets': Export(
+        PaidTicket,
+        (('order', 'orderstatus__order'),
+         ('paid', 'orderstatus__date'),
+         ('category', 'ticket__category__name'),
+         ('number', 'ticket__number'),
+         ('price', 'ticket__price'),
+         ('expires', 'ticket__expires')),
+        date_field='orderstatus__date',
+        status_field='orderstatus__order__state'),
+    'transactions': Export(
+        Transaction,
+        (('order', 'order'),
+         ('date', 'date'),
+         ('transaction_hash', 'transaction_hash'),
+         ('value', 'value'),
+         ('input_address', 'input_address'),
+         ('destination_address', 'destination_address'),
+         ('confirmations', 'confirmations')),
+        date_field='date',
+        status_field='order__state'),
+}
+
+def start_of_day(date):
+    """
+    Return the beginning of a date in the current time zone.
+    """
+    start = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(start) and timezone.get_current_timezone():
+        start = timezone.make_aware(start, timezone.get_current_timezone())
+    return start
+
+def export_rows(name, start=None, end=None, status=None, chunk_size=CHUNK_SIZE):
+    """
+    Generate the header and the rows of an export.
+
+    `start` and `end` are dates (inclusive) and `status` is one of the
+    names in STATUSES.
+    """
+    export = EXPORTS[name]
+    yield ('id',) + tuple(header for (header, field) in export.columns)
+    queryset = export.queryset(start=start, end=end, status=status)
+    for row in pagination.keyset_chunks(queryset,
+                                        [field for (header, field)
+                                         in export.columns],
+                                        chunk_size=chunk_size):
+        yield row
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        value = timezone.localtime(value) if timezone.is_aware(value) else value
+        return value.isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+class Echo(object):
+    """
+    File-like object returning what is written, for generating CSV lines.
+    """
+
+    def write(self, value):
+        return value
+
+def csv_lines(rows):
+    """
+    Generate UTF-8 encoded CSV lines of the rows.
+    """
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow([_csv_value(value) for value in row])
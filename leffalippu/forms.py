@@ -16,12 +16,15 @@
 # <http://www.gnu.org/licenses/>.
 
 from django import forms
+from django.conf import settings
 from django.forms.formsets import BaseFormSet
 
 from django.forms.util import ErrorList
 from django.forms.forms import NON_FIELD_ERRORS
 
 from leffalippu.models import Order, Category, OrderedTickets
+from leffalippu import reservations
+from leffalippu import exports
 
 #from captcha.fields import ReCaptchaField
 #from captcha.fields import CaptchaField
@@ -29,7 +32,7 @@ from leffalippu.models import Order, Category, OrderedTickets
 # debugging
 import inspect
 
-#import bitcoin
+from leffalippu import bitcoin
 
 MAX_AMOUNT = 5
 
@@ -51,11 +54,16 @@ class OrderForm(forms.ModelForm):
         """
         Custom validation.
 
-        1) The email address doesn't have other open orders
+        1) The email address doesn't have too many other open orders
         """
         cleaned_data = super(OrderForm, self).clean()
 
-        # TODO/FIXME: Check the email!
+        email = cleaned_data.get('email')
+        if (email and
+            Order.objects.count_open(email) >= settings.MAX_OPEN_ORDERS_PER_EMAIL):
+            raise forms.ValidationError("Sähköpostiosoitteella on jo "
+                                        "maksamaton tilaus. Maksa tai peru "
+                                        "se ennen uutta tilausta.")
         
         return cleaned_data
 
@@ -141,38 +149,26 @@ class BaseOrderedTicketsFormSet(BaseFormSet):
         """
         Custom save method for the form set.
 
-        Save only non-zero ticket orders.
-
-        Paranoid check: At the end, check that the amount of available
-        tickets for any category is not negative, if several people
-        made simultaneous orders. If a negative amount is found,
-        delete all these just saved orders and return False.
+        Reserve the non-zero ticket amounts for the order and create the
+        payment. The order is saved in the same transaction as the
+        reservation, so nothing is written if several people made
+        simultaneous orders and there are not enough tickets left. Returns
+        False if the reservation or the payment failed.
         """
-        for form in self.forms:
-            amount = form.cleaned_data['amount']
-            if amount > 0:
-                # Save only non-zero ticket categories
-                category = form.cleaned_data['category']
-                reserved_tickets = OrderedTickets(order=order,
-                                                   category=category,
-                                                   amount=amount,
-                                                   price=category.price)
-                reserved_tickets.save()
-
-                if category.amount_available() < 0:
-                    # This error should not happen. However, if
-                    # simultaneous purchases happen, it may be that
-                    # they both reserve "the same" tickets and the
-                    # amount of available tickets becomes
-                    # negative. Thus, cancel this order.
+        amounts = dict((form.cleaned_data['category'],
+                        form.cleaned_data['amount'])
+                       for form in self.forms)
+        result = reservations.reserve_tickets(order, amounts)
+        if not result:
+            for form in self.forms:
+                if form.cleaned_data['category'] in result.shortages:
                     errors = form._errors.setdefault(NON_FIELD_ERRORS, ErrorList())
                     errors.append("Lippuja ei ole riittävästi saatavilla.")
-                    OrderedTickets.objects.filter(order=order).delete()
-                    return False
+            return False
                 
         try:
             (address, price) = bitcoin.create_payment(order)
-            order.bitcoin_address = address
+            order.public_address = address
             order.price_satoshi = price
             order.save()
             return True
@@ -189,3 +185,40 @@ class BaseOrderedTicketsFormSet(BaseFormSet):
             return False
 
         
+
+class TicketImportForm(forms.Form):
+    """
+    Upload of a ticket file in the admin.
+    """
+
+    file = forms.FileField(help_text="CSV or XLSX file with columns number, "
+                                     "expires, price and category.")
+
+    category = forms.ModelChoiceField(queryset=Category.objects.all(),
+                                      required=False,
+                                      help_text="Category of all the tickets, "
+                                                "if the file has no category "
+                                                "column.")
+
+    dry_run = forms.BooleanField(required=False,
+                                 initial=True,
+                                 help_text="Only validate the file.")
+
+class ExportForm(forms.Form):
+    """
+    Selection of a CSV export in the admin.
+    """
+
+    export = forms.ChoiceField(choices=[(name, name)
+                                        for name in sorted(exports.EXPORTS)])
+
+    start = forms.DateField(required=False,
+                            help_text="First date (YYYY-MM-DD).")
+
+    end = forms.DateField(required=False,
+                          help_text="Last date (YYYY-MM-DD).")
+
+    status = forms.ChoiceField(choices=[('', 'all')] + [(name, name)
+                                                        for (name, code)
+                                                        in exports.STATUSES],
+                               required=False)
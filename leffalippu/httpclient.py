@@ -0,0 +1,321 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Shared HTTP client for the external providers.
+
+All outbound provider calls go through `get_json`, which
+
+* keeps the connections to each host alive in a small pool of this process,
+* uses the connect and read timeouts of the named endpoint,
+* retries failed requests after an exponential, jittered backoff and
+* fails fast with CircuitOpen while a host is down.
+
+A host is considered down after FAILURE_THRESHOLD consecutive failures
+(connection errors, timeouts and 5xx responses). Then a background thread
+probes the PROBE_URL of the endpoint (the root of the host by default)
+every RESET_SECONDS and lets the requests through again when the host
+answers. The endpoints are configured in HTTP_ENDPOINTS setting, see the
+default settings.
+"""
+
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+import urlparse
+
+import simplejson
+
+from django.conf import settings
+
+from leffalippu import metrics
+
+logger = logging.getLogger(__name__)
+
+""" Maximum number of idle connections kept per host """
+MAX_IDLE = 4
+
+DEFAULTS = {
+    'CONNECT_TIMEOUT': 3,
+    'READ_TIMEOUT': 10,
+    'RETRIES': 1,
+    'BACKOFF': 0.2,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_SECONDS': 30,
+    'PROBE_URL': None,
+}
+
+class HTTPError(Exception):
+    """
+    A request failed or got an error response.
+    """
+
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+class CircuitOpen(HTTPError):
+    """
+    The host is down, so the request was not sent.
+    """
+    pass
+
+requests_total = metrics.REGISTRY.counter(
+    'leffalippu_http_requests_total',
+    'Outbound HTTP requests by endpoint and outcome.')
+
+def endpoint_options(endpoint):
+    options = dict(DEFAULTS)
+    options.update(settings.HTTP_ENDPOINTS.get(endpoint, {}))
+    return options
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections of this process by host.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def put(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < MAX_IDLE:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+POOL = ConnectionPool()
+
+class CircuitBreaker(object):
+    """
+    Failure memory of a host.
+    """
+
+    def __init__(self, endpoint, host):
+        self.endpoint = endpoint
+        self.host = host
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.prober = None
+
+    def is_open(self):
+        return self.opened is not None
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self, probe_url):
+        """
+        Count a failure. Opens the circuit at the failure threshold.
+        """
+        options = endpoint_options(self.endpoint)
+        with self.lock:
+            self.failures += 1
+            if (self.opened is not None or
+                self.failures < options['FAILURE_THRESHOLD']):
+                return
+            self.opened = time.time()
+            self.prober = threading.Thread(target=self.probe_loop,
+                                           args=(probe_url,))
+            self.prober.daemon = True
+        logger.error("%s is down, failing %s requests until it answers",
+                     self.host, self.endpoint)
+        self.prober.start()
+
+    def close(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.prober = None
+
+    def probe(self, url):
+        """
+        Return True if the host answers without a server error.
+        """
+        options = endpoint_options(self.endpoint)
+        try:
+            (status, body) = send(url,
+                                  options['CONNECT_TIMEOUT'],
+                                  options['READ_TIMEOUT'])
+        except (socket.error, httplib.HTTPException):
+            return False
+        return status < 500
+
+    def probe_loop(self, url):
+        while True:
+            time.sleep(endpoint_options(self.endpoint)['RESET_SECONDS'])
+            if self.probe(url):
+                logger.warning("%s answers again", self.host)
+                self.close()
+                return
+
+# Circuit breakers by endpoint and host
+_breakers_lock = threading.Lock()
+_breakers = {}
+
+def get_breaker(endpoint, host):
+    with _breakers_lock:
+        key = (endpoint, host)
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(endpoint, host)
+        return _breakers[key]
+
+def reset():
+    """
+    Forget the circuit states and close the idle connections.
+    """
+    with _breakers_lock:
+        _breakers.clear()
+    POOL.clear()
+
+def circuit_metrics():
+    with _breakers_lock:
+        breakers = sorted(_breakers.items())
+    return [
+        ('leffalippu_http_circuit_open',
+         'gauge',
+         'Whether requests to the host are failed without sending them.',
+         [('leffalippu_http_circuit_open',
+           {'endpoint': endpoint, 'host': host},
+           int(breaker.is_open()))
+          for ((endpoint, host), breaker) in breakers]),
+        ('leffalippu_http_consecutive_failures',
+         'gauge',
+         'Consecutive failed requests to the host.',
+         [('leffalippu_http_consecutive_failures',
+           {'endpoint': endpoint, 'host': host},
+           breaker.failures)
+          for ((endpoint, host), breaker) in breakers]),
+    ]
+
+metrics.REGISTRY.add_collector(circuit_metrics)
+
+def _connect(scheme, host, connect_timeout, read_timeout):
+    if scheme == 'https':
+        connection = httplib.HTTPSConnection(host, timeout=connect_timeout)
+    else:
+        connection = httplib.HTTPConnection(host, timeout=connect_timeout)
+    connection.connect()
+    connection.sock.settimeout(read_timeout)
+    return connection
+
+def send(url, connect_timeout, read_timeout):
+    """
+    Send a GET request on a pooled connection and return the status and
+    the body.
+
+    A failure on a reused connection, which the server may have closed in
+    the meantime, is retried once on a new connection.
+    """
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    connection = POOL.get(key)
+    reused = connection is not None
+    while True:
+        if connection is None:
+            connection = _connect(parts.scheme, parts.netloc,
+                                  connect_timeout, read_timeout)
+        try:
+            connection.request('GET', path, headers={
+                'Accept': 'application/json',
+            })
+            response = connection.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            (connection, reused) = (None, False)
+            continue
+        if response.will_close:
+            connection.close()
+        else:
+            POOL.put(key, connection)
+        return (response.status, body)
+
+def get(endpoint, url):
+    """
+    Get the body of an URL of the named endpoint.
+
+    Raises CircuitOpen if the host is down, and HTTPError if the request
+    fails after the retries.
+    """
+    options = endpoint_options(endpoint)
+    parts = urlparse.urlsplit(url)
+    breaker = get_breaker(endpoint, parts.netloc)
+    if breaker.is_open():
+        requests_total.inc(endpoint=endpoint, outcome='circuit_open')
+        raise CircuitOpen("%s is down" % parts.netloc)
+    probe_url = options['PROBE_URL'] or '%s://%s/' % (parts.scheme,
+                                                      parts.netloc)
+    attempt = 0
+    while True:
+        try:
+            with metrics.timer('http'):
+                (status, body) = send(url,
+                                      options['CONNECT_TIMEOUT'],
+                                      options['READ_TIMEOUT'])
+        except (socket.error, httplib.HTTPException) as e:
+            error = HTTPError("%s failed: %s" % (parts.netloc, e))
+        else:
+            if status < 400:
+                breaker.success()
+                requests_total.inc(endpoint=endpoint, outcome='ok')
+                return body
+            error = HTTPError("%s answered %d" % (parts.netloc, status),
+                              status=status)
+            if status < 500:
+                # The host is up, and retrying won't help
+                breaker.success()
+                requests_total.inc(endpoint=endpoint, outcome='error')
+                raise error
+        breaker.failure(probe_url)
+        if attempt >= options['RETRIES'] or breaker.is_open():
+            requests_total.inc(endpoint=endpoint, outcome='failed')
+            raise error
+        requests_total.inc(endpoint=endpoint, outcome='retried')
+        # Full jitter spreads the retries of concurrent requests
+        time.sleep(random.uniform(0, options['BACKOFF'] * 2 ** attempt))
+        attempt += 1
+
+def get_json(endpoint, url):
+    """
+    Get JSON response from an URL of the named endpoint and return it as a
+    nested dictionary.
+    """
+    return simplejson.loads(get(endpoint, url))
@@ -0,0 +1,514 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Load-test harness for the checkout flow.
+
+Concurrent buyers load the order page, post orders, pay them with payment
+callbacks or cancel them, while the admin manager view is loaded every now
+and then. The exchange rate and receive API providers are replaced by the
+stubs, so the harness runs offline. Each step is timed and its queries are
+counted, see `loadtest` management command.
+
+In the crowd mode, thousands of simulated customers arrive at the checkout
+at once. A few worker threads step each customer through the waiting room:
+post the order, poll the queue until admitted and post the order again.
+The checkouts in progress and the order of admission are recorded to check
+the waiting room.
+"""
+
+import datetime
+import heapq
+import re
+import threading
+import time
+
+import simplejson
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from leffalippu.models import (Category, Ticket, Inventory, Order,
+                               PaymentAddress)
+from leffalippu import benchmark
+from leffalippu import bitcoin
+from leffalippu import httpclient
+from leffalippu import rates
+from leffalippu import waitingroom
+from leffalippu.stubs import FakeTicker, FakeReceiveAPI
+
+ADMIN_USERNAME = 'loadtest'
+ADMIN_PASSWORD = 'loadtest'
+
+QUEUE_TOKEN = re.compile(br'name="queue" value="([^"]+)"')
+
+class LoadClient(Client):
+    """
+    Test client which returns the error responses instead of re-raising the
+    exceptions of the views.
+
+    The default client stores the exceptions through a global signal, which
+    mixes up the exceptions of concurrent clients.
+    """
+
+    def store_exc_info(self, **kwargs):
+        pass
+
+class Recorder(object):
+    """
+    Thread-safe collection of the latencies, query counts and errors of the
+    steps.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = {}
+
+    def step(self, name):
+        return self.steps.setdefault(name, {'latencies': [],
+                                            'queries': [],
+                                            'errors': {}})
+
+    def measure(self, name, fn, *args, **kwargs):
+        """
+        Call the function, record the measurements and return the result.
+
+        The result is None if the call raised an exception or returned an
+        error response.
+        """
+        error = None
+        result = None
+        with CaptureQueriesContext(connection) as context:
+            start = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                error = e.__class__.__name__
+            latency = time.time() - start
+        status = getattr(result, 'status_code', 200)
+        if status >= 400:
+            error = 'HTTP %d' % status
+            result = None
+        with self.lock:
+            step = self.step(name)
+            step['latencies'].append(latency)
+            step['queries'].append(len(context))
+            if error is not None:
+                step['errors'][error] = step['errors'].get(error, 0) + 1
+        return result
+
+    def count(self):
+        return sum(len(step['latencies']) for step in self.steps.values())
+
+    def report(self, seconds):
+        """
+        Return the report lines.
+        """
+        lines = []
+        for name in sorted(self.steps):
+            step = self.steps[name]
+            queries = step['queries']
+            lines.append("%-16s %s queries=%.1f/%d errors=%s" % (
+                name,
+                benchmark.format_summary(
+                    benchmark.summarize(step['latencies'])),
+                float(sum(queries)) / len(queries),
+                max(queries),
+                ', '.join('%s: %d' % error
+                          for error in sorted(step['errors'].items()))
+                or 0))
+        lines.append("%d requests in %.2fs, %.1f requests/s"
+                     % (self.count(), seconds, self.count() / seconds))
+        return lines
+
+def seed(categories=3, tickets=100):
+    """
+    Create ticket categories and the admin user.
+    """
+    expires = datetime.date.today() + datetime.timedelta(days=365)
+    for i in range(categories):
+        name = 'Loadtest %d' % i
+        category = Category.objects.create(name=name,
+                                           description=name,
+                                           price=700)
+        Ticket.objects.bulk_create(
+            Ticket(category=category,
+                   number='%s-%d' % (name, j),
+                   price=500,
+                   expires=expires)
+            for j in range(tickets))
+        # Bulk creation doesn't send signals
+        Inventory.objects.rebuild(category)
+    if not User.objects.filter(username=ADMIN_USERNAME).exists():
+        User.objects.create_superuser(ADMIN_USERNAME,
+                                      'loadtest@example.com',
+                                      ADMIN_PASSWORD)
+
+class Buyer(threading.Thread):
+    """
+    A customer placing orders one after another.
+
+    Every other order is paid and every other cancelled. Every `admin_every`
+    order the buyer also loads the admin manager view.
+    """
+
+    def __init__(self, index, recorder, orders, admin_every=5):
+        threading.Thread.__init__(self)
+        self.index = index
+        self.recorder = recorder
+        self.orders = orders
+        self.admin_every = admin_every
+
+    def run(self):
+        try:
+            self.loop()
+        finally:
+            connection.close()
+
+    def loop(self):
+        client = LoadClient()
+        admin = LoadClient()
+        admin.login(username=ADMIN_USERNAME, password=ADMIN_PASSWORD)
+        categories = list(Category.objects.values_list('pk', flat=True))
+        for i in range(self.orders):
+            self.order(client, categories, i)
+            if self.admin_every and i % self.admin_every == 0:
+                self.recorder.measure('admin manager', admin.get,
+                                      reverse('admin:manager'))
+
+    def order(self, client, categories, i):
+        email = 'buyer%d-%d@example.com' % (self.index, i)
+        self.recorder.measure('order GET', client.get, reverse('order'))
+        data = order_data(email, categories, i)
+        response = self.recorder.measure('order POST', client.post,
+                                         reverse('order'), data)
+        token = queue_token(response)
+        while token is not None:
+            # Wait for the turn in the checkout queue
+            time.sleep(settings.WAITING_ROOM_POLL_SECONDS)
+            self.recorder.measure('queue poll', client.get,
+                                  reverse('queue_status'), {'queue': token})
+            response = self.recorder.measure('order POST', client.post,
+                                             reverse('order'),
+                                             dict(data, queue=token))
+            token = queue_token(response)
+        orders = list(Order.objects.filter(email=email))
+        if not orders:
+            return
+        order = orders[0]
+        if i % 2 == 0:
+            self.recorder.measure('callback', client.get,
+                                  callback_path(order, 'lt-%d-%d'
+                                                % (self.index, i)))
+            self.recorder.measure('process payments',
+                                  bitcoin.process_payments)
+        else:
+            self.recorder.measure('cancel', cancel_path, client, order)
+
+def order_data(email, categories, i):
+    """
+    POST data of an order of one ticket of every other category.
+    """
+    data = {
+        'email': email,
+        'terms': 'on',
+        'form-TOTAL_FORMS': len(categories),
+        'form-INITIAL_FORMS': 0,
+        'form-MAX_NUM_FORMS': 1000,
+    }
+    for (j, pk) in enumerate(categories):
+        data['form-%d-category' % j] = pk
+        data['form-%d-amount' % j] = 1 if (i + j) % 2 == 0 else 0
+    return data
+
+def queue_token(response):
+    """
+    Return the queue token if the response is the waiting page.
+
+    The token is read from the page, as the contexts of the test client are
+    mixed up between the threads.
+    """
+    match = QUEUE_TOKEN.search(getattr(response, 'content', b''))
+    if match is None:
+        return None
+    return match.group(1).decode('ascii')
+
+def callback_path(order, transaction_hash):
+    """
+    Path of the payment callback paying the full price of the order.
+    """
+    token = PaymentAddress.objects.filter(
+        order=order
+    ).values_list('token', flat=True)[0]
+    return '%s?%s' % (
+        reverse('callback', args=[token]),
+        'value=%d&input_address=%s&destination_address=%s&confirmations=0'
+        '&transaction_hash=%s&input_transaction_hash=in-%s&secret=%s' % (
+            order.price_satoshi,
+            order.public_address,
+            settings.BITCOIN_ADDRESS,
+            transaction_hash,
+            transaction_hash,
+            settings.CALLBACK_SECRET))
+
+def cancel_path(client, order):
+    return client.get(reverse('cancel', args=[order.token]))
+
+class Customer(object):
+    """
+    A customer of the crowd going through the waiting room.
+
+    The customer posts the order, polls the queue while waiting and posts
+    the order with the queue token when admitted.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.token = None
+        self.arrived = None
+        self.waited = None
+
+    def step(self, client, recorder):
+        """
+        Take the next step and return the seconds until the following one,
+        or None when done.
+        """
+        if self.arrived is None:
+            self.arrived = time.time()
+        if self.token is not None:
+            response = recorder.measure('queue poll', client.get,
+                                        reverse('queue_status'),
+                                        {'queue': self.token})
+            if (response is not None and
+                    simplejson.loads(response.content)['waiting']):
+                return settings.WAITING_ROOM_POLL_SECONDS
+            data = dict(self.data, queue=self.token)
+        else:
+            data = self.data
+        response = recorder.measure('order POST', client.post,
+                                    reverse('order'), data)
+        self.token = queue_token(response)
+        if self.token is not None:
+            return settings.WAITING_ROOM_POLL_SECONDS
+        self.waited = time.time() - self.arrived
+        return None
+
+class Gauge(object):
+    """
+    Record the checkouts in progress and the order of admission.
+
+    Wraps the waiting room functions while the crowd runs. A waiting ticket
+    is a FIFO violation if a ticket with the same or a later number was
+    admitted before it was asked for.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.serving = 0
+        self.violations = 0
+        self.requeued = 0
+        self.functions = {}
+
+    def report(self, slots, customers):
+        """
+        Return the report lines.
+        """
+        waits = [customer.waited for customer in customers
+                 if customer.waited is not None]
+        return [
+            "waiting         %s" % benchmark.format_summary(
+                benchmark.summarize(waits)),
+            "%d/%d customers done, peak %d/%d checkouts in progress, "
+            "%d FIFO violations, %d requeued"
+            % (len(waits), len(customers), self.peak, slots,
+               self.violations, self.requeued),
+        ]
+
+    def status(self, number):
+        with self.lock:
+            serving = self.serving
+        ticket = self.functions['status'](number)
+        with self.lock:
+            if ticket.waiting and ticket.number <= serving:
+                self.violations += 1
+            if ticket.admitted:
+                self.serving = max(self.serving, ticket.number)
+        return ticket
+
+    def enter(self, token=None):
+        # The tickets are recorded by the status calls of enter
+        ticket = self.functions['enter'](token)
+        if token and waitingroom.read_token(token) != ticket.number:
+            with self.lock:
+                self.requeued += 1
+        if ticket.admitted:
+            with self.lock:
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+        return ticket
+
+    def release(self, ticket):
+        with self.lock:
+            self.in_flight -= 1
+        return self.functions['release'](ticket)
+
+    def __enter__(self):
+        for name in ('enter', 'status', 'release'):
+            self.functions[name] = getattr(waitingroom, name)
+            setattr(waitingroom, name, getattr(self, name))
+        return self
+
+    def __exit__(self, *exc_info):
+        for (name, fn) in self.functions.items():
+            setattr(waitingroom, name, fn)
+
+def crowd_worker(customers, heap, lock, recorder, close=True):
+    """
+    Step the customers whose turn it is until all of them are done.
+    """
+    client = LoadClient()
+    try:
+        while True:
+            with lock:
+                if not heap:
+                    return
+                (due, index) = heapq.heappop(heap)
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            customer = customers[index]
+            wait = customer.step(client, recorder)
+            if wait is not None:
+                with lock:
+                    heapq.heappush(heap, (time.time() + wait, index))
+    finally:
+        if close:
+            connection.close()
+
+def crowd(customers=1000, workers=20, slots=None, poll_seconds=0.1):
+    """
+    Run a crowd of customers through the waiting room with stubbed
+    providers.
+
+    All the customers arrive at once and order one ticket each. `workers`
+    threads step the customers and `slots` overrides WAITING_ROOM_SLOTS.
+    Returns the recorder, the duration in seconds and the report lines of
+    the waiting room.
+    """
+    seed(categories=1, tickets=customers)
+    ticker = FakeTicker().start()
+    receive_api = FakeReceiveAPI().start()
+    stubbed = override_settings(
+        EXCHANGE_RATE_PROVIDERS=ticker.providers(),
+        BLOCKCHAIN_RECEIVE_URL=receive_api.receive_url(),
+        ADDRESS_POOL_LOW_WATERMARK=0,
+        ORDER_RATE_PER_IP=None,
+        WAITING_ROOM_SLOTS=(settings.WAITING_ROOM_SLOTS if slots is None
+                            else slots),
+        WAITING_ROOM_POLL_SECONDS=poll_seconds)
+    stubbed.enable()
+    try:
+        rates.forget_quote()
+        rates.refresh()
+        bitcoin.fill_address_pool(size=customers)
+        waitingroom.reset()
+        categories = list(Category.objects.values_list('pk', flat=True))
+        crowd = [Customer(order_data('customer%d@example.com' % i,
+                                     categories, 0))
+                 for i in range(customers)]
+        start = time.time()
+        heap = [(start, i) for i in range(customers)]
+        lock = threading.Lock()
+        recorder = Recorder()
+        with Gauge() as gauge:
+            if workers == 1:
+                # Run in this thread, for instance, for in-memory databases
+                crowd_worker(crowd, heap, lock, recorder, close=False)
+            else:
+                threads = [threading.Thread(target=crowd_worker,
+                                            args=(crowd, heap, lock, recorder))
+                           for i in range(workers)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        seconds = time.time() - start
+        lines = gauge.report(settings.WAITING_ROOM_SLOTS, crowd)
+    finally:
+        stubbed.disable()
+        rates.forget_quote()
+        httpclient.reset()
+        ticker.stop()
+        receive_api.stop()
+    return (recorder, seconds, lines)
+
+def run(buyers=10, orders=5, categories=3, tickets=100, pool=True,
+        admin_every=5, stale_rate=False, provider_delay=0):
+    """
+    Seed the database and run the buyers with stubbed providers.
+
+    If `pool` is False, the payment address pool is left empty so that each
+    checkout calls the receive API. If `stale_rate` is True, the exchange
+    rate is never recent enough so that each checkout fetches it. Each
+    request to the stubbed providers takes `provider_delay` seconds.
+    Returns the recorder and the duration in seconds.
+    """
+    seed(categories=categories, tickets=tickets)
+    ticker = FakeTicker().start()
+    receive_api = FakeReceiveAPI().start()
+    stubbed = override_settings(
+        EXCHANGE_RATE_PROVIDERS=ticker.providers(),
+        BLOCKCHAIN_RECEIVE_URL=receive_api.receive_url(),
+        ADDRESS_POOL_LOW_WATERMARK=0,
+        # All the buyers come from the same address
+        ORDER_RATE_PER_IP=None,
+        EXCHANGE_RATE_MAX_AGE=(-1 if stale_rate else
+                               settings.EXCHANGE_RATE_MAX_AGE))
+    stubbed.enable()
+    try:
+        rates.forget_quote()
+        rates.refresh()
+        if pool:
+            bitcoin.fill_address_pool(size=buyers * orders)
+        ticker.delay = receive_api.delay = provider_delay
+        recorder = Recorder()
+        threads = [Buyer(i, recorder, orders, admin_every=admin_every)
+                   for i in range(buyers)]
+        start = time.time()
+        if buyers == 1:
+            # Run in this thread, for instance, for in-memory databases
+            threads[0].loop()
+        else:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        seconds = time.time() - start
+    finally:
+        stubbed.disable()
+        rates.forget_quote()
+        # Close the kept-alive connections to the stubs
+        httpclient.reset()
+        ticker.stop()
+        receive_api.stop()
+    return (recorder, seconds)
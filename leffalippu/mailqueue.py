@@ -0,0 +1,134 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Sending the emails of the outbox.
+
+Several workers can drain the outbox at the same time. A worker claims a
+batch of emails by postponing them for the duration of the batch, sends
+them through one connection of EMAIL_BACKEND and marks them sent. Failed
+emails are retried with exponential backoff and jitter until
+OUTBOX_MAX_ATTEMPTS attempts have failed.
+"""
+
+import datetime
+import random
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from leffalippu.models import OutgoingEmail
+from leffalippu import metrics
+
+""" How long a claimed batch is hidden from the other workers """
+CLAIM_SECONDS = 300
+
+def retry_delay(attempts):
+    """
+    Seconds to wait before the next attempt after `attempts` failed ones.
+    """
+    delay = settings.OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1)
+    return delay * random.uniform(0.5, 1.5)
+
+def claim(batch_size):
+    """
+    Claim a batch of pending emails for this worker.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(OutgoingEmail.objects.pending(now=now)
+                      .select_for_update()[:batch_size])
+        OutgoingEmail.objects.filter(
+            pk__in=[email.pk for email in emails]
+        ).update(next_attempt=now + datetime.timedelta(seconds=CLAIM_SECONDS))
+    return emails
+
+def open_connection(connection):
+    """
+    Open a connection to the mail server, ignoring failures.
+
+    If the server can't be reached, sending each email fails and is retried
+    later.
+    """
+    try:
+        with metrics.timer('email'):
+            connection.open()
+    except Exception:
+        pass
+
+def send_batch(emails, connection):
+    """
+    Send the emails through an open connection and record the results.
+
+    Returns a tuple (sent, retried, failed).
+    """
+    (sent, retried, failed) = (0, 0, 0)
+    for email in emails:
+        try:
+            with metrics.timer('email'):
+                sent_count = connection.send_messages([email.message()])
+            if not sent_count:
+                raise Exception("Email backend did not send the message")
+        except Exception as e:
+            email.attempts += 1
+            email.last_error = "%s" % (e,)
+            if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                email.failed = True
+                failed += 1
+            else:
+                delay = retry_delay(email.attempts)
+                email.next_attempt = (timezone.now() +
+                                      datetime.timedelta(seconds=delay))
+                retried += 1
+            email.save(update_fields=['attempts', 'last_error', 'failed',
+                                      'next_attempt'])
+            # The connection may be broken, so try to open a new one
+            connection.close()
+            open_connection(connection)
+        else:
+            email.sent = timezone.now()
+            email.save(update_fields=['sent'])
+            sent += 1
+    return (sent, retried, failed)
+
+def send_queued_mail(batch_size=100, connection=None):
+    """
+    Send all pending emails in batches through one connection.
+
+    Returns a tuple (sent, retried, failed, elapsed seconds).
+    """
+    start = time.time()
+    if connection is None:
+        connection = get_connection(fail_silently=False)
+    totals = [0, 0, 0]
+    opened = False
+    try:
+        while True:
+            emails = claim(batch_size)
+            if not emails:
+                break
+            if not opened:
+                open_connection(connection)
+                opened = True
+            for (i, count) in enumerate(send_batch(emails, connection)):
+                totals[i] += count
+    finally:
+        if opened:
+            connection.close()
+    return tuple(totals) + (time.time() - start,)
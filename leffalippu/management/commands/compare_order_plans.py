@@ -0,0 +1,80 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Management command for comparing the query plans of the open order lookups.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from leffalippu import queryplans
+
+class Command(BaseCommand):
+    help = ("Seed a large order history in a test database and compare the "
+            "query plans and timings of the open order lookups written with "
+            "the OrderStatus anti-join and with the Order.state column.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--orders',
+                    type='int',
+                    dest='orders',
+                    default=100000,
+                    help="Number of seeded orders."),
+        make_option('--open-every',
+                    type='int',
+                    dest='open_every',
+                    default=50,
+                    help="Every Nth seeded order is open."),
+        make_option('--repeat',
+                    type='int',
+                    dest='repeat',
+                    default=5,
+                    help="Run each lookup this many times and report the "
+                         "fastest."),
+    )
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(
+            verbosity=int(options['verbosity']) - 1,
+            autoclobber=True,
+            serialize=False)
+        try:
+            start = time.time()
+            queryplans.seed(orders=options['orders'],
+                            open_every=options['open_every'])
+            queryplans.analyze()
+            self.stdout.write("Seeded %d orders on %s in %.1f seconds"
+                              % (options['orders'],
+                                 connection.vendor,
+                                 time.time() - start))
+            for (name, before, after, before_seconds, after_seconds) in (
+                    queryplans.compare_open_orders(repeat=options['repeat'])):
+                self.stdout.write("")
+                self.stdout.write("%s: %.2fms -> %.2fms"
+                                  % (name,
+                                     1000 * before_seconds,
+                                     1000 * after_seconds))
+                for (title, plan) in (("OrderStatus anti-join", before),
+                                      ("Order.state", after)):
+                    self.stdout.write("  %s:" % title)
+                    for line in plan:
+                        self.stdout.write("    %s" % line)
+        finally:
+            connection.close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,70 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for expiring open orders.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from leffalippu import expiration
+
+class Command(BaseCommand):
+    help = ("Expire open orders that have not been paid in time and release "
+            "their tickets.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    dest='loop',
+                    default=False,
+                    help="Keep running and expire orders periodically."),
+        make_option('--interval',
+                    type='float',
+                    dest='interval',
+                    default=60,
+                    help="Seconds between the runs when looping."),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=500,
+                    help="Number of orders expired in one transaction."),
+        make_option('--all',
+                    action='store_false',
+                    dest='lookback',
+                    default=True,
+                    help="Look for open orders of any age, for instance, "
+                         "after the expiration has not been run for a while."),
+    )
+
+    def handle(self, *args, **options):
+        lookback = options['lookback']
+        while True:
+            (expired, seconds) = expiration.expire_orders(
+                lookback=lookback,
+                batch_size=options['batch_size'])
+            self.stdout.write("Expired %d orders in %.3f seconds"
+                              % (expired, seconds))
+            if not options['loop']:
+                break
+            # Older orders have been handled by the first run
+            lookback = True
+            time.sleep(options['interval'])
+            close_old_connections()
@@ -0,0 +1,75 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for exporting sales as CSV.
+"""
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from leffalippu import exports
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError("Invalid date: %s" % value)
+
+class Command(BaseCommand):
+    args = "|".join(sorted(exports.EXPORTS))
+    help = ("Export orders, ordered tickets, paid tickets or transactions as "
+            "CSV for accounting.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start',
+                    dest='start',
+                    default=None,
+                    help="First date (YYYY-MM-DD) to export."),
+        make_option('--end',
+                    dest='end',
+                    default=None,
+                    help="Last date (YYYY-MM-DD) to export."),
+        make_option('--status',
+                    dest='status',
+                    default=None,
+                    choices=[name for (name, code) in exports.STATUSES],
+                    help="Export only orders of this status."),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help="Output file (default: standard output)."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in exports.EXPORTS:
+            raise CommandError("Give one of: %s" % self.args)
+        start = options['start'] and parse_date(options['start'])
+        end = options['end'] and parse_date(options['end'])
+        rows = exports.export_rows(args[0],
+                                   start=start,
+                                   end=end,
+                                   status=options['status'])
+        lines = exports.csv_lines(rows)
+        if options['output'] is None:
+            for line in lines:
+                self.stdout.write(line, ending='')
+        else:
+            with open(options['output'], 'wb') as f:
+                for line in lines:
+                    f.write(line)
@@ -0,0 +1,59 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for running a fake mail server.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from leffalippu.stubs import FakeMTA
+
+class Command(BaseCommand):
+    help = ("Run a local SMTP server which accepts and discards all emails. "
+            "Point EMAIL_HOST and EMAIL_PORT to it for testing the outbox "
+            "throughput offline.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--port',
+                    type='int',
+                    dest='port',
+                    default=2525,
+                    help="Port to listen to."),
+        make_option('--delay',
+                    type='float',
+                    dest='delay',
+                    default=0,
+                    help="Seconds spent on each message."),
+    )
+
+    def handle(self, *args, **options):
+        mta = FakeMTA(port=options['port'], delay=options['delay']).start()
+        self.stdout.write("Fake MTA listening on port %d" % mta.port)
+        received = 0
+        try:
+            while True:
+                time.sleep(1)
+                if len(mta.messages) != received:
+                    received = len(mta.messages)
+                    self.stdout.write("%d messages received through %d "
+                                      "connections"
+                                      % (received, mta.connections))
+        except KeyboardInterrupt:
+            mta.stop()
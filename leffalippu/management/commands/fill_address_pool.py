@@ -0,0 +1,66 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for filling the payment address pool.
+"""
+
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from leffalippu import bitcoin
+
+class Command(BaseCommand):
+    help = ("Create payment addresses with callbacks in advance, so that "
+            "checkout doesn't need to wait for the receive API.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    dest='loop',
+                    default=False,
+                    help="Keep running and refill the pool periodically."),
+        make_option('--interval',
+                    type='float',
+                    dest='interval',
+                    default=None,
+                    help="Seconds between the refills when looping "
+                         "(default: ADDRESS_POOL_REFILL_SECONDS)."),
+        make_option('--size',
+                    type='int',
+                    dest='size',
+                    default=None,
+                    help="Number of unused addresses to keep in the pool "
+                         "(default: ADDRESS_POOL_SIZE)."),
+    )
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            interval = settings.ADDRESS_POOL_REFILL_SECONDS
+        while True:
+            created = bitcoin.fill_address_pool(size=options['size'])
+            if created or not options['loop']:
+                self.stdout.write("Created %d addresses, %d unused"
+                                  % (created, bitcoin.count_unused_addresses()))
+            if not options['loop']:
+                break
+            time.sleep(interval)
+            close_old_connections()
@@ -0,0 +1,84 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for importing tickets from a CSV or XLSX file.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from leffalippu.models import Category
+from leffalippu import ticketimport
+
+class Command(BaseCommand):
+    args = "FILE"
+    help = ("Import tickets from a CSV or XLSX file with columns number, "
+            "expires, price and category. Nothing is imported if any of the "
+            "rows is invalid.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--category',
+                    dest='category',
+                    default=None,
+                    help="Name of the category of all the tickets, the file "
+                         "doesn't need a category column then."),
+        make_option('--dry-run',
+                    action='store_true',
+                    dest='dry_run',
+                    default=False,
+                    help="Only validate the file."),
+        make_option('--chunk-size',
+                    type='int',
+                    dest='chunk_size',
+                    default=ticketimport.CHUNK_SIZE,
+                    help="Number of tickets per INSERT."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to import")
+        category = None
+        if options['category'] is not None:
+            try:
+                category = Category.objects.get(name=options['category'])
+            except Category.DoesNotExist:
+                raise CommandError("Unknown category: %s" % options['category'])
+
+        try:
+            with open(args[0], 'rb') as f:
+                result = ticketimport.import_tickets(
+                    ticketimport.read_rows(f, args[0]),
+                    category=category,
+                    dry_run=options['dry_run'],
+                    chunk_size=options['chunk_size'])
+        except (IOError, ticketimport.TicketImportError) as e:
+            raise CommandError(e)
+
+        for (line, message) in result.errors:
+            self.stdout.write(u"Line %d: %s" % (line, message))
+        if result.error_count > len(result.errors):
+            self.stdout.write("... and %d more errors"
+                              % (result.error_count - len(result.errors)))
+        if not result:
+            raise CommandError("%d of %d rows are invalid, nothing was "
+                               "imported" % (result.error_count, result.rows))
+        if result.dry_run:
+            self.stdout.write("%d valid tickets, nothing was imported"
+                              % result.valid)
+        else:
+            self.stdout.write("%d tickets imported" % result.created)
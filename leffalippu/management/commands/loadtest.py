@@ -0,0 +1,225 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for load testing the checkout flow.
+"""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+
+from leffalippu import dbpool
+from leffalippu import loadtest
+
+class Command(BaseCommand):
+    help = ("Run concurrent buyers through the checkout flow in a test "
+            "database and report the latencies, queries per request and "
+            "throughput. Use leffalippu.settings.loadtest settings for "
+            "SQLite or PostgreSQL. --compare-db-pool runs the test without "
+            "and with the database connection pool and --compare-lookups "
+            "with sequential and parallel checkout lookups. --crowd runs a "
+            "crowd of customers through the checkout waiting room.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--buyers',
+                    type='int',
+                    dest='buyers',
+                    default=10,
+                    help="Number of concurrent buyers."),
+        make_option('--orders',
+                    type='int',
+                    dest='orders',
+                    default=5,
+                    help="Number of orders per buyer."),
+        make_option('--categories',
+                    type='int',
+                    dest='categories',
+                    default=3,
+                    help="Number of ticket categories."),
+        make_option('--tickets',
+                    type='int',
+                    dest='tickets',
+                    default=100,
+                    help="Number of tickets per category."),
+        make_option('--admin-every',
+                    type='int',
+                    dest='admin_every',
+                    default=5,
+                    help="Load the admin manager view every N orders of a "
+                         "buyer (0 disables)."),
+        make_option('--no-pool',
+                    action='store_false',
+                    dest='pool',
+                    default=True,
+                    help="Leave the payment address pool empty."),
+        make_option('--stale-rate',
+                    action='store_true',
+                    dest='stale_rate',
+                    default=False,
+                    help="Treat the exchange rate as stale, so each "
+                         "checkout fetches it."),
+        make_option('--provider-delay',
+                    type='float',
+                    dest='provider_delay',
+                    default=0,
+                    help="Seconds each request to the stubbed providers "
+                         "takes."),
+        make_option('--db-pool-size',
+                    type='int',
+                    dest='db_pool_size',
+                    default=None,
+                    help="Size of the database connection pool (0 disables "
+                         "pooling). Requires a pooled database backend."),
+        make_option('--compare-db-pool',
+                    action='store_true',
+                    dest='compare_db_pool',
+                    default=False,
+                    help="Run the test without and with the database "
+                         "connection pool and compare the throughput."),
+        make_option('--compare-lookups',
+                    action='store_true',
+                    dest='compare_lookups',
+                    default=False,
+                    help="Run the test with sequential and parallel "
+                         "checkout lookups and compare the throughput. Use "
+                         "with --no-pool, --stale-rate and --provider-delay."),
+        make_option('--crowd',
+                    type='int',
+                    dest='crowd',
+                    default=None,
+                    help="Run this many customers arriving at once through "
+                         "the waiting room, stepped by --buyers threads."),
+        make_option('--slots',
+                    type='int',
+                    dest='slots',
+                    default=None,
+                    help="Checkouts processed at a time in the waiting room "
+                         "(WAITING_ROOM_SLOTS by default)."),
+    )
+
+    def handle(self, *args, **options):
+        in_memory = (
+            connection.vendor == 'sqlite' and
+            connection.settings_dict['TEST'].get('NAME') in (None, '',
+                                                             ':memory:'))
+        if in_memory and options['buyers'] > 1:
+            raise CommandError("Concurrent buyers can't share an in-memory "
+                               "SQLite database. Use "
+                               "--settings=leffalippu.settings.loadtest.")
+
+        pooled = isinstance(connections[DEFAULT_DB_ALIAS],
+                            dbpool.PooledDatabaseWrapperMixin)
+        size = options['db_pool_size']
+        if size is None:
+            size = dict(dbpool.DEFAULTS,
+                        **(connection.settings_dict.get('POOL') or {}))[
+                            'MAX_SIZE']
+        if not pooled and (options['compare_db_pool'] or
+                           options['db_pool_size'] is not None):
+            raise CommandError("Database connection pooling requires a "
+                               "pooled ENGINE, for instance, "
+                               "leffalippu.backends.postgresql_pool.")
+        if options['compare_db_pool'] and options['compare_lookups']:
+            raise CommandError("Compare one thing at a time.")
+        if options['crowd'] and (options['slots'] or
+                                 settings.WAITING_ROOM_SLOTS) is None:
+            raise CommandError("The waiting room is disabled. Use --slots.")
+
+        # Pairs of a description and the settings of each run
+        if options['compare_db_pool']:
+            runs = [("Database connection pool disabled",
+                     {'db_pool_size': 0}),
+                    ("Database connection pool of %d" % max(size, 1),
+                     {'db_pool_size': max(size, 1)})]
+        elif options['compare_lookups']:
+            runs = [("Sequential checkout lookups",
+                     {'CHECKOUT_PARALLEL_LOOKUPS': False}),
+                    ("Parallel checkout lookups",
+                     {'CHECKOUT_PARALLEL_LOOKUPS': True})]
+        else:
+            runs = [(None, {'db_pool_size': size} if pooled else {})]
+
+        results = []
+        for (description, run_settings) in runs:
+            run_settings = dict(run_settings)
+            if 'db_pool_size' in run_settings:
+                connection.settings_dict['POOL'] = dict(
+                    connection.settings_dict.get('POOL') or {},
+                    MAX_SIZE=run_settings.pop('db_pool_size'))
+            if description:
+                self.stdout.write(description)
+            with override_settings(**run_settings):
+                results.append(self.run(options))
+        if len(results) == 2:
+            self.stdout.write("Throughput changed from %.1f to %.1f "
+                              "requests/s (%+.0f%%)"
+                              % (results[0],
+                                 results[1],
+                                 100.0 * (results[1] - results[0]) /
+                                 results[0]))
+
+    def run(self, options):
+        """
+        Run the load test in a new test database and return the requests
+        per second.
+        """
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=int(options['verbosity']) - 1,
+            autoclobber=True,
+            serialize=False)
+        try:
+            if options['crowd']:
+                self.stdout.write("Running %d customers through the waiting "
+                                  "room with %d threads on %s"
+                                  % (options['crowd'],
+                                     options['buyers'],
+                                     connection.vendor))
+                (recorder, seconds, lines) = loadtest.crowd(
+                    customers=options['crowd'],
+                    workers=options['buyers'],
+                    slots=options['slots'])
+                for line in recorder.report(seconds) + lines:
+                    self.stdout.write(line)
+                return recorder.count() / seconds
+            self.stdout.write("Running %d buyers with %d orders each on %s"
+                              % (options['buyers'],
+                                 options['orders'],
+                                 connection.vendor))
+            (recorder, seconds) = loadtest.run(
+                buyers=options['buyers'],
+                orders=options['orders'],
+                categories=options['categories'],
+                tickets=options['tickets'],
+                pool=options['pool'],
+                admin_every=options['admin_every'],
+                stale_rate=options['stale_rate'],
+                provider_delay=options['provider_delay'])
+            for line in recorder.report(seconds):
+                self.stdout.write(line)
+        finally:
+            # Pooled connections would keep the test database in use
+            connection.close()
+            dbpool.close_pools()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        return recorder.count() / seconds
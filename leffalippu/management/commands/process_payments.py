@@ -0,0 +1,60 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for paying the orders which have received their price.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from leffalippu import bitcoin
+
+class Command(BaseCommand):
+    help = ("Set the fully paid orders to paid state and send the tickets. "
+            "Payment callbacks only record the transactions.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    dest='loop',
+                    default=False,
+                    help="Keep running and process payments periodically."),
+        make_option('--interval',
+                    type='float',
+                    dest='interval',
+                    default=1.0,
+                    help="Seconds between the runs when looping."),
+        make_option('--limit',
+                    type='int',
+                    dest='limit',
+                    default=100,
+                    help="Maximum number of orders paid per run."),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            (paid, failed) = bitcoin.process_payments(limit=options['limit'])
+            if paid or failed or not options['loop']:
+                self.stdout.write("Paid %d orders, %d failed"
+                                  % (paid, failed))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+            close_old_connections()
@@ -0,0 +1,60 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for rebuilding the inventory counters.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from leffalippu.models import Category, Inventory
+
+class Command(BaseCommand):
+    help = ("Check the ticket counters of the categories against the tickets "
+            "and the orders and rebuild the incorrect ones.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check',
+                    action='store_true',
+                    dest='check',
+                    default=False,
+                    help="Only check the counters, do not rebuild them."),
+    )
+
+    def handle(self, *args, **options):
+        mismatches = 0
+        for category in Category.objects.all():
+            counts = Inventory.objects.count_tickets(category)
+            try:
+                inventory = Inventory.objects.get(category=category)
+                current = (inventory.total, inventory.reserved, inventory.sold)
+            except Inventory.DoesNotExist:
+                current = None
+            if current != counts:
+                mismatches += 1
+                self.stdout.write("%s: counters %s, should be %s "
+                                  "(total, reserved, sold)"
+                                  % (category, current, counts))
+            if not options['check']:
+                Inventory.objects.rebuild(category)
+
+        if options['check'] and mismatches:
+            raise CommandError("%d categories have incorrect counters"
+                               % mismatches)
+        self.stdout.write("%d categories checked, %d incorrect"
+                          % (Category.objects.count(), mismatches))
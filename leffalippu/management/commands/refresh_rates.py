@@ -0,0 +1,60 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for refreshing the exchange rate.
+"""
+
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from leffalippu import rates
+
+class Command(BaseCommand):
+    help = "Fetch the EUR/BTC exchange rate from the providers."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    dest='loop',
+                    default=False,
+                    help="Keep running and refresh the rate periodically."),
+        make_option('--interval',
+                    type='float',
+                    dest='interval',
+                    default=None,
+                    help="Seconds between the refreshes when looping "
+                         "(default: EXCHANGE_RATE_REFRESH_SECONDS)."),
+    )
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            interval = settings.EXCHANGE_RATE_REFRESH_SECONDS
+        while True:
+            quote = rates.refresh()
+            if quote is not None:
+                self.stdout.write("%s from %s" % (quote, quote.provider))
+            elif not options['loop']:
+                raise CommandError("All exchange rate providers failed")
+            if not options['loop']:
+                break
+            time.sleep(interval)
+            close_old_connections()
@@ -0,0 +1,122 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for replaying recorded payment callbacks.
+
+Each line of the file is a JSON object with the payment address token and
+the query string of the callback, for instance:
+
+    {"token": "abc123", "query": "value=100000&input_address=...&secret=..."}
+
+Each callback runs in its own transaction, as in production. The
+callbacks write transactions and payments, so unless --commit is given, the
+replay runs in one transaction which is rolled back at the end and each
+callback only releases a savepoint. The latencies then don't include the
+cost of committing.
+"""
+
+import time
+from optparse import make_option
+
+import simplejson
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from leffalippu import benchmark
+from leffalippu import bitcoin
+
+class Command(BaseCommand):
+    args = "FILE"
+    help = ("Replay recorded payment callbacks and report the latencies and "
+            "the number of queries.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat',
+                    type='int',
+                    dest='repeat',
+                    default=1,
+                    help="Number of times each callback is replayed, for "
+                         "simulating retries."),
+        make_option('--commit',
+                    action='store_true',
+                    dest='commit',
+                    default=False,
+                    help="Commit each callback and keep the transactions and "
+                         "payments. Without this, the changes are rolled "
+                         "back and the latencies exclude the commits."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the callback file")
+        try:
+            with open(args[0]) as f:
+                callbacks = [simplejson.loads(line)
+                             for line in f if line.strip()]
+        except (IOError, ValueError) as e:
+            raise CommandError("Could not read callbacks: %s" % e)
+
+        if options['commit']:
+            (ok, rejected, latencies, queries) = self.replay(
+                callbacks, options['repeat'])
+        else:
+            with transaction.atomic():
+                (ok, rejected, latencies, queries) = self.replay(
+                    callbacks, options['repeat'])
+                transaction.set_rollback(True)
+
+        self.stdout.write("Callbacks: %d ok, %d rejected" % (ok, rejected))
+        self.stdout.write("Latency: %s"
+                          % benchmark.format_summary(
+                              benchmark.summarize(latencies)))
+        if queries:
+            self.stdout.write("Queries per callback: mean %.1f, max %d"
+                              % (float(sum(queries)) / len(queries),
+                                 max(queries)))
+        if not options['commit']:
+            self.stdout.write("Rolled back the changes, give --commit to "
+                              "keep them")
+
+    def replay(self, callbacks, repeat):
+        """
+        Replay the callbacks, each in its own transaction or savepoint.
+
+        Returns the numbers of accepted and rejected callbacks and the
+        latencies and query counts of the callbacks.
+        """
+        factory = RequestFactory()
+        latencies = []
+        queries = []
+        (ok, rejected) = (0, 0)
+        for i in range(repeat):
+            for cb in callbacks:
+                request = factory.get('/callback/%s/?%s' % (cb['token'],
+                                                             cb['query']))
+                with CaptureQueriesContext(connection) as context:
+                    start = time.time()
+                    try:
+                        with transaction.atomic():
+                            bitcoin.callback(request, cb['token'])
+                        ok += 1
+                    except Http404:
+                        rejected += 1
+                    latencies.append(time.time() - start)
+                queries.append(len(context))
+        return (ok, rejected, latencies, queries)
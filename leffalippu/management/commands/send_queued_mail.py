@@ -0,0 +1,62 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for sending the emails of the outbox.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from leffalippu import mailqueue
+
+class Command(BaseCommand):
+    help = "Send the pending emails of the outbox."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    dest='loop',
+                    default=False,
+                    help="Keep running and send emails as they arrive."),
+        make_option('--interval',
+                    type='float',
+                    dest='interval',
+                    default=5,
+                    help="Seconds between polling the outbox when looping."),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=100,
+                    help="Number of emails claimed at a time."),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            (sent, retried, failed, seconds) = mailqueue.send_queued_mail(
+                batch_size=options['batch_size'])
+            if sent or retried or failed or not options['loop']:
+                self.stdout.write("Sent %d, retrying %d and failed %d emails "
+                                  "in %.3f seconds (%.1f emails/s)"
+                                  % (sent, retried, failed, seconds,
+                                     (sent + retried + failed) / max(seconds, 1e-6)))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+            close_old_connections()
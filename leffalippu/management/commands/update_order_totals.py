@@ -0,0 +1,32 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Management command for recomputing the stored order totals.
+"""
+
+from django.core.management.base import BaseCommand
+
+from leffalippu.models import Order
+
+class Command(BaseCommand):
+    help = ("Recompute the stored total prices of the orders from their "
+            "ordered tickets, for instance, for orders created before the "
+            "totals were stored.")
+
+    def handle(self, *args, **options):
+        updated = Order.objects.update_totals()
+        self.stdout.write("%d orders updated" % updated)
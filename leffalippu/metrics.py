@@ -0,0 +1,255 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+In-process performance metrics.
+
+Counters and histograms are kept in the memory of each worker process and
+rendered in Prometheus text format by `render`, which the /metrics view
+serves. Time spent in external services is measured with `timer`, which
+also adds the time to the totals of the current request for
+`leffalippu.middleware.PerformanceMiddleware`.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from leffalippu.cache_backends import cache_stats
+from leffalippu.dbpool import pool_stats
+
+""" Buckets of durations in seconds """
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+""" Buckets of query counts """
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+def _escape(value):
+    return (u'%s' % value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+def _labels(labels):
+    items = sorted(labels)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for (name, value) in items)
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    """
+    Monotonically increasing count with labels.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(key), value)
+                    for (key, value) in sorted(self.values.items())]
+
+class Histogram(object):
+    """
+    Distribution of observed values with labels, in cumulative buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            (counts, total) = self.values.get(key, ([0] * len(self.buckets), 0))
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for (key, (counts, total)) in sorted(self.values.items()):
+                labels = dict(key)
+                for (bound, count) in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket',
+                                    dict(labels, le=_number(bound)),
+                                    count))
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, counts[-1]))
+        return samples
+
+class Registry(object):
+    """
+    Collection of the metrics of this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def add_collector(self, collector):
+        """
+        Add a function returning extra metrics at render time.
+
+        The function returns a list of (name, kind, help, samples) tuples.
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """
+        Return the metrics in Prometheus text format.
+        """
+        families = [(metric.name, metric.kind, metric.help, metric.samples())
+                    for (name, metric) in sorted(self.metrics.items())]
+        for collector in self.collectors:
+            families.extend(collector())
+        lines = []
+        for (name, kind, help, samples) in families:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (sample, labels, value) in samples:
+                lines.append('%s%s %s' % (sample,
+                                          _labels(labels.items()),
+                                          _number(value)))
+        return u'\n'.join(lines) + u'\n'
+
+REGISTRY = Registry()
+
+request_seconds = REGISTRY.histogram(
+    'leffalippu_request_seconds',
+    'Wall time of the requests by view.')
+db_queries = REGISTRY.histogram(
+    'leffalippu_request_db_queries',
+    'Database queries per request by view.',
+    buckets=COUNT_BUCKETS)
+db_seconds = REGISTRY.histogram(
+    'leffalippu_request_db_seconds',
+    'Database time of the requests by view.')
+external_seconds = REGISTRY.histogram(
+    'leffalippu_external_seconds',
+    'Time spent in external services (http, email).')
+requests_total = REGISTRY.counter(
+    'leffalippu_requests_total',
+    'Requests by view and status code.')
+
+def cache_metrics():
+    stats = cache_stats()
+    return [
+        ('leffalippu_cache_%s_total' % kind,
+         'counter',
+         'Cache %s of this process by cache directory.' % kind,
+         [('leffalippu_cache_%s_total' % kind,
+           {'location': location},
+           counts[kind])
+          for (location, counts) in sorted(stats.items())])
+        for kind in ('hits', 'misses')
+    ]
+
+REGISTRY.add_collector(cache_metrics)
+
+def pool_metrics():
+    stats = pool_stats()
+    families = [
+        ('leffalippu_db_pool_connections_%s_total' % kind,
+         'counter',
+         'Database connections %s by the pool of this process.' % kind,
+         [('leffalippu_db_pool_connections_%s_total' % kind,
+           {'alias': alias},
+           counts[kind])
+          for (alias, counts) in sorted(stats.items())])
+        for kind in ('created', 'reused', 'discarded')
+    ]
+    families.extend(
+        ('leffalippu_db_pool_connections_%s' % kind,
+         'gauge',
+         'Database connections %s in the pool of this process.' % kind,
+         [('leffalippu_db_pool_connections_%s' % kind,
+           {'alias': alias},
+           counts[kind])
+          for (alias, counts) in sorted(stats.items())])
+        for kind in ('open', 'idle'))
+    return families
+
+REGISTRY.add_collector(pool_metrics)
+
+def render():
+    return REGISTRY.render()
+
+# Timings of the current request
+_local = threading.local()
+
+def begin_request():
+    """
+    Start collecting the external timings of a request in this thread.
+    """
+    _local.timings = {}
+
+def end_request():
+    """
+    Stop collecting and return the external seconds by kind.
+    """
+    timings = getattr(_local, 'timings', None) or {}
+    _local.timings = None
+    return timings
+
+@contextmanager
+def timer(kind):
+    """
+    Measure time spent in an external service, for instance, 'http' or
+    'email'.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        external_seconds.observe(elapsed, kind=kind)
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings[kind] = timings.get(kind, 0.0) + elapsed
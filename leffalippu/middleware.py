@@ -0,0 +1,160 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Middleware for `leffalippu`.
+"""
+
+import logging
+import threading
+import time
+
+import simplejson
+
+from django.conf import settings
+from django.db import connections
+
+from leffalippu import metrics
+
+logger = logging.getLogger('leffalippu.performance')
+
+_slow_log_lock = threading.Lock()
+
+class QueryRecorder(object):
+    """
+    Cursor which appends the SQL and the duration of each query to a list.
+
+    Unlike the debug cursor of Django, this does not format the executed
+    query with its parameters nor keep the queries in `connection.queries`
+    after the request.
+    """
+
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def _record(self, method, sql, *args):
+        start = time.time()
+        try:
+            return method(sql, *args)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'time': "%.3f" % (time.time() - start),
+            })
+
+    def execute(self, sql, params=None):
+        return self._record(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._record(self.cursor.executemany, sql, param_list)
+
+def _record_queries(connection, queries):
+    """
+    Make the cursors of the connection record their queries to the list.
+    """
+    cursor = type(connection).cursor
+    connection.cursor = lambda: QueryRecorder(cursor(connection), queries)
+
+def _stop_recording(connection):
+    connection.__dict__.pop('cursor', None)
+
+class PerformanceMiddleware(object):
+    """
+    Record the wall time, the database queries and time and the time spent
+    in external services of each request.
+
+    The numbers are logged as one JSON line per request to
+    `leffalippu.performance` logger and added to the histograms of
+    `leffalippu.metrics` by view. Requests slower than
+    SLOW_REQUEST_SECONDS are appended with their queries to
+    SLOW_REQUEST_LOG file, if it is set.
+
+    Put this first in MIDDLEWARE_CLASSES.
+    """
+
+    def process_request(self, request):
+        request._performance = {
+            'start': time.time(),
+            'view': None,
+            'queries': [],
+        }
+        for connection in connections.all():
+            _record_queries(connection, request._performance['queries'])
+        metrics.begin_request()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        performance = getattr(request, '_performance', None)
+        if performance is not None:
+            match = getattr(request, 'resolver_match', None)
+            performance['view'] = ((match and match.url_name) or
+                                   getattr(view_func, '__name__', None))
+
+    def process_response(self, request, response):
+        performance = getattr(request, '_performance', None)
+        if performance is None:
+            return response
+        del request._performance
+        elapsed = time.time() - performance['start']
+        external = metrics.end_request()
+
+        queries = performance['queries']
+        for connection in connections.all():
+            _stop_recording(connection)
+        db_seconds = sum(float(query['time']) for query in queries)
+
+        view = performance['view'] or 'unknown'
+        metrics.request_seconds.observe(elapsed, view=view)
+        metrics.db_queries.observe(len(queries), view=view)
+        metrics.db_seconds.observe(db_seconds, view=view)
+        metrics.requests_total.inc(view=view, status=response.status_code)
+
+        record = {
+            'view': view,
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'seconds': round(elapsed, 6),
+            'db_queries': len(queries),
+            'db_seconds': round(db_seconds, 6),
+            'http_seconds': round(external.get('http', 0.0), 6),
+            'email_seconds': round(external.get('email', 0.0), 6),
+        }
+        logger.info(simplejson.dumps(record))
+
+        if (settings.SLOW_REQUEST_LOG and
+            elapsed >= settings.SLOW_REQUEST_SECONDS):
+            record['queries'] = queries
+            try:
+                with _slow_log_lock:
+                    with open(settings.SLOW_REQUEST_LOG, 'a') as f:
+                        f.write(simplejson.dumps(record) + '\n')
+            except IOError:
+                logger.exception("Could not write the slow request log")
+
+        return response
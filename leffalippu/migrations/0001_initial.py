@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100)),
+                ('description', models.TextField()),
+                ('price', models.PositiveIntegerField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('rate', models.FloatField()),
+                ('provider', models.CharField(max_length=100)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now, db_index=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Inventory',
+            fields=[
+                ('category', models.OneToOneField(primary_key=True, serialize=False, to='leffalippu.Category')),
+                ('total', models.IntegerField(default=0)),
+                ('reserved', models.IntegerField(default=0)),
+                ('sold', models.IntegerField(default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('email', models.EmailField(max_length=75)),
+                ('ip', models.GenericIPAddressField(null=True, blank=True)),
+                ('public_address', models.CharField(unique=True, max_length=100)),
+                ('price_satoshi', models.BigIntegerField()),
+                ('amount_paid', models.BigIntegerField(default=0)),
+                ('total_cents', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='OrderedTickets',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('amount', models.PositiveIntegerField()),
+                ('price', models.PositiveIntegerField()),
+                ('category', models.ForeignKey(to='leffalippu.Category')),
+                ('order', models.ForeignKey(to='leffalippu.Order')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='OrderStatus',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(max_length=1, choices=[(b'P', b'Paid'), (b'C', b'Cancelled'), (b'E', b'Expired')])),
+                ('order', models.OneToOneField(to='leffalippu.Order')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('from_email', models.CharField(max_length=254)),
+                ('recipients', models.TextField()),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField()),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, db_index=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('sent', models.DateTimeField(null=True, blank=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='PaidTicket',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('orderstatus', models.ForeignKey(to='leffalippu.OrderStatus')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='PaymentAddress',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('address', models.CharField(unique=True, max_length=100)),
+                ('token', models.CharField(unique=True, max_length=40)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('claimed', models.DateTimeField(null=True, blank=True)),
+                ('order', models.OneToOneField(null=True, blank=True, to='leffalippu.Order')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Ticket',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('price', models.PositiveIntegerField()),
+                ('number', models.CharField(max_length=100)),
+                ('expires', models.DateField()),
+                ('category', models.ForeignKey(to='leffalippu.Category')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Transaction',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('value', models.BigIntegerField()),
+                ('input_address', models.CharField(max_length=100)),
+                ('destination_address', models.CharField(max_length=100)),
+                ('confirmations', models.IntegerField()),
+                ('transaction_hash', models.CharField(unique=True, max_length=100)),
+                ('input_transaction_hash', models.CharField(max_length=100)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(to='leffalippu.Order')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ticket',
+            unique_together=set([('number', 'category')]),
+        ),
+        migrations.AddField(
+            model_name='paidticket',
+            name='ticket',
+            field=models.OneToOneField(to='leffalippu.Ticket'),
+            preserve_default=True,
+        ),
+        migrations.AlterUniqueTogether(
+            name='orderedtickets',
+            unique_together=set([('order', 'category')]),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='tickets',
+            field=models.ManyToManyField(to='leffalippu.Category', through='leffalippu.OrderedTickets'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leffalippu', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='orderstatus',
+            index_together=set([('status', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='ticket',
+            index_together=set([('category', 'expires')]),
+        ),
+    ]
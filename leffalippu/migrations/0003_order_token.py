@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from leffalippu import tokens
+
+
+def set_tokens(apps, schema_editor):
+    Order = apps.get_model('leffalippu', 'Order')
+    pks = Order.objects.filter(token__isnull=True).values_list('pk', flat=True)
+    for (pk, token) in tokens.encode_many(pks.iterator()).items():
+        Order.objects.filter(pk=pk).update(token=token)
+
+
+def unset_tokens(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leffalippu', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='token',
+            field=models.CharField(max_length=16, unique=True, null=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_tokens, unset_tokens),
+    ]
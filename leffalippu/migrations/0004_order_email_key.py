@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from leffalippu import throttling
+
+
+def set_email_keys(apps, schema_editor):
+    Order = apps.get_model('leffalippu', 'Order')
+    emails = Order.objects.values_list('email', flat=True).distinct()
+    for email in emails.iterator():
+        Order.objects.filter(email=email).update(
+            email_key=throttling.normalize_email(email))
+
+
+def unset_email_keys(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leffalippu', '0003_order_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='email_key',
+            field=models.CharField(default='', max_length=254, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='order',
+            index_together=set([('email_key', 'date')]),
+        ),
+        migrations.RunPython(set_email_keys, unset_email_keys),
+    ]
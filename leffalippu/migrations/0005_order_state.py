@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def set_states(apps, schema_editor):
+    Order = apps.get_model('leffalippu', 'Order')
+    OrderStatus = apps.get_model('leffalippu', 'OrderStatus')
+    # The closed states are the statuses of OrderStatus
+    statuses = OrderStatus.objects.values_list('status', flat=True).distinct()
+    for status in statuses:
+        Order.objects.filter(orderstatus__status=status).update(state=status)
+
+
+def unset_states(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leffalippu', '0004_order_email_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='state',
+            field=models.CharField(default='O', max_length=1, editable=False, choices=[('O', 'Open'), ('P', 'Paid'), ('C', 'Cancelled'), ('E', 'Expired')]),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='order',
+            index_together=set([('email_key', 'date'), ('state', 'date')]),
+        ),
+        migrations.RunPython(set_states, unset_states),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Sum
+
+
+def create_counters(apps, schema_editor):
+    """
+    Compute the missing counters of the existing categories, as they are
+    otherwise created only when a category is saved.
+    """
+    Category = apps.get_model('leffalippu', 'Category')
+    Ticket = apps.get_model('leffalippu', 'Ticket')
+    OrderedTickets = apps.get_model('leffalippu', 'OrderedTickets')
+    Inventory = apps.get_model('leffalippu', 'Inventory')
+    for category in Category.objects.filter(inventory=None):
+        ordered_tickets = OrderedTickets.objects.filter(category=category)
+        reserved = ordered_tickets.filter(
+            order__state='O'
+        ).aggregate(Sum('amount'))['amount__sum']
+        sold = ordered_tickets.filter(
+            order__state='P'
+        ).aggregate(Sum('amount'))['amount__sum']
+        Inventory.objects.create(
+            category=category,
+            total=Ticket.objects.filter(category=category).count(),
+            reserved=reserved or 0,
+            sold=sold or 0)
+
+
+def remove_counters(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leffalippu', '0005_order_state'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_counters, remove_counters),
+    ]
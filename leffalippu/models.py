@@ -22,64 +22,91 @@ Models for `leffalippu`.
 # could first reserve tickets, then buy other tickets with more
 # expiration time and then cancel the previous ones.
 
-from django.db import models
+from django.db import models, transaction, connections, IntegrityError
 
-from django.db.models import Count, Sum, Q
-
-#import encrypted_models
-
-#from mail_templated import send_mail
+from django.db.models import Count, Sum, Q, F
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
 
 from django.conf import settings
+from django.core.mail import EmailMessage
+from django.template import Context
+from django.template.loader import get_template
+from django.template.loader_tags import BlockNode
 
-# A cron job for finding expired orders.
-# Add to crontab: python manage.py runcrons
-#from django_cron import CronJobBase, Schedule
-#from mail_templated import send_mail
 import datetime
 from django.utils import timezone
 
-## class ExpirationCronJob(CronJobBase):
-##     RUN_EVERY_MINS = 1 # every minute
-
-##     schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
-##     code = 'leffalippu.check_expiration'    # a unique code
-
-##     def do(self):
-##         now = timezone.now()
-##         delta = datetime.timedelta(0, 60*settings.EXPIRATION_MINUTES)
-##         earliest_date = now - delta
-##         expired_orders = Order.objects.filter(orderstatus=None,date__lt=earliest_date)
-##         for order in expired_orders:
-##             try:
-##                 expired_status = OrderStatus(order=order, 
-##                                              status=OrderStatus.EXPIRED)
-##                 expired_status.save()
-##                 ## send_mail('email/expire.txt',
-##                 ##           {
-##                 ##               'order': order,
-##                 ##               'EMAIL_ADDRESS': settings.EMAIL_ADDRESS,
-##                 ##           },
-##                 ##           settings.EMAIL_ADDRESS,
-##                 ##           [order.email])
-##             except:
-##                 pass
-        
-    
-## class CategoryManager(models.Manager):
-
-##     def OLD_with_amount_available(self):
-##         # Amount of reserved/buyed tickets
-##         category_list = self.annotate(amount_reserved=Sum('orderedtickets__amount'))
-##         # Total amount of tickets
-##         category_list = category_list.annotate(amount_total=Count('ticket'))
-##         # Compute the number of available tickets
-##         for category in category_list:
-##             if category.amount_reserved:
-##                 category.amount_available = category.amount_total - category.amount_reserved
-##             else:
-##                 category.amount_available = category.amount_total
-##         return category_list
+from leffalippu import caching
+from leffalippu import throttling
+from leffalippu import tokens
+
+class CategoryManager(models.Manager):
+
+    def with_amount_available(self):
+        """
+        Annotate categories with amount_total, amount_reserved and
+        amount_available.
+
+        The amounts are read from the inventory counters with correlated
+        subqueries, so the list is one SQL statement without the join fan-out
+        of counting tickets and summing ordered tickets at the same
+        time. Reserved amount includes the tickets of both open and paid
+        orders.
+
+        Note that the amount_available attribute shadows the method of the
+        same name for the annotated instances.
+        """
+        counter = self._inventory_counter()
+        return self.extra(select={
+            'amount_total': counter % "total",
+            'amount_reserved': counter % "reserved + sold",
+            'amount_available': counter % "total - reserved - sold",
+        })
+
+    def with_totals(self):
+        """
+        Annotate categories with the amounts of `with_amount_available` and
+        amount_sold and revenue (in cents) of the paid orders.
+
+        The revenue is a correlated subquery too, so the dashboard gets the
+        totals of all categories with one SQL statement.
+        """
+        revenue = ("SELECT COALESCE(SUM(%(ordered)s.amount * %(ordered)s.price), 0) "
+                   "FROM %(ordered)s INNER JOIN %(order)s "
+                   "ON %(order)s.id = %(ordered)s.order_id "
+                   "WHERE %(ordered)s.category_id = %(category)s.id "
+                   "AND %(order)s.state = %%s"
+                   % {
+                       'ordered': OrderedTickets._meta.db_table,
+                       'order': Order._meta.db_table,
+                       'category': Category._meta.db_table,
+                   })
+        return self.with_amount_available().extra(
+            select={
+                'amount_sold': self._inventory_counter() % "sold",
+                'revenue': revenue,
+            },
+            select_params=(Order.PAID,))
+
+    def cached_list(self):
+        """
+        Return the list of categories from the cache.
+
+        The cache is invalidated whenever a category or a ticket is saved or
+        deleted.
+        """
+        return caching.cached('categories',
+                              settings.CATEGORY_CACHE_SECONDS,
+                              lambda: list(self.order_by('pk')))
+
+    def _inventory_counter(self):
+        return ("SELECT %%s FROM %(inventory)s "
+                "WHERE %(inventory)s.category_id = %(category)s.id"
+                % {
+                    'inventory': Inventory._meta.db_table,
+                    'category': Category._meta.db_table,
+                })
 
 class Category(models.Model):
     """
@@ -98,30 +125,23 @@ class Category(models.Model):
     """ Current selling price of the tickets in cents """
     price = models.PositiveIntegerField()
 
-    #objects = CategoryManager()
+    objects = CategoryManager()
 
     def __unicode__(self):
         return self.name
 
     def amount_available(self):
-        amount_total = self.ticket_set.count()
-        ordered_tickets = self.orderedtickets_set.filter(Q(order__orderstatus=None) | 
-                                                           Q(order__orderstatus__status=OrderStatus.PAID))
-        amount_ordered = ordered_tickets.aggregate(Sum('amount'))['amount__sum']
-        # Use if clause to avoid None
-        if amount_ordered is not None:
-            return (amount_total - amount_ordered)
-        else:
-            return amount_total
+        try:
+            inventory = Inventory.objects.get(category=self)
+        except Inventory.DoesNotExist:
+            inventory = Inventory.objects.rebuild(self)
+        return inventory.available()
 
     def price_in_euros(self):
         return self.price/100.0 #".2f" % (self.price/100.0)
         
         
 
-## class OrderManager(encrypted_models.EncryptedPKModelManager):
-##     pass
-
     ## def create_order(self, email):
     ##     # Send email with payment instructions
     ##     pass
@@ -131,8 +151,58 @@ class Category(models.Model):
     ##     # been paid..
     ##     pass
 
+class OrderManager(models.Manager):
+
+    def with_price(self):
+        """
+        Annotate orders with price_cents summed from the ordered tickets.
+
+        The sum is computed in SQL, so it can be used for checking or
+        reporting without loading the ordered tickets. Normally, read the
+        stored total_cents instead.
+        """
+        return self.extra(select={'price_cents': self._price_sql()})
+
+    def update_totals(self):
+        """
+        Recompute the stored total_cents of the orders from their ordered
+        tickets with one UPDATE statement.
+
+        Returns the number of corrected orders.
+        """
+        price = self._price_sql()
+        cursor = connections[self.db].cursor()
+        cursor.execute("UPDATE %(order)s SET total_cents = (%(price)s) "
+                       "WHERE total_cents <> (%(price)s)"
+                       % {
+                           'order': Order._meta.db_table,
+                           'price': price,
+                       })
+        return cursor.rowcount
+
+    def count_open(self, email):
+        """
+        Count the open orders of an email address which haven't expired.
+
+        The addresses are compared in normalized form, and the lookup is a
+        range scan of the (email_key, date) index.
+        """
+        since = timezone.now() - datetime.timedelta(
+            minutes=settings.EXPIRATION_MINUTES)
+        return self.filter(email_key=throttling.normalize_email(email),
+                           date__gte=since,
+                           state=Order.OPEN).count()
+
+    def _price_sql(self):
+        return ("SELECT COALESCE(SUM(%(ordered)s.amount * %(ordered)s.price), 0) "
+                "FROM %(ordered)s "
+                "WHERE %(ordered)s.order_id = %(order)s.id"
+                % {
+                    'ordered': OrderedTickets._meta.db_table,
+                    'order': Order._meta.db_table,
+                })
+
 class Order(models.Model):
-#class Order(encrypted_models.EncryptedPKModel):
     """
     Class for handling ordering of tickets.
 
@@ -141,14 +211,39 @@ class Order(models.Model):
     for the reservation until it either expires or is cancelled.
     """
 
-    """ Object manager for encrypted PKs """
-    #objects = OrderManager()
+    objects = OrderManager()
+
+    # State: open or the status of OrderStatus
+    OPEN = 'O'
+    PAID = 'P'
+    CANCELLED = 'C'
+    EXPIRED = 'E'
+    STATE_CHOICES = (
+        (OPEN, 'Open'),
+        (PAID, 'Paid'),
+        (CANCELLED, 'Cancelled'),
+        (EXPIRED, 'Expired'),
+    )
+    """
+    Current state of the order. Copy of the status of OrderStatus (which
+    records the closing) so that the open orders can be found without a
+    join.
+    """
+    state = models.CharField(max_length=1, choices=STATE_CHOICES,
+                             default=OPEN, editable=False)
+
+    """ Public identifier of the order for the customer, see tokens.py """
+    token = models.CharField(max_length=16, unique=True, null=True,
+                             editable=False)
 
     """ Timestamp of the order placement """
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
     
     """ Email address of the customer """
     email = models.EmailField()
+
+    """ Normalized email address for counting the orders of a customer """
+    email_key = models.CharField(max_length=254, default='', editable=False)
     
     """ IP address from where the reservation was made """
     ip = models.GenericIPAddressField(null=True,
@@ -166,83 +261,155 @@ class Order(models.Model):
 
     """ The EUR price converted to bitcoins (in satoshi units) """
     price_satoshi = models.BigIntegerField()
+
+    """ Sum of the received transactions (in satoshi units) """
+    amount_paid = models.BigIntegerField(default=0)
+
+    """ Total price of the ordered tickets in cents, set when reserving """
+    total_cents = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # Recent orders of a customer and orders of a state by date
+        index_together = (("email_key", "date"),
+                          ("state", "date"))
     
     def price(self):
-        total_price = 0
-        for tickets in self.orderedtickets_set.all():
-            total_price += tickets.amount * tickets.price
-        return total_price
+        return self.total_cents
 
     def price_in_euros(self):
         return "%.2f" % (self.price()/100.0,)
+    price_in_euros.admin_order_field = 'total_cents'
 
     def price_in_bitcoins(self):
         return "%.8f" % (self.price_satoshi * 1e-8)
 
     def cancel(self):
-        pass
+        """
+        Cancel the order if it is still open.
+
+        Returns True if the order was cancelled.
+        """
+        return self.close(OrderStatus.CANCELLED, 'email/cancel.txt')
 
     def expire(self):
-        pass
+        """
+        Expire the order if it is still open.
+
+        Returns True if the order was expired.
+        """
+        return self.close(OrderStatus.EXPIRED, 'email/expire.txt')
+
+    def close(self, status, email_template):
+        """
+        Close an open order without paying, release its reserved tickets and
+        email the customer.
+
+        Returns False if the order was already closed or paid, also when a
+        concurrent payment or expiration closed it in between.
+        """
+        # Only open orders can be closed, so check that orderstatus does not
+        # exist.
+        try:
+            self.status = self.orderstatus.status
+            self.sync_state()
+            return False
+        except OrderStatus.DoesNotExist:
+            pass
+        try:
+            with transaction.atomic():
+                orderstatus = OrderStatus(order=self,
+                                          status=status)
+                orderstatus.save()
+                self.set_state(status)
+                for ordered_tickets in self.orderedtickets_set.all():
+                    Inventory.objects.release(ordered_tickets.category_id,
+                                              ordered_tickets.amount)
+                OutgoingEmail.objects.enqueue(email_template,
+                                              {
+                                                  'order': self,
+                                              },
+                                              [self.email])
+        except IntegrityError:
+            # The status was inserted after the check above
+            self.status = OrderStatus.objects.get(order=self).status
+            self.sync_state()
+            return False
+        self.status = orderstatus.status
+        return True
+
+    def set_state(self, state):
+        """
+        Update the state column after the OrderStatus has been saved.
+        """
+        Order.objects.filter(pk=self.pk).update(state=state)
+        self.state = state
+
+    def sync_state(self):
+        """
+        Copy the status of an already closed order to the state column, if
+        they differ, for instance, after editing the database by hand.
+        """
+        if self.state != self.status:
+            self.set_state(self.status)
+
+    def save(self, *args, **kwargs):
+        """
+        Save the order and set its token on the first save.
+
+        The token is derived from the primary key, so it can be set only
+        after the order has been inserted. Creating an order therefore costs
+        an INSERT and an UPDATE of the same row, which is cheap within the
+        checkout transaction and keeps the tokens verifiable from the key.
+        """
+        self.email_key = throttling.normalize_email(self.email)
+        super(Order, self).save(*args, **kwargs)
+        if self.token is None:
+            self.token = tokens.encode(self.pk)
+            Order.objects.filter(pk=self.pk).update(token=self.token)
 
     def __unicode__(self):
-        return self.encrypted_pk
+        return self.token or u''
     #return "%s %s" % (self.email, self.date)
 
     def pay(self):
+        """
+        Mark the order paid and give the ordered tickets to it.
+
+        For each category, exactly the ordered amount of unsold tickets are
+        locked and the paid tickets are inserted with one statement.
+        """
         # Only open orders can be paid, so check that orderstatus does not exist.
         try:
             self.status = self.orderstatus.status
+            self.sync_state()
         except OrderStatus.DoesNotExist:
-            orderstatus = OrderStatus(order=self,
-                                      status=OrderStatus.PAID)
-            try:
-                orderstatus.save()
-                self.status = orderstatus.status
-            except:
-                raise Exception("Order could not be paid. Handle this situation.")
-
-            # Add tickets to it
-            for ordered_tickets in self.orderedtickets_set.all(): #OrderedTickets.objects.filter(order=self):
-                category = ordered_tickets.category
-                amount = ordered_tickets.amount
-                tickets = Ticket.objects.filter(category=category,
-                                                paidticket=None).order_by('expires')
-                if len(tickets) < amount:
-                    # This should not happen: A customer has paid for more
-                    # tickets than we have available. If this ever
-                    # happens, it means there's a bug in this system.
-                    raise Exception("Serious bug in the system. Not enough tickets available.")
-                amount_given = 0
-                for ticket in tickets[:amount]:
-                    if amount_given == amount:
-                        break
-                    paid_ticket = PaidTicket(ticket=ticket, orderstatus=orderstatus)
-                    try:
-                        paid_ticket.save()
-                        amount_given += 1
-                    except:
-                        # This may happen extremely rarely: Someone has
-                        # bought a ticket that was available when we
-                        # filtered. This may happen if several customers
-                        # are paying at the same time. However, there
-                        # should be enough tickets available, so no need
-                        # to worry.
-                        pass
-                if PaidTicket.objects.filter(orderstatus=orderstatus).count() != amount:
-                    # This should not happen: The system was not able to
-                    # provide enough tickets for the customer.
-                    raise Exception("Serious bug in the system. Not enough tickets given to the customer.")
-
-            tickets = Ticket.objects.filter(paidticket__orderstatus=orderstatus)
-            ## send_mail('email/pay.txt',
-            ##           {
-            ##               'order': self,
-            ##               'tickets': tickets,
-            ##               'EMAIL_ADDRESS': settings.EMAIL_ADDRESS,
-            ##           },
-            ##           settings.EMAIL_ADDRESS,
-            ##           [self.email])
+            # Status, tickets and the inventory counters change together. On
+            # SQLite, inserting the status first serializes the payers.
+            with transaction.atomic():
+                orderstatus = OrderStatus(order=self,
+                                          status=OrderStatus.PAID)
+                try:
+                    orderstatus.save()
+                    self.status = orderstatus.status
+                except:
+                    raise Exception("Order could not be paid. Handle this situation.")
+                self.set_state(OrderStatus.PAID)
+
+                # Add tickets to it
+                for ordered_tickets in self.orderedtickets_set.all():
+                    PaidTicket.objects.allocate(orderstatus,
+                                                ordered_tickets.category_id,
+                                                ordered_tickets.amount)
+                    Inventory.objects.sell(ordered_tickets.category_id,
+                                           ordered_tickets.amount)
+
+                tickets = Ticket.objects.filter(paidticket__orderstatus=orderstatus)
+                OutgoingEmail.objects.enqueue('email/pay.txt',
+                                              {
+                                                  'order': self,
+                                                  'tickets': tickets,
+                                              },
+                                              [self.email])
 
 class OrderedTickets(models.Model):
     """
@@ -268,7 +435,32 @@ class OrderedTickets(models.Model):
         unique_together = (("order", "category"),)
 
     def __unicode__(self):
-        return "%d x %s @ %s" % (self.amount, self.category, self.order.encrypted_pk)
+        return "%d x %s @ order %d" % (self.amount, self.category, self.order_id)
+
+class TicketManager(models.Manager):
+
+    def lock_unsold(self, category, amount):
+        """
+        Lock unsold tickets of a category and return their PKs.
+
+        Call inside a transaction. At most `amount` tickets are locked, the
+        ones expiring first. On PostgreSQL, tickets locked by concurrent
+        payers are skipped. SQLite does not support row locks but it
+        serializes the writing transactions.
+        """
+        tickets = self.filter(category=category,
+                              paidticket=None).order_by('expires', 'pk')
+        tickets = tickets.values_list('pk', flat=True)[:amount]
+        db_connection = connections[self.db]
+        if db_connection.vendor == 'postgresql':
+            # Lock only the ticket rows, not the outer joined paid tickets
+            (sql, params) = tickets.query.sql_with_params()
+            sql += (" FOR UPDATE OF %s SKIP LOCKED"
+                    % db_connection.ops.quote_name(self.model._meta.db_table))
+            cursor = db_connection.cursor()
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+        return list(tickets.select_for_update())
 
 class Ticket(models.Model):
     """
@@ -289,8 +481,12 @@ class Ticket(models.Model):
     """ Last valid day of the ticket """
     expires = models.DateField()
 
+    objects = TicketManager()
+
     class Meta:
         unique_together = (("number", "category"),)
+        # Unsold tickets of a category in the order of expiration
+        index_together = (("category", "expires"),)
 
     def __unicode__(self):
         return "%s %s (%s)" % (self.category, self.number, self.expires)
@@ -311,10 +507,48 @@ class OrderStatus(models.Model):
     """ Current status of the order """
     status = models.CharField(max_length=1,
                               choices=STATUS_CHOICES)
+
+    class Meta:
+        # Orders of a status by date
+        index_together = (("status", "date"),)
     
     def __unicode__(self):
         return "%s" % (self.get_status_display())
     
+class PaidTicketManager(models.Manager):
+
+    """ How many times to retry if concurrent payers took the same tickets """
+    ALLOCATION_ATTEMPTS = 3
+
+    def allocate(self, orderstatus, category, amount):
+        """
+        Give `amount` unsold tickets of a category to a paid order.
+
+        Call inside a transaction.
+        """
+        for attempt in range(self.ALLOCATION_ATTEMPTS):
+            ticket_pks = Ticket.objects.lock_unsold(category, amount)
+            if len(ticket_pks) < amount:
+                # This should not happen: A customer has paid for more
+                # tickets than we have available. If this ever
+                # happens, it means there's a bug in this system.
+                raise Exception("Serious bug in the system. Not enough tickets available.")
+            try:
+                with transaction.atomic():
+                    return self.bulk_create([
+                        PaidTicket(ticket_id=ticket_pk,
+                                   orderstatus=orderstatus)
+                        for ticket_pk in ticket_pks
+                    ])
+            except IntegrityError:
+                # This may happen extremely rarely: A concurrent payer
+                # committed some of the tickets after we filtered them
+                # but before we locked them. Just try again.
+                pass
+        # This should not happen: The system was not able to
+        # provide enough tickets for the customer.
+        raise Exception("Serious bug in the system. Not enough tickets given to the customer.")
+
 class PaidTicket(models.Model):
 
     """ Ticket that was bought """
@@ -324,6 +558,8 @@ class PaidTicket(models.Model):
     orderstatus = models.ForeignKey(OrderStatus)
     #transaction = models.ForeignKey(Transaction)
 
+    objects = PaidTicketManager()
+
     
 class Transaction(models.Model):
     """
@@ -357,3 +593,305 @@ class Transaction(models.Model):
     
     def __unicode__(self):
         return "%s" % (self.transaction_hash)
+
+
+class InventoryManager(models.Manager):
+    """
+    Manager for keeping the ticket counters of the categories up to date.
+
+    The counters are modified with single UPDATE statements using F()
+    expressions, thus they are atomic in the database. Call them in the same
+    transaction as the corresponding rows are written. Missing counters are
+    not created here but computed from scratch when they are needed.
+    """
+
+    def _add(self, category, **amounts):
+        updates = dict((field, F(field) + amount)
+                       for (field, amount) in amounts.items())
+        self.filter(category=category).update(**updates)
+        caching.bump_version('availability')
+
+    def availability(self):
+        """
+        Return a snapshot of the available amounts by category PK.
+
+        The snapshot is cached for a short time and invalidated whenever the
+        counters change. The invalidation happens before the transaction
+        commits, so a concurrent request may cache the old amounts until the
+        snapshot expires.
+        """
+        return caching.cached(
+            'availability',
+            settings.AVAILABILITY_CACHE_SECONDS,
+            lambda: dict((category, total - reserved - sold)
+                         for (category, total, reserved, sold)
+                         in self.values_list('category',
+                                             'total',
+                                             'reserved',
+                                             'sold')))
+
+    def add_tickets(self, category, amount):
+        self._add(category, total=amount)
+
+    def reserve(self, category, amount):
+        self._add(category, reserved=amount)
+
+    def try_reserve(self, category, amount):
+        """
+        Reserve tickets only if enough of them are available.
+
+        Returns True if the tickets were reserved.
+        """
+        reserved = self.filter(
+            category=category,
+            total__gte=F('reserved') + F('sold') + amount
+        ).update(reserved=F('reserved') + amount)
+        if reserved:
+            caching.bump_version('availability')
+        elif not self.filter(category=category).exists():
+            # The counters do not exist yet, compute them and try again
+            self.rebuild(category)
+            return self.try_reserve(category, amount)
+        return bool(reserved)
+
+    def release(self, category, amount):
+        self._add(category, reserved=-amount)
+
+    def sell(self, category, amount):
+        self._add(category, reserved=-amount, sold=amount)
+
+    def unsell(self, category, amount):
+        self._add(category, sold=-amount)
+
+    def count_tickets(self, category):
+        """
+        Compute the counters of a category from the tickets and the orders.
+
+        Returns a tuple (total, reserved, sold).
+        """
+        total = Ticket.objects.filter(category=category).count()
+        ordered_tickets = OrderedTickets.objects.filter(category=category)
+        reserved = ordered_tickets.filter(
+            order__state=Order.OPEN
+        ).aggregate(Sum('amount'))['amount__sum']
+        sold = ordered_tickets.filter(
+            order__state=Order.PAID
+        ).aggregate(Sum('amount'))['amount__sum']
+        # Use or to avoid None
+        return (total, reserved or 0, sold or 0)
+
+    def rebuild(self, category):
+        """
+        Recompute the counters of a category and return the inventory.
+        """
+        with transaction.atomic():
+            # Lock the counters (if they exist) while counting
+            list(self.select_for_update().filter(category=category))
+            (total, reserved, sold) = self.count_tickets(category)
+            (inventory, created) = self.update_or_create(
+                category_id=getattr(category, 'pk', category),
+                defaults={
+                    'total': total,
+                    'reserved': reserved,
+                    'sold': sold,
+                })
+        caching.bump_version('availability')
+        return inventory
+
+class Inventory(models.Model):
+    """
+    Maintained ticket counters of a category.
+
+    The amount of available tickets is a single primary key read instead of
+    aggregating over all tickets and orders. `rebuild_inventory` management
+    command checks and fixes the counters.
+    """
+
+    """ Category of the tickets """
+    category = models.OneToOneField(Category, primary_key=True)
+
+    """ Amount of tickets in stock, including the sold ones """
+    total = models.IntegerField(default=0)
+
+    """ Amount of tickets in open orders """
+    reserved = models.IntegerField(default=0)
+
+    """ Amount of tickets in paid orders """
+    sold = models.IntegerField(default=0)
+
+    objects = InventoryManager()
+
+    def available(self):
+        return self.total - self.reserved - self.sold
+
+    def __unicode__(self):
+        return "%s: %d/%d" % (self.category, self.available(), self.total)
+
+class PaymentAddress(models.Model):
+    """
+    A pre-generated bitcoin address for receiving a payment.
+
+    The address pool is filled in the background with the callbacks already
+    registered, and checkout claims an unused address for the order.
+    """
+
+    """ Address the customer pays to """
+    address = models.CharField(max_length=100, unique=True)
+
+    """ Random token identifying the address in the callback URL """
+    token = models.CharField(max_length=40, unique=True)
+
+    """ Timestamp of creating the address """
+    date = models.DateTimeField(auto_now_add=True)
+
+    """ The order using the address, if claimed """
+    order = models.OneToOneField(Order, null=True, blank=True)
+
+    """ Timestamp of claiming the address """
+    claimed = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return self.address
+
+class ExchangeRate(models.Model):
+    """
+    A quote of the EUR/BTC exchange rate.
+    """
+
+    """ Price of one bitcoin in euros """
+    rate = models.FloatField()
+
+    """ Provider of the quote """
+    provider = models.CharField(max_length=100)
+
+    """ Timestamp of fetching the quote """
+    date = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def age(self):
+        """
+        Age of the quote in seconds.
+        """
+        return (timezone.now() - self.date).total_seconds()
+
+    def __unicode__(self):
+        return "%s EUR/BTC (%s)" % (self.rate, self.date)
+
+class OutgoingEmailManager(models.Manager):
+
+    def create_email(self, template_name, context, recipients):
+        """
+        Render an email template to an unsaved outbox message.
+
+        The template has `subject` and `body` blocks. EMAIL_ADDRESS is added
+        to the context and used as the sender.
+        """
+        context = dict(context, EMAIL_ADDRESS=settings.EMAIL_ADDRESS)
+        context = Context(context, autoescape=False)
+        template = get_template(template_name)
+        blocks = dict((node.name, node)
+                      for node in template.nodelist.get_nodes_by_type(BlockNode))
+        subject = ' '.join(blocks['subject'].render(context).split())
+        body = blocks['body'].render(context).strip() + '\n'
+        return self.model(from_email=settings.EMAIL_ADDRESS,
+                          recipients=','.join(recipients),
+                          subject=subject,
+                          body=body)
+
+    def enqueue(self, template_name, context, recipients):
+        """
+        Put an email to the outbox. `send_queued_mail` sends it.
+        """
+        email = self.create_email(template_name, context, recipients)
+        email.save()
+        return email
+
+    def pending(self, now=None):
+        """
+        Emails that should be sent now.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(sent=None,
+                           failed=False,
+                           next_attempt__lte=now).order_by('next_attempt')
+
+class OutgoingEmail(models.Model):
+    """
+    An email in the outbox.
+
+    Requests only put emails to the outbox and separate worker processes
+    send them, so the response time does not depend on the mail server.
+    """
+
+    """ Timestamp of queuing the email """
+    date = models.DateTimeField(auto_now_add=True)
+
+    """ Sender address """
+    from_email = models.CharField(max_length=254)
+
+    """ Comma separated recipient addresses """
+    recipients = models.TextField()
+
+    subject = models.CharField(max_length=255)
+
+    body = models.TextField()
+
+    """ Time when the email should be sent next """
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+
+    """ Number of failed sending attempts """
+    attempts = models.PositiveIntegerField(default=0)
+
+    """ Timestamp of sending the email, if sent """
+    sent = models.DateTimeField(null=True, blank=True)
+
+    """ Whether sending the email has been given up """
+    failed = models.BooleanField(default=False)
+
+    """ Error of the latest failed attempt """
+    last_error = models.TextField(blank=True)
+
+    objects = OutgoingEmailManager()
+
+    def message(self):
+        return EmailMessage(subject=self.subject,
+                            body=self.body,
+                            from_email=self.from_email,
+                            to=self.recipients.split(','))
+
+    def __unicode__(self):
+        return "%s: %s" % (self.recipients, self.subject)
+
+# Signals for keeping the inventory counters in sync
+
+@receiver(post_save, sender=Category)
+def create_inventory(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Inventory.objects.get_or_create(category=instance)
+
+@receiver(post_save, sender=Ticket)
+def add_ticket(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Inventory.objects.add_tickets(instance.category_id, 1)
+
+@receiver(post_delete, sender=Ticket)
+def remove_ticket(sender, instance, **kwargs):
+    Inventory.objects.add_tickets(instance.category_id, -1)
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Ticket)
+@receiver(post_delete, sender=Ticket)
+def invalidate_categories(sender, **kwargs):
+    caching.bump_version('categories')
+
+@receiver(pre_delete, sender=Order)
+def remove_order(sender, instance, **kwargs):
+    # Deleting an open or paid order frees its tickets
+    for ordered_tickets in instance.orderedtickets_set.all():
+        if instance.state == Order.OPEN:
+            Inventory.objects.release(ordered_tickets.category_id,
+                                      ordered_tickets.amount)
+        elif instance.state == Order.PAID:
+            Inventory.objects.unsell(ordered_tickets.category_id,
+                                     ordered_tickets.amount)
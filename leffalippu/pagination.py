@@ -0,0 +1,65 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Keyset pagination.
+
+Pages are selected with a condition on the last seen PK instead of an
+offset, so each page is an index range scan no matter how deep it is.
+"""
+
+def parse_after(value):
+    """
+    Parse the last seen PK from a request parameter, None if invalid.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def keyset_page(queryset, after=None, size=50):
+    """
+    Return a page of objects newest first and the PK to continue after.
+
+    The continuation PK is None on the last page.
+    """
+    if after is not None:
+        queryset = queryset.filter(pk__lt=after)
+    objects = list(queryset.order_by('-pk')[:size + 1])
+    if len(objects) > size:
+        return (objects[:size], objects[size - 1].pk)
+    return (objects, None)
+
+def keyset_chunks(queryset, fields, chunk_size=1000):
+    """
+    Generate the values of the fields for all rows in the order of PK.
+
+    The rows are fetched in chunks of `pk > last seen pk` queries, so only
+    one chunk is in memory at a time and no query runs for long. Each
+    generated tuple starts with the PK.
+    """
+    queryset = queryset.order_by('pk').values_list('pk', *fields)
+    after = None
+    while True:
+        chunk = queryset
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        after = rows[-1][0]
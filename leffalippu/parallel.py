@@ -0,0 +1,107 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Running slow lookups concurrently.
+
+The WSGI workers are synchronous, so the external calls of a request can't
+be awaited. Instead, independent calls are run in background threads and
+the request waits only for the slowest of them, at most until a deadline.
+"""
+
+import logging
+import threading
+import time
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+class Task(threading.Thread):
+    """
+    A function call in a background thread.
+
+    If the caller stops waiting before the call returns, the result is
+    passed to `late` function (if given) in the background thread, so that
+    it isn't wasted.
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fn = fn
+        self.args = args
+        self.late = kwargs.pop('late', None)
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.done = False
+        self.abandoned = False
+
+    def run(self):
+        try:
+            try:
+                result = self.fn(*self.args, **self.kwargs)
+            except Exception as e:
+                logger.warning("Background call %s failed: %s",
+                               self.fn.__name__, e)
+                with self.lock:
+                    self.error = e
+                    self.done = True
+                return
+            with self.lock:
+                self.result = result
+                self.done = True
+                late = self.late if self.abandoned else None
+            if late is not None:
+                late(result)
+        except Exception:
+            logger.exception("Handling the late result of %s failed",
+                             self.fn.__name__)
+        finally:
+            # The thread may have used the database
+            connection.close()
+
+    def abandon(self):
+        """
+        Stop waiting for the result. Returns False if it is already there.
+        """
+        with self.lock:
+            if self.done:
+                return False
+            self.abandoned = True
+            return True
+
+def run_all(tasks, timeout):
+    """
+    Start the tasks and wait at most `timeout` seconds for all of them.
+
+    Returns the results in the same order. The result of a failed or
+    unfinished task is None.
+    """
+    deadline = time.time() + timeout
+    for task in tasks:
+        task.start()
+    results = []
+    for task in tasks:
+        task.join(max(deadline - time.time(), 0))
+        if task.is_alive() and task.abandon():
+            logger.warning("Background call %s timed out",
+                           task.fn.__name__)
+            results.append(None)
+        else:
+            results.append(task.result)
+    return results
@@ -0,0 +1,232 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Query plans of the hot lookups.
+
+`sequential_scans` runs EXPLAIN on the querysets of `hot_querysets` and
+reports the tables that are read with a full table scan instead of an
+index. The tests run it on seeded tables, so a missing or unusable index
+shows up as a test failure.
+
+`compare_open_orders` compares the plans and the timings of the open order
+lookups written with the anti-join on OrderStatus (the way they were before
+Order.state) and with the state column, see `compare_order_plans`
+management command.
+"""
+
+import datetime
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from leffalippu.models import (Category, Ticket, Order, OrderStatus,
+                               OrderedTickets, Transaction, PaymentAddress)
+from leffalippu import expiration
+from leffalippu import bitcoin
+
+def hot_querysets():
+    """
+    Return the hot lookups of the application by name.
+
+    The querysets use the first rows of the tables as parameters, so seed the
+    tables before calling.
+    """
+    category = Category.objects.order_by('pk')[0]
+    order = Order.objects.order_by('pk')[0]
+    since = timezone.now() - datetime.timedelta(hours=1)
+    return {
+        'unsold tickets': Ticket.objects.filter(
+            category=category,
+            paidticket=None).order_by('expires', 'pk'),
+        'expired orders': expiration.expired_orders(),
+        'paid orders': bitcoin.paid_orders().order_by('date'),
+        'orders by status': Order.objects.filter(
+            orderstatus__status=OrderStatus.PAID,
+            orderstatus__date__gte=since),
+        'transactions of order': Transaction.objects.filter(order=order),
+        'payment address': PaymentAddress.objects.filter(token='token'),
+    }
+
+def explain(queryset):
+    """
+    Return the query plan of a queryset as a list of lines.
+    """
+    connection = connections[queryset.db]
+    (sql, params) = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        sql = "EXPLAIN QUERY PLAN " + sql
+        column = 3
+    else:
+        sql = "EXPLAIN " + sql
+        column = 0
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [row[column] for row in cursor.fetchall()]
+
+def scanned_tables(plan, vendor):
+    """
+    Return the tables that a query plan reads with a full table scan.
+    """
+    tables = []
+    for line in plan:
+        words = line.split()
+        if vendor == 'sqlite':
+            # For instance, "SCAN TABLE leffalippu_order" (older SQLite) or
+            # "SCAN leffalippu_order", but not "SCAN leffalippu_order USING
+            # INDEX ..."
+            if words[:1] == ['SCAN'] and 'USING' not in words:
+                words = [word for word in words[1:] if word != 'TABLE']
+                tables.append(words[0])
+        elif 'Seq Scan on' in line:
+            tables.append(line.split('Seq Scan on')[1].split()[0])
+    return tables
+
+def analyze(using='default'):
+    """
+    Update the planner statistics, for instance, after seeding the tables.
+    """
+    connections[using].cursor().execute("ANALYZE")
+
+def sequential_scans(querysets=None, ignore=()):
+    """
+    Return the hot lookups that read a table with a full table scan.
+
+    The result maps the names of the lookups to the lists of scanned
+    tables. Tables in `ignore` are allowed to be scanned, for instance,
+    small lookup tables.
+    """
+    if querysets is None:
+        querysets = hot_querysets()
+    result = {}
+    for (name, queryset) in querysets.items():
+        vendor = connections[queryset.db].vendor
+        tables = [table
+                  for table in scanned_tables(explain(queryset), vendor)
+                  if table not in ignore]
+        if tables:
+            result[name] = tables
+    return result
+
+def open_order_querysets(legacy=False):
+    """
+    Return the open order lookups by name.
+
+    If `legacy` is True, the orders are open if they have no OrderStatus,
+    otherwise the state column is used. Seed the tables before calling.
+    """
+    category = Category.objects.order_by('pk')[0]
+    latest_date = timezone.now() - datetime.timedelta(
+        minutes=settings.EXPIRATION_MINUTES)
+    earliest_date = latest_date - datetime.timedelta(
+        hours=settings.EXPIRATION_LOOKBACK_HOURS)
+    if legacy:
+        (open_orders, open_tickets) = ({'orderstatus': None},
+                                       {'order__orderstatus': None})
+    else:
+        (open_orders, open_tickets) = ({'state': Order.OPEN},
+                                       {'order__state': Order.OPEN})
+    orders = Order.objects.filter(**open_orders)
+    return {
+        'open orders': orders.order_by('date'),
+        'expired orders': orders.filter(
+            date__lt=latest_date,
+            date__gte=earliest_date).order_by('date'),
+        'paid orders': orders.filter(
+            price_satoshi__gt=0,
+            amount_paid__gte=F('price_satoshi')).order_by('date'),
+        'reserved tickets': OrderedTickets.objects.filter(
+            category=category,
+            **open_tickets),
+    }
+
+def best_time(queryset, repeat=5):
+    """
+    Return the shortest time in seconds of fetching the primary keys of a
+    queryset.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        list(queryset.values_list('pk', flat=True))
+        times.append(time.time() - start)
+    return min(times)
+
+def compare_open_orders(repeat=5):
+    """
+    Compare the open order lookups with and without the state column.
+
+    Returns a list of tuples (name, anti-join plan, state plan, anti-join
+    seconds, state seconds).
+    """
+    legacy = open_order_querysets(legacy=True)
+    current = open_order_querysets()
+    return [(name,
+             explain(legacy[name]),
+             explain(current[name]),
+             best_time(legacy[name], repeat),
+             best_time(current[name], repeat))
+            for name in sorted(current)]
+
+def seed(orders=100000, open_every=50, days=30, batch_size=5000):
+    """
+    Seed a large order history for comparing the query plans.
+
+    The orders are spread evenly over the last `days` days and every
+    `open_every`:th order is open. Half of the others are paid and the rest
+    are cancelled or expired. Each order has one ticket of one of three
+    categories.
+    """
+    categories = [Category.objects.create(name='Plans %d' % i,
+                                          description='Plans %d' % i,
+                                          price=700)
+                  for i in range(3)]
+    now = timezone.now()
+    step = datetime.timedelta(days=days) / orders
+    closed = (OrderStatus.PAID, OrderStatus.CANCELLED,
+              OrderStatus.PAID, OrderStatus.EXPIRED)
+    for offset in range(0, orders, batch_size):
+        numbers = range(offset, min(offset + batch_size, orders))
+        states = [Order.OPEN if i % open_every == 0 else
+                  closed[i % len(closed)]
+                  for i in numbers]
+        with transaction.atomic():
+            Order.objects.bulk_create(
+                Order(email='plans%d@example.com' % i,
+                      public_address='plans-%d' % i,
+                      price_satoshi=100,
+                      state=state)
+                for (i, state) in zip(numbers, states))
+            first = Order.objects.get(public_address='plans-%d' % offset).pk
+            pks = list(Order.objects.filter(pk__gte=first).order_by(
+                'pk').values_list('pk', flat=True))
+            # The dates are set to now on insert, so spread them in groups
+            for start in range(0, len(pks), 100):
+                Order.objects.filter(pk__in=pks[start:start + 100]).update(
+                    date=now - (orders - offset - start) * step)
+            OrderStatus.objects.bulk_create(
+                OrderStatus(order_id=pk, status=state)
+                for (pk, state) in zip(pks, states)
+                if state != Order.OPEN)
+            OrderedTickets.objects.bulk_create(
+                OrderedTickets(order_id=pk,
+                               category=categories[i % len(categories)],
+                               amount=1,
+                               price=700)
+                for (i, pk) in zip(numbers, pks))
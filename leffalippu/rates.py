@@ -0,0 +1,176 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+EUR/BTC exchange rate service.
+
+The rate is refreshed in the background from the providers listed in
+EXCHANGE_RATE_PROVIDERS and the latest good quote is stored in the
+database. Conversions are served from memory and refused only if the
+latest quote is older than EXCHANGE_RATE_MAX_AGE.
+"""
+
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from leffalippu.models import ExchangeRate
+from leffalippu import caching
+from leffalippu import httpclient
+
+logger = logging.getLogger(__name__)
+
+""" How often the in-memory quote is compared to the database (seconds) """
+RELOAD_SECONDS = 10
+
+class StaleRate(Exception):
+    """
+    No recent enough exchange rate is available.
+    """
+    pass
+
+def parse_mtgox(ticker_json):
+    """
+    Parse EUR/BTC rate from mtgox.com ticker
+    """
+    if ticker_json['result'] != 'success':
+        raise Exception("Failed to get conversion rate from MtGox")
+    return float(ticker_json['return']['buy']['value'])
+
+def parse_blockchain(ticker_json):
+    """
+    Parse EUR/BTC rate from blockchain.info ticker
+    """
+    return float(ticker_json['EUR']['buy'])
+
+def fetch_json(url):
+    """
+    Get JSON response from a ticker URL and return it as a nested
+    dictionary.
+    """
+    return httpclient.get_json('exchange_rate', url)
+
+# The latest quote and the time it was read from the database
+_latest = (None, 0)
+
+def set_quote(quote):
+    global _latest
+    _latest = (quote, time.time())
+
+def forget_quote():
+    """
+    Make the next lookup read the quote from the database.
+    """
+    global _latest
+    _latest = (None, 0)
+    caching.bump_version('exchange_rate')
+
+def load_quote():
+    try:
+        return ExchangeRate.objects.latest('date')
+    except ExchangeRate.DoesNotExist:
+        return None
+
+def get_quote():
+    """
+    Return the latest quote or None.
+
+    The quote is kept in memory and reloaded only every RELOAD_SECONDS,
+    because the refreshing may happen in another process. The reload goes
+    through the shared cache, so the workers don't all query the database
+    at the same time.
+    """
+    (quote, loaded) = _latest
+    if time.time() - loaded > RELOAD_SECONDS:
+        quote = caching.cached('exchange_rate', RELOAD_SECONDS, load_quote)
+        set_quote(quote)
+    return quote
+
+def get_rate():
+    """
+    Return the price of one bitcoin in euros.
+
+    Raises StaleRate if there is no recent enough quote.
+    """
+    quote = get_quote()
+    if quote is None or quote.age() > settings.EXCHANGE_RATE_MAX_AGE:
+        raise StaleRate("No recent EUR/BTC exchange rate available")
+    return quote.rate
+
+def fetch_rate():
+    """
+    Fetch the rate from the first working provider without storing it.
+
+    Returns a tuple (rate, provider URL), or None if all providers failed.
+    """
+    for (parser, url) in settings.EXCHANGE_RATE_PROVIDERS:
+        try:
+            return (import_string(parser)(fetch_json(url)), url)
+        except Exception as e:
+            logger.warning("Exchange rate provider %s failed: %s", url, e)
+    logger.error("All exchange rate providers failed")
+    return None
+
+def store_rate(rate, provider):
+    """
+    Store a fetched rate as the latest quote and return the quote.
+
+    The quotes older than EXCHANGE_RATE_MAX_AGE can't be used anymore, so
+    they are deleted to keep the table small.
+    """
+    quote = ExchangeRate.objects.create(rate=rate, provider=provider)
+    ExchangeRate.objects.filter(
+        date__lt=quote.date - datetime.timedelta(
+            seconds=settings.EXCHANGE_RATE_MAX_AGE)
+    ).delete()
+    set_quote(quote)
+    caching.bump_version('exchange_rate')
+    return quote
+
+def refresh():
+    """
+    Fetch a new quote from the first working provider and store it.
+
+    Returns the new quote, or None if all providers failed.
+    """
+    fetched = fetch_rate()
+    if fetched is None:
+        return None
+    return store_rate(*fetched)
+
+def start_refresher(interval=None):
+    """
+    Refresh the rate periodically in a background thread of this process.
+    """
+    if interval is None:
+        interval = settings.EXCHANGE_RATE_REFRESH_SECONDS
+
+    def run():
+        while True:
+            try:
+                refresh()
+            except Exception:
+                logger.exception("Refreshing the exchange rate failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
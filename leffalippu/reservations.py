@@ -0,0 +1,85 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Reserving tickets for orders.
+"""
+
+from django.db import transaction
+from django.db.models import F
+
+from leffalippu.models import Inventory, Order, OrderedTickets
+
+class ReservationResult(object):
+    """
+    Result of a reservation attempt.
+
+    The result is true if the tickets were reserved. Otherwise, `shortages`
+    maps the categories which did not have enough tickets to the amounts
+    that were available.
+    """
+
+    def __init__(self, order, shortages):
+        self.order = order
+        self.shortages = shortages
+
+    def __nonzero__(self):
+        return not self.shortages
+
+    __bool__ = __nonzero__
+
+def reserve_tickets(order, amounts):
+    """
+    Reserve tickets for an order.
+
+    `amounts` maps categories to the requested amounts. In one transaction,
+    the inventory counters of the categories are decremented with
+    conditional updates, the order is saved (with its total price) if it
+    hasn't been saved yet and the ordered tickets are inserted. If any of the
+    categories doesn't have enough tickets available, nothing is written.
+    """
+    amounts = dict((category, amount)
+                   for (category, amount) in amounts.items()
+                   if amount > 0)
+    shortages = {}
+    with transaction.atomic():
+        # Update the counters in a fixed order to avoid deadlocks between
+        # concurrent orders
+        for category in sorted(amounts, key=lambda category: category.pk):
+            if not Inventory.objects.try_reserve(category, amounts[category]):
+                shortages[category] = category.amount_available()
+
+        if shortages:
+            transaction.set_rollback(True)
+            return ReservationResult(order, shortages)
+
+        total = sum(amount * category.price
+                    for (category, amount) in amounts.items())
+        if order.pk is None:
+            order.total_cents = total
+            order.save()
+        else:
+            Order.objects.filter(pk=order.pk).update(
+                total_cents=F('total_cents') + total)
+            order.total_cents += total
+        OrderedTickets.objects.bulk_create([
+            OrderedTickets(order=order,
+                           category=category,
+                           amount=amount,
+                           price=category.price)
+            for (category, amount) in amounts.items()
+        ])
+    return ReservationResult(order, shortages)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 gettext_noop = lambda s: s
 
@@ -47,6 +48,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'leffalippu.middleware.PerformanceMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -79,6 +81,22 @@ TEMPLATE_DIRS = (
 
 # Database
 
+# DATABASES are set in the local settings. On PostgreSQL, connecting costs
+# about as much as serving a page, so reuse the connections between requests
+# by setting ENGINE to 'leffalippu.backends.postgresql_pool'. Each worker
+# process then keeps a pool of connections which is configured by POOL in
+# the database settings, for instance:
+#
+#     'POOL': {
+#         'MAX_SIZE': 10,       # open connections (0 disables pooling)
+#         'IDLE_SECONDS': 300,  # idle connections are closed after this
+#         'CHECK_SECONDS': 30,  # longer idle connections are checked first
+#         'TIMEOUT': 10,        # wait this long when all are in use
+#     },
+#
+# Keep CONN_MAX_AGE at 0, so that the connections are returned to the pool
+# at the end of each request. See leffalippu/dbpool.py.
+
 # Internationalization
 LANGUAGE_CODE = 'fi'
 LANGUAGES = (
@@ -110,6 +128,152 @@ STATICFILES_FINDERS = (
     'django.contrib.staticfiles.finders.AppDirectoriesFinder',
 )
 
+# Bitcoin payments. Overwrite these in the local settings.
+
+BITCOIN_ADDRESS = 'OVERWRITE_THIS'
+# Fee of the payment service in percents
+BITCOIN_FEE = 0.6
+CALLBACK_SECRET = 'OVERWRITE_THIS_AND_KEEP_SECRET'
+# Base URL for the payment callbacks, for instance, to use SSL
+CALLBACK_BASEURL = 'https://leffalippu.fi'
+# Receive API for creating the payment addresses
+BLOCKCHAIN_RECEIVE_URL = 'https://blockchain.info/api/receive'
+# Read timeout of the receive API (in seconds)
+BLOCKCHAIN_RECEIVE_TIMEOUT = 10
+# If the address pool is empty or the exchange rate is stale at checkout,
+# the receive API and the rate providers are called concurrently in
+# background threads. The checkout waits at most CHECKOUT_LOOKUP_TIMEOUT
+# seconds for them. Set CHECKOUT_PARALLEL_LOOKUPS to False to call them one
+# after another in the request thread.
+CHECKOUT_PARALLEL_LOOKUPS = True
+CHECKOUT_LOOKUP_TIMEOUT = 10
+
+# Payment addresses are created in advance by `manage.py fill_address_pool
+# --loop`, which keeps ADDRESS_POOL_SIZE unused addresses available. An
+# error is logged when fewer than ADDRESS_POOL_LOW_WATERMARK are left. Both
+# numbers are exported in /metrics for alerting.
+ADDRESS_POOL_SIZE = 100
+ADDRESS_POOL_LOW_WATERMARK = 20
+ADDRESS_POOL_REFILL_SECONDS = 30
+
+# Exchange rates are refreshed in the background by `manage.py
+# refresh_rates --loop`. The providers are tried in order. Each provider is
+# a tuple of a parser function path and a ticker URL.
+EXCHANGE_RATE_PROVIDERS = (
+    ('leffalippu.rates.parse_mtgox',
+     'https://data.mtgox.com/api/1/BTCEUR/ticker'),
+    ('leffalippu.rates.parse_blockchain',
+     'https://blockchain.info/ticker'),
+)
+# Read timeout of a ticker request in seconds
+EXCHANGE_RATE_TIMEOUT = 5
+# Seconds between refreshing the rate
+EXCHANGE_RATE_REFRESH_SECONDS = 60
+# Orders are refused if the latest rate is older than this (in seconds)
+EXCHANGE_RATE_MAX_AGE = 600
+
+# Email
+
+EMAIL_ADDRESS = 'info@leffalippu.fi'
+
+# Emails are put to an outbox and sent by `manage.py send_queued_mail`
+# using EMAIL_BACKEND. Failed emails are retried with exponential backoff
+# starting from OUTBOX_RETRY_SECONDS until OUTBOX_MAX_ATTEMPTS attempts
+# have failed.
+OUTBOX_RETRY_SECONDS = 60
+OUTBOX_MAX_ATTEMPTS = 8
+
+# Outbound HTTP requests
+
+# The provider requests go through leffalippu.httpclient. The options of
+# each endpoint override leffalippu.httpclient.DEFAULTS:
+#
+#     CONNECT_TIMEOUT    seconds to wait for the connection
+#     READ_TIMEOUT       seconds to wait for the response
+#     RETRIES            retries of a failed request
+#     BACKOFF            base of the jittered exponential backoff (seconds)
+#     FAILURE_THRESHOLD  consecutive failures after which the host is
+#                        considered down and its requests fail immediately
+#     RESET_SECONDS      interval of probing a host that is down
+#     PROBE_URL          URL of probing (the root of the host if None)
+HTTP_ENDPOINTS = {
+    # Creating an address is not idempotent, so don't retry it
+    'blockchain_receive': {
+        'READ_TIMEOUT': BLOCKCHAIN_RECEIVE_TIMEOUT,
+        'RETRIES': 0,
+    },
+    'exchange_rate': {
+        'READ_TIMEOUT': EXCHANGE_RATE_TIMEOUT,
+    },
+}
+
+# Orders
+
+# Open orders expire after this time
+EXPIRATION_MINUTES = 15
+# Expiration looks for open orders placed at most this long before the
+# expiration time. Older orders are expected to be handled by earlier runs.
+EXPIRATION_LOOKBACK_HOURS = 24
+# Reservation attempts allowed per client IP address and per customer email
+# address, as (attempts, seconds). Attempts over the limit get "429 Too Many
+# Requests" before the form is validated. None disables the limit.
+ORDER_RATE_PER_IP = (20, 3600)
+ORDER_RATE_PER_EMAIL = (10, 3600)
+# Customers can't place orders while they have this many unpaid orders
+MAX_OPEN_ORDERS_PER_EMAIL = 1
+# Key of the public order tokens (SECRET_KEY is used if None). Changing the
+# key affects only new orders, the tokens of old orders are stored.
+ORDER_TOKEN_KEY = None
+
+# Waiting room
+
+# At most this many checkouts are processed at a time. The other customers
+# wait in a queue and are admitted in order as the checkouts finish. None
+# disables the queue. The queue is kept in the default cache, which must be
+# shared by all the workers (a local memory cache is refused), see
+# leffalippu/waitingroom.py.
+WAITING_ROOM_SLOTS = None
+# A slot is taken for at most two periods of this length (in seconds) if the
+# customer never comes back, and an admission expires after the next period
+WAITING_ROOM_LEASE_SECONDS = 60
+# The queue positions are valid this long (in seconds)
+WAITING_ROOM_TOKEN_SECONDS = 60 * 60
+# The waiting page checks its position this often (in seconds)
+WAITING_ROOM_POLL_SECONDS = 2
+
+# Caching
+
+# The default cache is a directory shared by the worker processes of one
+# host. When running on several hosts, use a cache server instead, for
+# instance, django.core.cache.backends.memcached.MemcachedCache.
+CACHES = {
+    'default': {
+        'BACKEND': 'leffalippu.cache_backends.SharedFileCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'leffalippu-cache'),
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# The cached category list is invalidated when categories or tickets change
+CATEGORY_CACHE_SECONDS = 24 * 60 * 60
+# The available amounts shown on the order page may be this old (in seconds)
+AVAILABILITY_CACHE_SECONDS = 5
+# The terms of service page is cached this long (in seconds)
+TERMS_CACHE_SECONDS = 60 * 60
+
+# Monitoring
+
+# Requests slower than this (in seconds) are written with their queries to
+# SLOW_REQUEST_LOG file (disabled if None)
+SLOW_REQUEST_SECONDS = 1.0
+SLOW_REQUEST_LOG = None
+# The Prometheus metrics at /metrics/ are served only to these addresses.
+# The metrics are collected by each worker process separately.
+METRICS_ALLOWED_IPS = ('127.0.0.1',)
+
 # Logging
 
 LOGGING = {
@@ -152,6 +316,12 @@ LOGGING = {
             'handlers': ['null'],
             'level': 'DEBUG',
         },
+        # One JSON line per request from PerformanceMiddleware
+        'leffalippu.performance': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'py.warnings': {
             'handlers': ['null'],
             'level': 'WARNING',
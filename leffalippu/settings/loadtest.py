@@ -0,0 +1,62 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Settings for `loadtest` management command.
+
+The database is chosen with LEFFALIPPU_LOADTEST_DB environment variable:
+`sqlite` (default) or `postgresql`. PostgreSQL connection is configured
+with the standard PGDATABASE, PGUSER, PGPASSWORD, PGHOST and PGPORT
+variables. The database backends pool the connections, LEFFALIPPU_LOADTEST_POOL
+sets the pool size (0 disables pooling).
+"""
+
+from leffalippu.settings.default import *
+
+SECRET_KEY = 'loadtest'
+CALLBACK_SECRET = 'loadtest'
+
+POOL = {
+    'MAX_SIZE': int(os.environ.get('LEFFALIPPU_LOADTEST_POOL', '20')),
+}
+
+if os.environ.get('LEFFALIPPU_LOADTEST_DB', 'sqlite') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'leffalippu.backends.postgresql_pool',
+            'NAME': os.environ.get('PGDATABASE', 'leffalippu'),
+            'USER': os.environ.get('PGUSER', ''),
+            'PASSWORD': os.environ.get('PGPASSWORD', ''),
+            'HOST': os.environ.get('PGHOST', 'localhost'),
+            'PORT': os.environ.get('PGPORT', ''),
+            'POOL': POOL,
+        }
+    }
+else:
+    # The test database must be a file so that the buyer threads share it
+    TMP_PATH = tempfile.gettempdir()
+    DATABASES = {
+        'default': {
+            'ENGINE': 'leffalippu.backends.sqlite3_pool',
+            'NAME': os.path.join(TMP_PATH, 'loadtest.sqlite3'),
+            'POOL': POOL,
+            'TEST': {
+                'NAME': os.path.join(TMP_PATH, 'test_loadtest.sqlite3'),
+            },
+        }
+    }
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
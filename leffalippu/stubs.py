@@ -0,0 +1,226 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Local stand-ins for the external services, for testing and benchmarking
+offline.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import urlparse
+
+import simplejson
+
+class FakeMTAHandler(SocketServer.StreamRequestHandler):
+    """
+    Minimal SMTP session: accepts every message and stores it.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost fake MTA')
+        (sender, recipients) = (None, [])
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip()[:4].upper()
+            if command in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                sender = line.strip()[10:]
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.strip()[8:])
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in ('.\r\n', '.\n'):
+                        break
+                    data.append(line)
+                time.sleep(self.server.delay)
+                self.server.messages.append((sender, recipients, ''.join(data)))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                # RSET, NOOP etc.
+                self.reply('250 OK')
+
+class FakeMTA(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    SMTP server which accepts all messages and keeps them in memory.
+
+    `delay` seconds are spent on each message to simulate a slow mail
+    server. Use port 0 to pick a free port.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0):
+        SocketServer.TCPServer.__init__(self, (host, port), FakeMTAHandler)
+        self.delay = delay
+        self.messages = []
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeJSONHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep the connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        time.sleep(self.server.delay)
+        (path, _, query) = self.path.partition('?')
+        route = self.server.routes.get(path)
+        if self.server.fail or route is None:
+            self.send_error(500 if route else 404)
+            return
+        body = simplejson.dumps(route(urlparse.parse_qs(query)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeJSONServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server answering GET requests with JSON.
+
+    `routes` maps paths to functions which get the parsed query string and
+    return the response data. Each request takes `delay` seconds and all
+    requests fail if `fail` is set. The connections are kept alive and
+    counted in `connections`. Use port 0 to pick a free port.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeJSONHandler)
+        self.delay = delay
+        self.fail = False
+        self.requests = []
+        self.connections = 0
+        self.routes = {}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.port, path)
+
+    def handle_error(self, request, client_address):
+        # Clients timing out close their connections early
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeTicker(FakeJSONServer):
+    """
+    Exchange rate provider serving the MtGox ticker at /mtgox and the
+    blockchain.info ticker at /blockchain.
+    """
+
+    def __init__(self, rate=100.0, **kwargs):
+        FakeJSONServer.__init__(self, **kwargs)
+        self.rate = rate
+        self.routes['/mtgox'] = lambda query: {
+            'result': 'success',
+            'return': {'buy': {'value': '%f' % self.rate}},
+        }
+        self.routes['/blockchain'] = lambda query: {
+            'EUR': {'buy': self.rate},
+        }
+
+    def providers(self):
+        """
+        Value for EXCHANGE_RATE_PROVIDERS setting.
+        """
+        return (('leffalippu.rates.parse_mtgox', self.url('/mtgox')),
+                ('leffalippu.rates.parse_blockchain', self.url('/blockchain')))
+
+class FakeReceiveAPI(FakeJSONServer):
+    """
+    blockchain.info receive API at /api/receive creating fake addresses.
+
+    The registered callback URLs are kept in `callbacks`.
+    """
+
+    def __init__(self, **kwargs):
+        FakeJSONServer.__init__(self, **kwargs)
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.routes['/api/receive'] = self.create
+
+    def create(self, query):
+        with self.lock:
+            address = '1Fake%029d' % len(self.callbacks)
+            self.callbacks[address] = query['callback'][0]
+        return {
+            'input_address': address,
+            'destination': query['address'][0],
+            'fee_percent': 0,
+            'callback_url': query['callback'][0],
+        }
+
+    def receive_url(self):
+        """
+        Value for BLOCKCHAIN_RECEIVE_URL setting.
+        """
+        return self.url('/api/receive')
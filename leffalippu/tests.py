@@ -1,3 +1,5 @@
+# -*- encoding: utf-8 -*-
+
 """
 This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
@@ -5,7 +7,46 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import datetime
+import importlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+from unittest import skipIf
+
+import simplejson
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection, OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from leffalippu.models import *
+from leffalippu import reservations, expiration, mailqueue, rates, bitcoin
+from leffalippu import loadtest, queryplans, ticketimport, exports
+from leffalippu import caching, metrics, tokens, dbpool, parallel
+from leffalippu import httpclient, throttling, forms, waitingroom
+from leffalippu.backends.sqlite3_pool import base as sqlite3_pool
+from leffalippu.cache_backends import SharedFileCache, cache_stats
+from leffalippu.admin import OrderAdmin
+from leffalippu.stubs import FakeMTA, FakeTicker, FakeReceiveAPI
+
+# Keep the request log lines of PerformanceMiddleware out of the test output
+logging.getLogger('leffalippu.performance').setLevel(logging.WARNING)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +55,1604 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def create_category(name='BioRex', price=700, tickets=10):
+    category = Category.objects.create(name=name,
+                                       description=name,
+                                       price=price)
+    for i in range(tickets):
+        Ticket.objects.create(category=category,
+                              number='%s-%d' % (name, i),
+                              price=500,
+                              expires=datetime.date(2030, 1, 1))
+    return category
+
+def create_order(amounts, email='test@example.com'):
+    order = Order(email=email,
+                  public_address='addr-%s' % email,
+                  price_satoshi=0)
+    if not reservations.reserve_tickets(order, amounts):
+        raise Exception("Not enough tickets")
+    return order
+
+def in_memory_database():
+    """
+    Check whether the test database is in-memory SQLite which can't be shared
+    by threads.
+    """
+    return (connection.vendor == 'sqlite' and
+            connection.settings_dict['TEST'].get('NAME') in (None, '', ':memory:'))
+
+
+class InventoryTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category(tickets=10)
+
+    def test_tickets(self):
+        self.assertEqual(self.category.amount_available(), 10)
+        Ticket.objects.filter(category=self.category)[0].delete()
+        self.assertEqual(self.category.amount_available(), 9)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            self.category.amount_available()
+
+    def test_migration(self):
+        order = create_order({self.category: 2})
+        order.pay()
+        create_order({self.category: 3}, email='b@example.com')
+        Inventory.objects.all().delete()
+        migration = importlib.import_module(
+            'leffalippu.migrations.0006_inventory_counters')
+        migration.create_counters(apps, None)
+        inventory = Inventory.objects.get(category=self.category)
+        self.assertEqual((inventory.total, inventory.reserved, inventory.sold),
+                         (10, 3, 2))
+
+    def test_order_life_cycle(self):
+        cancelled = create_order({self.category: 2}, email='a@example.com')
+        expired = create_order({self.category: 3}, email='b@example.com')
+        paid = create_order({self.category: 4}, email='c@example.com')
+        self.assertEqual(self.category.amount_available(), 1)
+
+        self.assertTrue(cancelled.cancel())
+        self.assertFalse(cancelled.cancel())
+        self.assertEqual(self.category.amount_available(), 3)
+
+        self.assertTrue(expired.expire())
+        self.assertEqual(self.category.amount_available(), 6)
+
+        paid.pay()
+        inventory = Inventory.objects.get(category=self.category)
+        self.assertEqual((inventory.total, inventory.reserved, inventory.sold),
+                         (10, 0, 4))
+
+        paid.delete()
+        self.assertEqual(self.category.amount_available(), 10)
+
+    def test_rebuild(self):
+        create_order({self.category: 2})
+        Inventory.objects.filter(category=self.category).update(total=0,
+                                                                reserved=5)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_inventory', check=True, stdout=StringIO())
+        call_command('rebuild_inventory', stdout=StringIO())
+        call_command('rebuild_inventory', check=True, stdout=StringIO())
+        self.assertEqual(self.category.amount_available(), 8)
+
+        Inventory.objects.all().delete()
+        self.assertEqual(self.category.amount_available(), 8)
+
+
+class CategoryListTest(TestCase):
+
+    def test_with_amount_available(self):
+        biorex = create_category(name='BioRex', tickets=10)
+        finnkino = create_category(name='Finnkino', tickets=3)
+        create_order({finnkino: 1}, email='a@example.com').pay()
+        create_order({biorex: 5, finnkino: 1}, email='b@example.com')
+        with self.assertNumQueries(1):
+            amounts = dict(
+                (category.name, (category.amount_total,
+                                 category.amount_reserved,
+                                 category.amount_available))
+                for category in Category.objects.with_amount_available()
+            )
+        self.assertEqual(amounts, {'BioRex': (10, 5, 5),
+                                   'Finnkino': (3, 2, 1)})
+
+    def test_order_page_queries(self):
+        """
+        The number of queries of the order page does not depend on the number
+        of categories.
+        """
+        create_category(name='BioRex')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('order'))
+        self.assertContains(response, 'BioRex')
+        for i in range(5):
+            create_category(name='Finnkino %d' % i, tickets=2)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(reverse('order'))
+        self.assertContains(response, 'Finnkino 4')
+
+
+class PayTest(TestCase):
+
+    def test_pay(self):
+        biorex = create_category(name='BioRex', tickets=4)
+        finnkino = create_category(name='Finnkino', tickets=4)
+        order = create_order({biorex: 2, finnkino: 3})
+        order.pay()
+        self.assertEqual(order.orderstatus.status, OrderStatus.PAID)
+        self.assertEqual(Order.objects.get(pk=order.pk).state, Order.PAID)
+        self.assertEqual(
+            Ticket.objects.filter(paidticket__orderstatus__order=order,
+                                  category=biorex).count(),
+            2)
+        self.assertEqual(
+            Ticket.objects.filter(paidticket__orderstatus__order=order,
+                                  category=finnkino).count(),
+            3)
+        self.assertEqual(biorex.amount_available(), 2)
+        self.assertEqual(finnkino.amount_available(), 1)
+
+    def test_expiring_first(self):
+        category = create_category(tickets=0)
+        for (number, year) in (('late', 2031), ('early', 2029), ('middle', 2030)):
+            Ticket.objects.create(category=category,
+                                  number=number,
+                                  price=500,
+                                  expires=datetime.date(year, 1, 1))
+        order = create_order({category: 2})
+        order.pay()
+        self.assertEqual(
+            set(Ticket.objects.filter(paidticket__orderstatus__order=order)
+                .values_list('number', flat=True)),
+            set(['early', 'middle']))
+
+    def test_not_enough_tickets(self):
+        category = create_category(tickets=2)
+        order = create_order({category: 2})
+        Ticket.objects.filter(category=category)[0].delete()
+        self.assertRaises(Exception, order.pay)
+        self.assertFalse(OrderStatus.objects.filter(order=order).exists())
+        self.assertFalse(PaidTicket.objects.exists())
+
+
+@skipIf(in_memory_database(), "Threads can't share an in-memory database")
+class ConcurrentPayTest(TransactionTestCase):
+
+    def test_concurrent_pay(self):
+        category = create_category(tickets=40)
+        orders = [create_order({category: 1 + i % 2},
+                               email='%d@example.com' % i)
+                  for i in range(26)]
+        errors = []
+
+        def pay(order):
+            try:
+                order.pay()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=pay, args=(order,))
+                   for order in orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            OrderStatus.objects.filter(status=OrderStatus.PAID).count(),
+            26)
+        self.assertEqual(PaidTicket.objects.count(), 39)
+        self.assertEqual(
+            PaidTicket.objects.values('ticket').distinct().count(),
+            39)
+        inventory = Inventory.objects.get(category=category)
+        self.assertEqual((inventory.total, inventory.reserved, inventory.sold),
+                         (40, 0, 39))
+
+
+class ReservationTest(TestCase):
+
+    def setUp(self):
+        self.biorex = create_category(name='BioRex', tickets=5)
+        self.finnkino = create_category(name='Finnkino', tickets=2)
+
+    def test_reserve(self):
+        order = Order(email='test@example.com',
+                      public_address='address',
+                      price_satoshi=0)
+        # The token is set after inserting the order
+        with self.assertNumQueries(6):
+            result = reservations.reserve_tickets(order, {self.biorex: 3,
+                                                          self.finnkino: 0})
+        self.assertTrue(result)
+        self.assertEqual(result.shortages, {})
+        self.assertEqual(list(order.orderedtickets_set.values_list('category',
+                                                                   'amount',
+                                                                   'price')),
+                         [(self.biorex.pk, 3, 700)])
+        self.assertEqual(self.biorex.amount_available(), 2)
+        self.assertEqual(self.finnkino.amount_available(), 2)
+        self.assertEqual(Order.objects.get(pk=order.pk).total_cents, 3 * 700)
+
+    def test_order_totals(self):
+        order = create_order({self.biorex: 2, self.finnkino: 1})
+        self.assertEqual(order.price(), 3 * 700)
+        self.assertEqual(Order.objects.with_price().get(pk=order.pk).price_cents,
+                         3 * 700)
+        # Legacy orders without the stored total
+        Order.objects.filter(pk=order.pk).update(total_cents=0)
+        out = StringIO()
+        call_command('update_order_totals', stdout=out)
+        self.assertIn("1 orders updated", out.getvalue())
+        self.assertEqual(Order.objects.get(pk=order.pk).total_cents, 3 * 700)
+        self.assertEqual(Order.objects.update_totals(), 0)
+
+    def test_shortage(self):
+        create_order({self.biorex: 4}, email='first@example.com')
+        order = Order(email='second@example.com',
+                      public_address='address',
+                      price_satoshi=0)
+        result = reservations.reserve_tickets(order, {self.biorex: 2,
+                                                      self.finnkino: 1})
+        self.assertFalse(result)
+        self.assertEqual(result.shortages, {self.biorex: 1})
+        # Nothing was written
+        self.assertIsNone(order.pk)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.biorex.amount_available(), 1)
+        self.assertEqual(self.finnkino.amount_available(), 2)
+
+        # The last tickets can still be reserved
+        self.assertTrue(reservations.reserve_tickets(order, {self.biorex: 1}))
+        self.assertEqual(self.biorex.amount_available(), 0)
+
+
+class TokenTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category(tickets=5)
+
+    def test_token(self):
+        order = create_order({self.category: 1})
+        self.assertEqual(order.token, tokens.encode(order.pk))
+        self.assertEqual(len(order.token), 16)
+        self.assertEqual(Order.objects.get(token=order.token), order)
+        self.assertEqual(unicode(order), order.token)
+        # Saving again keeps the token
+        token = order.token
+        order.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).token, token)
+
+    def test_encode_many(self):
+        pks = [1, 2, 12345]
+        self.assertEqual(tokens.encode_many(pks),
+                         dict((pk, tokens.encode(pk)) for pk in pks))
+        self.assertEqual(len(set(tokens.encode_many(pks).values())), 3)
+        token = tokens.encode(1)
+        with override_settings(ORDER_TOKEN_KEY='another key'):
+            self.assertNotEqual(tokens.encode(1), token)
+
+    def test_cancel(self):
+        order = create_order({self.category: 2})
+        response = self.client.get(reverse('cancel', args=[order.token]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.get(pk=order.pk).orderstatus.status,
+                         OrderStatus.CANCELLED)
+        self.assertEqual(Order.objects.get(pk=order.pk).state,
+                         Order.CANCELLED)
+        response = self.client.get(reverse('cancel', args=[str(order.pk)]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_cancel_paid(self):
+        order = create_order({self.category: 2})
+        order.pay()
+        response = self.client.get(reverse('cancel', args=[order.token]))
+        self.assertContains(response, 'on jo maksettu')
+
+    def test_cancel_race(self):
+        order = create_order({self.category: 2})
+        # The order looks open, but it is paid before the status is inserted
+        self.assertRaises(OrderStatus.DoesNotExist,
+                          getattr, order, 'orderstatus')
+        Order.objects.get(pk=order.pk).pay()
+        available = Inventory.objects.availability()
+        self.assertFalse(order.cancel())
+        self.assertEqual(order.state, Order.PAID)
+        self.assertEqual(Inventory.objects.availability(), available)
+
+
+class ExpirationTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category(tickets=20)
+
+    def create_order(self, minutes_ago, amount=1):
+        order = create_order({self.category: amount},
+                             email='%d@example.com' % Order.objects.count())
+        date = timezone.now() - datetime.timedelta(minutes=minutes_ago)
+        Order.objects.filter(pk=order.pk).update(date=date)
+        return order
+
+    def test_expire_orders(self):
+        fresh = self.create_order(5)
+        expired = [self.create_order(20 + i, amount=2) for i in range(5)]
+        paid = self.create_order(30)
+        paid.pay()
+        ancient = self.create_order(60*24*7)
+
+        (count, seconds) = expiration.expire_orders(batch_size=2)
+        self.assertEqual(count, 5)
+        self.assertEqual(
+            set(OrderStatus.objects.filter(status=OrderStatus.EXPIRED)
+                .values_list('order', flat=True)),
+            set(order.pk for order in expired))
+        self.assertEqual(
+            set(Order.objects.filter(state=Order.EXPIRED)
+                .values_list('pk', flat=True)),
+            set(order.pk for order in expired))
+        inventory = Inventory.objects.get(category=self.category)
+        self.assertEqual((inventory.reserved, inventory.sold), (2, 1))
+
+        # Old orders are found only when asked
+        self.assertEqual(expiration.expire_orders()[0], 0)
+        self.assertEqual(expiration.expire_orders(lookback=False)[0], 1)
+        self.assertFalse(OrderStatus.objects.filter(order=fresh).exists())
+        self.assertEqual(Order.objects.get(pk=fresh.pk).state, Order.OPEN)
+        self.assertEqual(self.category.amount_available(), 18)
+
+    def test_paid_before_processing(self):
+        order = self.create_order(20)
+        Order.objects.filter(pk=order.pk).update(price_satoshi=1000,
+                                                 amount_paid=1000)
+        # The callback has been received but the payment not yet processed
+        self.assertEqual(expiration.expire_orders()[0], 0)
+        self.assertEqual(expiration.expire_batch([order.pk]), 0)
+        self.assertEqual(bitcoin.process_payments(), (1, 0))
+        self.assertEqual(Order.objects.get(pk=order.pk).state, Order.PAID)
+
+    def test_concurrently_closed(self):
+        orders = [self.create_order(20) for i in range(3)]
+        orders[1].cancel()
+        pks = [order.pk for order in orders]
+        self.assertEqual(expiration.expire_batch(pks), 2)
+        self.assertEqual(self.category.amount_available(), 20)
+        self.assertEqual(OrderStatus.objects.get(order=orders[1]).status,
+                         OrderStatus.CANCELLED)
+
+    def test_status_out_of_sync(self):
+        orders = [self.create_order(20) for i in range(3)]
+        # A status created by hand without updating the state
+        OrderStatus.objects.create(order=orders[0],
+                                   status=OrderStatus.CANCELLED)
+        self.assertEqual(expiration.expire_orders(batch_size=3)[0], 2)
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).state,
+                         Order.CANCELLED)
+        self.assertEqual(expiration.expire_orders()[0], 0)
+
+    def test_command(self):
+        self.create_order(20)
+        stdout = StringIO()
+        call_command('expire_orders', stdout=stdout)
+        self.assertIn('Expired 1 orders', stdout.getvalue())
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category(tickets=5)
+
+    def test_order_emails(self):
+        cancelled = create_order({self.category: 1}, email='a@example.com')
+        cancelled.cancel()
+        paid = create_order({self.category: 2}, email='b@example.com')
+        paid.pay()
+        self.assertEqual(
+            list(OutgoingEmail.objects.order_by('pk')
+                 .values_list('recipients', 'subject')),
+            [('a@example.com', 'Tilaus peruttu'),
+             ('b@example.com', 'Elokuvalippusi')])
+        # Nothing is sent in the request
+        self.assertEqual(len(mail.outbox), 0)
+
+        (sent, retried, failed, seconds) = mailqueue.send_queued_mail()
+        self.assertEqual((sent, retried, failed), (2, 0, 0))
+        self.assertEqual([message.to for message in mail.outbox],
+                         [['a@example.com'], ['b@example.com']])
+        self.assertIn('BioRex-0', mail.outbox[1].body)
+        self.assertEqual(mailqueue.send_queued_mail()[:3], (0, 0, 0))
+
+    def test_retry(self):
+        email = OutgoingEmail.objects.enqueue('email/cancel.txt',
+                                              {},
+                                              ['a@example.com'])
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST='127.0.0.1',
+                               EMAIL_PORT=1,
+                               OUTBOX_MAX_ATTEMPTS=2):
+            self.assertEqual(mailqueue.send_queued_mail()[:3], (0, 1, 0))
+            email = OutgoingEmail.objects.get(pk=email.pk)
+            self.assertEqual(email.attempts, 1)
+            self.assertTrue(email.next_attempt > timezone.now())
+            self.assertEqual(mailqueue.send_queued_mail()[:3], (0, 0, 0))
+
+            OutgoingEmail.objects.update(next_attempt=timezone.now())
+            self.assertEqual(mailqueue.send_queued_mail()[:3], (0, 0, 1))
+            self.assertTrue(OutgoingEmail.objects.get(pk=email.pk).failed)
+
+    def test_fake_mta(self):
+        for i in range(50):
+            OutgoingEmail.objects.enqueue('email/cancel.txt',
+                                          {},
+                                          ['%d@example.com' % i])
+        mta = FakeMTA().start()
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                   EMAIL_HOST='127.0.0.1',
+                                   EMAIL_PORT=mta.port):
+                (sent, retried, failed, seconds) = mailqueue.send_queued_mail(batch_size=20)
+        finally:
+            mta.stop()
+        self.assertEqual((sent, retried, failed), (50, 0, 0))
+        self.assertEqual(len(mta.messages), 50)
+        # All emails were sent through one connection
+        self.assertEqual(mta.connections, 1)
+
+
+class ExchangeRateTest(TestCase):
+
+    def setUp(self):
+        self.ticker = FakeTicker(rate=200.0).start()
+        rates.forget_quote()
+
+    def tearDown(self):
+        self.ticker.stop()
+        rates.forget_quote()
+
+    def test_refresh(self):
+        with override_settings(EXCHANGE_RATE_PROVIDERS=self.ticker.providers()):
+            quote = rates.refresh()
+        self.assertEqual(quote.rate, 200.0)
+        self.assertEqual(quote.provider, self.ticker.url('/mtgox'))
+        # Served from memory
+        with self.assertNumQueries(0):
+            self.assertEqual(rates.get_rate(), 200.0)
+        with override_settings(BITCOIN_FEE=0):
+            # 10 euros is 0.05 BTC
+            self.assertEqual(bitcoin.cents_to_satoshi(1000), 5000000)
+
+    def test_failover(self):
+        providers = (('leffalippu.rates.parse_mtgox', self.ticker.url('/missing')),
+                     ('leffalippu.rates.parse_blockchain', self.ticker.url('/blockchain')))
+        with override_settings(EXCHANGE_RATE_PROVIDERS=providers):
+            quote = rates.refresh()
+        self.assertEqual(quote.provider, self.ticker.url('/blockchain'))
+
+        self.ticker.fail = True
+        with override_settings(EXCHANGE_RATE_PROVIDERS=providers):
+            self.assertIsNone(rates.refresh())
+        # The last good quote is still used
+        self.assertEqual(rates.get_rate(), 200.0)
+
+    def test_prune(self):
+        old = timezone.now() - datetime.timedelta(hours=1)
+        ExchangeRate.objects.create(rate=100.0, provider='test', date=old)
+        recent = ExchangeRate.objects.create(rate=150.0, provider='test')
+        with override_settings(EXCHANGE_RATE_MAX_AGE=600):
+            quote = rates.store_rate(200.0, 'test')
+        self.assertEqual(set(ExchangeRate.objects.all()), set([recent, quote]))
+
+    def test_stale(self):
+        self.assertRaises(rates.StaleRate, rates.get_rate)
+        old = timezone.now() - datetime.timedelta(hours=1)
+        ExchangeRate.objects.create(rate=100.0, provider='test', date=old)
+        rates.forget_quote()
+        with override_settings(EXCHANGE_RATE_MAX_AGE=600):
+            self.assertRaises(rates.StaleRate, rates.get_rate)
+            self.assertIsNone(bitcoin.cents_to_satoshi(1000))
+        with override_settings(EXCHANGE_RATE_MAX_AGE=7200):
+            self.assertEqual(rates.get_rate(), 100.0)
+
+
+class AddressPoolTest(TestCase):
+
+    def setUp(self):
+        self.api = FakeReceiveAPI().start()
+        self.settings = override_settings(
+            BLOCKCHAIN_RECEIVE_URL=self.api.receive_url(),
+            ADDRESS_POOL_SIZE=5,
+            ADDRESS_POOL_LOW_WATERMARK=2)
+        self.settings.enable()
+        self.category = create_category(tickets=10)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.api.stop()
+
+    def test_fill_and_claim(self):
+        self.assertEqual(bitcoin.fill_address_pool(), 5)
+        self.assertEqual(bitcoin.fill_address_pool(), 0)
+        # The callbacks are registered with the tokens of the addresses
+        for address in PaymentAddress.objects.all():
+            self.assertEqual(self.api.callbacks[address.address],
+                             bitcoin.callback_url(address.token))
+
+        orders = [create_order({self.category: 1},
+                               email='%d@example.com' % i)
+                  for i in range(5)]
+        with self.assertNumQueries(2):
+            address = bitcoin.claim_address(orders[0])
+        claimed = [address] + [bitcoin.claim_address(order)
+                               for order in orders[1:]]
+        self.assertEqual(len(set(claimed)), 5)
+        self.assertEqual(PaymentAddress.objects.get(address=address).order,
+                         orders[0])
+        self.assertIsNone(bitcoin.claim_address(orders[0]))
+
+    def test_low_watermark(self):
+        alarms = []
+        def alarm(sender, unused, **kwargs):
+            alarms.append(unused)
+        bitcoin.address_pool_low.connect(alarm)
+        try:
+            bitcoin.fill_address_pool(size=1)
+            self.assertEqual(alarms, [1])
+            bitcoin.fill_address_pool()
+            self.assertEqual(alarms, [1])
+        finally:
+            bitcoin.address_pool_low.disconnect(alarm)
+
+    def test_metrics(self):
+        bitcoin.fill_address_pool(size=1)
+        content = self.client.get(reverse('metrics')).content
+        self.assertIn('\nleffalippu_payment_addresses_unused 1\n', content)
+        self.assertIn('\nleffalippu_payment_addresses_low_watermark 2\n',
+                      content)
+
+    def test_empty_pool(self):
+        order = create_order({self.category: 2})
+        ExchangeRate.objects.create(rate=100.0, provider='test')
+        rates.forget_quote()
+        (address, price) = bitcoin.create_payment(order)
+        self.assertEqual(PaymentAddress.objects.get(order=order).address,
+                         address)
+        self.assertEqual(len(self.api.requests), 1)
+
+        self.api.fail = True
+        order = create_order({self.category: 2}, email='other@example.com')
+        self.assertRaises(Exception, bitcoin.create_payment, order)
+
+
+    @override_settings(EXCHANGE_RATE_PROVIDERS=())
+    def test_failed_checkout(self):
+        bitcoin.fill_address_pool(size=1)
+        rates.forget_quote()
+        # The rate can't be fetched after the address has been claimed
+        response = self.client.post(reverse('order'), {
+            'email': 'test@example.com',
+            'terms': 'on',
+            'form-TOTAL_FORMS': 1,
+            'form-INITIAL_FORMS': 0,
+            'form-0-category': self.category.pk,
+            'form-0-amount': 1,
+        })
+        self.assertContains(response, 'Maksua ei kyetty luomaan')
+        self.assertEqual(Order.objects.count(), 0)
+        # The registered address is back in the pool
+        self.assertEqual(bitcoin.count_unused_addresses(), 1)
+        self.assertIsNone(PaymentAddress.objects.get().claimed)
+
+class BrokenCache(object):
+
+    def get(self, *args, **kwargs):
+        raise IOError("Cache is down")
+
+    set = get
+
+
+class ThrottlingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = create_category(tickets=10)
+
+    def test_normalize_email(self):
+        for (email, normalized) in [
+                (' Matti.Meikalainen+leffa@Example.com ',
+                 'matti.meikalainen@example.com'),
+                ('m.a.t.t.i+x@googlemail.com', 'matti@gmail.com'),
+                ('not an email', 'not an email')]:
+            self.assertEqual(throttling.normalize_email(email), normalized)
+
+    def test_take(self):
+        self.assertEqual(throttling.take('test', 'a', (2, 60)), 0)
+        self.assertEqual(throttling.take('test', 'a', (2, 60)), 0)
+        self.assertAlmostEqual(throttling.take('test', 'a', (2, 60)), 30,
+                               delta=1)
+        self.assertEqual(throttling.take('test', 'b', (2, 60)), 0)
+
+    def test_local_fallback(self):
+        (shared, throttling.cache) = (throttling.cache, BrokenCache())
+        try:
+            self.assertEqual(throttling.take('test', 'a', (1, 60)), 0)
+            self.assertGreater(throttling.take('test', 'a', (1, 60)), 0)
+        finally:
+            throttling.cache = shared
+            throttling._local.clear()
+
+    @override_settings(ORDER_RATE_PER_IP=(2, 60), ORDER_RATE_PER_EMAIL=None)
+    def test_order_view(self):
+        data = {'email': 'test@example.com',
+                'form-TOTAL_FORMS': 0,
+                'form-INITIAL_FORMS': 0}
+        for i in range(2):
+            self.assertEqual(self.client.post(reverse('order'),
+                                              data).status_code, 200)
+        # Rejected without touching the database
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('order'), data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        # Another address still gets through
+        response = self.client.post(reverse('order'), data,
+                                    REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(ORDER_RATE_PER_IP=(1, 60), ORDER_RATE_PER_EMAIL=None,
+                       WAITING_ROOM_SLOTS=1)
+    def test_waiting_room(self):
+        holder = waitingroom.enter()
+        data = {'email': 'test@example.com',
+                'form-TOTAL_FORMS': 0,
+                'form-INITIAL_FORMS': 0}
+        token = self.client.post(reverse('order'), data).context['ticket'].token
+        # Waiting doesn't use up the budget of the customer
+        for i in range(3):
+            response = self.client.post(reverse('order'),
+                                        dict(data, queue=token))
+            self.assertTemplateUsed(response, 'leffalippu/waiting.html')
+        waitingroom.release(holder)
+        response = self.client.post(reverse('order'), dict(data, queue=token))
+        self.assertTemplateUsed(response, 'leffalippu/home.html')
+        # The used admission is counted again
+        response = self.client.post(reverse('order'), dict(data, queue=token))
+        self.assertEqual(response.status_code, 429)
+
+    @override_settings(ORDER_RATE_PER_IP=None, ORDER_RATE_PER_EMAIL=(1, 60))
+    def test_email_rate(self):
+        self.assertEqual(throttling.admit_order('1.2.3.4', 'a+1@example.com'),
+                         0)
+        self.assertGreater(throttling.admit_order('5.6.7.8', 'A@example.com'),
+                           0)
+
+    def test_open_orders(self):
+        order = create_order({self.category: 1}, email='Ma.tti+x@gmail.com')
+        self.assertEqual(order.email_key, 'matti@gmail.com')
+        form = forms.OrderForm({'email': 'matti@gmail.com', 'terms': 'on'})
+        with self.assertNumQueries(1):
+            self.assertFalse(form.is_valid())
+        order.cancel()
+        form = forms.OrderForm({'email': 'matti@gmail.com', 'terms': 'on'})
+        self.assertTrue(form.is_valid())
+
+
+class CheckoutLookupTest(TestCase):
+
+    def setUp(self):
+        self.api = FakeReceiveAPI(delay=0.2).start()
+        self.ticker = FakeTicker(rate=200.0, delay=0.2).start()
+        self.settings = override_settings(
+            BLOCKCHAIN_RECEIVE_URL=self.api.receive_url(),
+            EXCHANGE_RATE_PROVIDERS=self.ticker.providers(),
+            BITCOIN_FEE=0)
+        self.settings.enable()
+        self.category = create_category(tickets=10)
+        rates.forget_quote()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.api.stop()
+        self.ticker.stop()
+        rates.forget_quote()
+
+    def create_payment(self):
+        order = create_order({self.category: 2})
+        start = time.time()
+        (address, price) = bitcoin.create_payment(order)
+        self.assertEqual(PaymentAddress.objects.get(order=order).address,
+                         address)
+        # 2 x 7 euros at 200 euros per bitcoin
+        self.assertEqual(price, 7000000)
+        self.assertEqual(rates.get_rate(), 200.0)
+        return time.time() - start
+
+    def test_parallel(self):
+        self.assertLess(self.create_payment(), 0.35)
+
+    @override_settings(CHECKOUT_PARALLEL_LOOKUPS=False)
+    def test_sequential(self):
+        self.assertGreaterEqual(self.create_payment(), 0.4)
+
+    def test_run_all(self):
+        late = []
+        tasks = [parallel.Task(time.sleep, 0.3, late=late.append),
+                 parallel.Task(lambda: 1 / 0),
+                 parallel.Task(lambda x: x, 'fast', late=late.append)]
+        start = time.time()
+        self.assertEqual(parallel.run_all(tasks, 0.1), [None, None, 'fast'])
+        self.assertLess(time.time() - start, 0.2)
+        self.assertIsInstance(tasks[1].error, ZeroDivisionError)
+        self.assertEqual(late, [])
+        tasks[0].join()
+        self.assertEqual(late, [None])
+
+
+class HTTPClientTest(TestCase):
+
+    def setUp(self):
+        httpclient.reset()
+        self.ticker = FakeTicker(rate=200.0).start()
+        self.url = self.ticker.url('/blockchain')
+
+    def tearDown(self):
+        self.ticker.stop()
+        httpclient.reset()
+
+    def endpoint(self, **options):
+        return override_settings(HTTP_ENDPOINTS={
+            'test': dict({'BACKOFF': 0}, **options),
+        })
+
+    def test_keep_alive(self):
+        with self.endpoint():
+            for i in range(3):
+                self.assertEqual(httpclient.get_json('test', self.url),
+                                 {'EUR': {'buy': 200.0}})
+        self.assertEqual((len(self.ticker.requests), self.ticker.connections),
+                         (3, 1))
+
+    def test_retries(self):
+        self.ticker.fail = True
+        with self.endpoint(RETRIES=2):
+            self.assertRaises(httpclient.HTTPError,
+                              httpclient.get, 'test', self.url)
+        self.assertEqual(len(self.ticker.requests), 3)
+        # Client errors are not retried
+        with self.endpoint(RETRIES=2):
+            self.assertRaises(httpclient.HTTPError,
+                              httpclient.get, 'test', self.ticker.url('/x'))
+        self.assertEqual(len(self.ticker.requests), 4)
+
+    def test_timeout(self):
+        self.ticker.delay = 0.5
+        start = time.time()
+        with self.endpoint(READ_TIMEOUT=0.1, RETRIES=0):
+            self.assertRaises(httpclient.HTTPError,
+                              httpclient.get, 'test', self.url)
+        self.assertLess(time.time() - start, 0.4)
+
+    def test_circuit_breaker(self):
+        self.ticker.fail = True
+        with self.endpoint(RETRIES=0, FAILURE_THRESHOLD=2,
+                           RESET_SECONDS=0.05, PROBE_URL=self.url):
+            for i in range(2):
+                self.assertRaises(httpclient.HTTPError,
+                                  httpclient.get, 'test', self.url)
+            # Fails fast without a request
+            requests = len(self.ticker.requests)
+            self.assertRaises(httpclient.CircuitOpen,
+                              httpclient.get, 'test', self.url)
+            self.assertIn('leffalippu_http_circuit_open{endpoint="test",'
+                          'host="127.0.0.1:%d"} 1' % self.ticker.port,
+                          metrics.render())
+            # The background probe closes the circuit when the host is up
+            self.ticker.fail = False
+            deadline = time.time() + 5
+            breaker = httpclient.get_breaker('test',
+                                             '127.0.0.1:%d' % self.ticker.port)
+            while breaker.is_open() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertGreater(len(self.ticker.requests), requests)
+            self.assertEqual(httpclient.get_json('test', self.url),
+                             {'EUR': {'buy': 200.0}})
+
+
+@override_settings(CALLBACK_SECRET='secret')
+class CallbackTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category(tickets=10)
+        self.order = create_order({self.category: 2})
+        self.order.price_satoshi = 300000
+        self.order.save()
+        PaymentAddress.objects.create(address='in-1',
+                                      token='token1',
+                                      order=self.order,
+                                      claimed=timezone.now())
+
+    def query(self, value, confirmations=0, tx='tx-1', secret='secret'):
+        return ('value=%d&input_address=in-1&destination_address=dest'
+                '&confirmations=%d&transaction_hash=%s'
+                '&input_transaction_hash=in-%s&secret=%s'
+                % (value, confirmations, tx, tx, secret))
+
+    def callback(self, query, token='token1'):
+        return self.client.get(reverse('callback', args=[token]) + '?' + query)
+
+    def amount_paid(self):
+        return Order.objects.get(pk=self.order.pk).amount_paid
+
+    def test_duplicate_callback(self):
+        response = self.callback(self.query(200000))
+        self.assertContains(response, '*ok*')
+        response = self.callback(self.query(200000, confirmations=3))
+        self.assertContains(response, '*ok*')
+        self.assertEqual(self.amount_paid(), 200000)
+        self.assertEqual(Transaction.objects.get().confirmations, 3)
+        # Partial payment doesn't pay the order
+        self.assertEqual(bitcoin.process_payments(), (0, 0))
+
+        self.callback(self.query(100000, tx='tx-2'))
+        self.assertEqual(self.amount_paid(), 300000)
+        self.assertEqual(bitcoin.process_payments(), (1, 0))
+        self.assertEqual(OrderStatus.objects.get(order=self.order).status,
+                         OrderStatus.PAID)
+        self.assertEqual(bitcoin.process_payments(), (0, 0))
+
+    def test_rejected_callback(self):
+        self.assertEqual(self.callback(self.query(1, secret='x')).status_code,
+                         404)
+        self.assertEqual(self.callback(self.query(1), token='x').status_code,
+                         404)
+        self.assertEqual(self.callback('value=1').status_code, 404)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_replay(self):
+        (fd, path) = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(simplejson.dumps({'token': 'token1',
+                                      'query': self.query(300000)}) + '\n')
+        try:
+            out = StringIO()
+            call_command('replay_callbacks', path, repeat=3, stdout=out)
+            self.assertIn("3 ok, 0 rejected", out.getvalue())
+            self.assertEqual(self.amount_paid(), 0)
+            self.assertEqual(Transaction.objects.count(), 0)
+            call_command('replay_callbacks', path, repeat=3, commit=True,
+                         stdout=out)
+        finally:
+            os.remove(path)
+        self.assertEqual(self.amount_paid(), 300000)
+
+
+class LoadTestTest(TestCase):
+
+    def test_run(self):
+        cache.clear()
+        (recorder, seconds) = loadtest.run(buyers=1,
+                                           orders=2,
+                                           categories=2,
+                                           tickets=5,
+                                           admin_every=1)
+        self.assertEqual(len(recorder.steps['order GET']['latencies']), 2)
+        self.assertEqual(recorder.steps['order GET']['errors'], {})
+        for step in ('order POST', 'callback', 'cancel'):
+            self.assertEqual(recorder.steps[step]['errors'], {})
+        # The category list stays cached, the availability changes in between
+        self.assertEqual(recorder.steps['order GET']['queries'], [2, 1])
+        self.assertEqual(len(recorder.steps['admin manager']['latencies']), 2)
+        self.assertEqual(len(recorder.report(seconds)), len(recorder.steps) + 1)
+
+    def test_crowd(self):
+        cache.clear()
+        (recorder, seconds, lines) = loadtest.crowd(customers=6,
+                                                    workers=1,
+                                                    slots=2,
+                                                    poll_seconds=0)
+        self.assertEqual(recorder.steps['order POST']['errors'], {})
+        self.assertEqual(Order.objects.count(), 6)
+        self.assertEqual(lines[-1], "6/6 customers done, peak 1/2 checkouts "
+                         "in progress, 0 FIFO violations, 0 requeued")
+
+    def test_in_memory_database(self):
+        if in_memory_database():
+            self.assertRaises(CommandError, call_command, 'loadtest',
+                              buyers=2, stdout=StringIO())
+
+
+class ManagerTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.biorex = create_category(name='BioRex', price=700, tickets=20)
+        self.finnkino = create_category(name='Finnkino', price=900, tickets=20)
+        self.count = 0
+
+    def create_orders(self):
+        for action in (None, 'cancel', 'expire', 'pay'):
+            self.count += 1
+            order = create_order({self.biorex: 1, self.finnkino: 1},
+                                 email='%d@example.com' % self.count)
+            if action is not None:
+                getattr(order, action)()
+
+    def get(self, query=''):
+        return self.client.get(reverse('admin:manager') + query)
+
+    def test_bounded_queries(self):
+        self.create_orders()
+        with CaptureQueriesContext(connection) as context:
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.create_orders()
+        self.create_orders()
+        with self.assertNumQueries(len(context)):
+            self.get()
+
+    def test_read_only_tickets(self):
+        order = create_order({self.biorex: 2})
+        response = self.client.get(
+            reverse('admin:leffalippu_order_change', args=[order.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'name="orderedtickets_set-0-amount"')
+        response = self.client.get(
+            reverse('admin:leffalippu_orderedtickets_add'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_totals(self):
+        self.create_orders()
+        self.create_orders()
+        categories = dict((c.name, c)
+                          for c in Category.objects.with_totals())
+        self.assertEqual(categories['BioRex'].revenue, 2 * 700)
+        self.assertEqual(categories['BioRex'].amount_sold, 2)
+        self.assertEqual(categories['BioRex'].amount_reserved, 4)
+        self.assertEqual(categories['Finnkino'].revenue, 2 * 900)
+        self.assertContains(self.get(), u'Myynti yhteensä: 3200')
+
+    def test_pagination(self):
+        for i in range(3):
+            self.create_orders()
+        OrderAdmin.manager_page_size = 2
+        self.addCleanup(setattr, OrderAdmin, 'manager_page_size', 50)
+        response = self.get()
+        open_orders = response.context['order_sections'][0]
+        self.assertEqual(len(open_orders['order_list']), 2)
+        self.assertEqual(open_orders['count'], 3)
+        response = self.get(open_orders['next_url'])
+        open_orders = response.context['order_sections'][0]
+        self.assertEqual(len(open_orders['order_list']), 1)
+        self.assertIsNone(open_orders['next_url'])
+
+
+class QueryPlanTest(TestCase):
+
+    def setUp(self):
+        categories = [create_category(name='Category %d' % i, tickets=0)
+                      for i in range(3)]
+        expires = datetime.date(2030, 1, 1)
+        Ticket.objects.bulk_create(
+            Ticket(category=categories[i % 3],
+                   number='%d' % i,
+                   price=500,
+                   expires=expires + datetime.timedelta(days=i % 100))
+            for i in range(3000))
+        Order.objects.bulk_create(
+            Order(email='%d@example.com' % i,
+                  public_address='address-%d' % i,
+                  price_satoshi=0)
+            for i in range(1000))
+        orders = list(Order.objects.values_list('pk', flat=True))
+        OrderStatus.objects.bulk_create(
+            OrderStatus(order_id=pk, status=OrderStatus.CANCELLED)
+            for pk in orders[::2])
+        Order.objects.filter(pk__in=orders[::2]).update(state=Order.CANCELLED)
+        OrderedTickets.objects.bulk_create(
+            OrderedTickets(order_id=pk, category=categories[0], amount=1,
+                           price=700)
+            for pk in orders)
+        Transaction.objects.bulk_create(
+            Transaction(order_id=pk,
+                        value=1,
+                        input_address='in',
+                        destination_address='out',
+                        confirmations=0,
+                        transaction_hash='tx-%d' % pk,
+                        input_transaction_hash='in-%d' % pk)
+            for pk in orders[::3])
+        PaymentAddress.objects.bulk_create(
+            PaymentAddress(address='address-%d' % i, token='token-%d' % i)
+            for i in range(1000))
+        queryplans.analyze()
+
+    def test_no_sequential_scans(self):
+        self.assertEqual(
+            queryplans.sequential_scans(ignore=[Category._meta.db_table]),
+            {})
+
+    def test_open_orders(self):
+        for (name, before, after, before_seconds, after_seconds) in (
+                queryplans.compare_open_orders(repeat=1)):
+            self.assertEqual(queryplans.scanned_tables(after,
+                                                       connection.vendor),
+                             [], name)
+        self.assertEqual(
+            queryplans.open_order_querysets()['reserved tickets'].count(),
+            500)
+
+    def test_state_migration(self):
+        migration = importlib.import_module(
+            'leffalippu.migrations.0005_order_state')
+        Order.objects.update(state=Order.OPEN)
+        migration.set_states(apps, None)
+        self.assertEqual(Order.objects.filter(state=Order.CANCELLED).count(),
+                         500)
+
+    def test_scanned_tables(self):
+        self.assertEqual(
+            queryplans.scanned_tables(['SCAN TABLE leffalippu_order',
+                                       'SCAN leffalippu_ticket USING INDEX x',
+                                       'SEARCH leffalippu_orderstatus'],
+                                      'sqlite'),
+            ['leffalippu_order'])
+        self.assertEqual(
+            queryplans.scanned_tables(['Hash Join  (cost=1.0..2.0)',
+                                       '  ->  Seq Scan on leffalippu_order  '
+                                       '(cost=0.00..1.00 rows=1 width=4)'],
+                                      'postgresql'),
+            ['leffalippu_order'])
+
+
+class TicketImportTest(TestCase):
+
+    def setUp(self):
+        self.biorex = create_category(name='BioRex', tickets=2)
+        self.finnkino = create_category(name='Finnkino', tickets=0)
+
+    def import_file(self, content, *args, **kwargs):
+        (fd, path) = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        out = StringIO()
+        call_command('import_tickets', path, stdout=out, *args, **kwargs)
+        return out.getvalue()
+
+    def test_import(self):
+        content = ("number,expires,price,category\n"
+                   "A1,2030-01-01,500,BioRex\n"
+                   "A2,31.12.2030,500,Finnkino\n"
+                   "A3,2030-01-01,600,Finnkino\n")
+        self.assertIn("3 valid tickets", self.import_file(content,
+                                                          dry_run=True))
+        self.assertEqual(Ticket.objects.count(), 2)
+
+        self.assertIn("3 tickets imported", self.import_file(content,
+                                                             chunk_size=2))
+        self.assertEqual(Ticket.objects.get(number='A2').expires,
+                         datetime.date(2030, 12, 31))
+        self.assertEqual(self.biorex.amount_available(), 3)
+        self.assertEqual(self.finnkino.amount_available(), 2)
+        self.assertEqual(Inventory.objects.count_tickets(self.finnkino),
+                         (2, 0, 0))
+
+    def test_invalid_rows(self):
+        rows = [[u'number', u'expires', u'price', u'category'],
+                [u'BioRex-0', u'2030-01-01', u'500', u'BioRex'],
+                [u'B1', u'2030-01-01', u'500', u'BioRex'],
+                [u'B1', u'2030-01-01', u'500', u'BioRex'],
+                [u'B2', u'tomorrow', u'500', u'BioRex'],
+                [u'B3', u'2030-01-01', u'5.5', u'BioRex'],
+                [u'B4', u'2030-01-01', u'500', u'Norkko'],
+                [u'', u'', u'', u''],
+                [u'B5', u'2030-01-01', u'500', u'BioRex']]
+        result = ticketimport.import_tickets(rows, chunk_size=1)
+        self.assertFalse(result)
+        self.assertEqual([line for (line, message) in result.errors],
+                         [2, 4, 5, 6, 7])
+        self.assertEqual(result.valid, 2)
+        self.assertEqual(result.created, 0)
+        self.assertEqual(Ticket.objects.count(), 2)
+        self.assertEqual(self.biorex.amount_available(), 2)
+
+        self.assertRaises(CommandError, self.import_file,
+                          "number,expires\nC1,2030-01-01\n")
+
+    def test_category_option(self):
+        content = "number,expires,price\nC1,2030-01-01,500\n"
+        self.assertIn("1 tickets imported",
+                      self.import_file(content, category='Finnkino'))
+        self.assertEqual(Ticket.objects.get(number='C1').category,
+                         self.finnkino)
+
+    def test_admin_upload(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        upload = SimpleUploadedFile('tickets.csv',
+                                    "number,expires,price\n"
+                                    "D1,2030-01-01,500\n"
+                                    "D2,2030-01-01,500\n")
+        response = self.client.post(reverse('admin:import_tickets'),
+                                    {
+                                        'file': upload,
+                                        'category': self.finnkino.pk,
+                                    })
+        self.assertContains(response, "2 lippua tallennettu")
+        self.assertEqual(self.finnkino.amount_available(), 2)
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category(name=u'Kinopalatsi', tickets=10)
+        self.orders = [create_order({self.category: 1},
+                                    email='%d@example.com' % i)
+                       for i in range(5)]
+        self.orders[0].pay()
+        self.orders[1].cancel()
+
+    def rows(self, name, **kwargs):
+        return list(exports.export_rows(name, chunk_size=2, **kwargs))
+
+    def test_export_rows(self):
+        rows = self.rows('orders')
+        self.assertEqual(rows[0][:3], ('id', 'date', 'email'))
+        self.assertEqual([row[0] for row in rows[1:]],
+                         [order.pk for order in self.orders])
+        self.assertEqual(len(self.rows('orders', status='open')), 4)
+        self.assertEqual(len(self.rows('orders', status='paid')), 2)
+        self.assertEqual(len(self.rows('paidtickets')), 2)
+        self.assertEqual(len(self.rows('orderedtickets', status='cancelled')),
+                         2)
+        # The status is filtered by the state of the order
+        query = exports.EXPORTS['orderedtickets'].queryset(status='open').query
+        self.assertNotIn('orderstatus', str(query))
+        today = timezone.localtime(timezone.now()).date()
+        yesterday = today - datetime.timedelta(days=1)
+        self.assertEqual(len(self.rows('orders', start=today, end=today)), 6)
+        self.assertEqual(len(self.rows('orders', end=yesterday)), 1)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_csv', 'paidtickets', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,order,paid,category,number,price,expires')
+        self.assertIn('Kinopalatsi', lines[1])
+        self.assertRaises(CommandError, call_command, 'export_csv', 'foo',
+                          stdout=out)
+
+    def test_admin_export(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('admin:export'),
+                                   {'export': 'orders', 'status': 'paid'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        content = ''.join(response.streaming_content)
+        self.assertEqual(len(content.splitlines()), 2)
+        self.assertIn(self.orders[0].email, content)
+
+
+class CacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = create_category(name='BioRex', tickets=10)
+
+    def test_order_page(self):
+        self.client.get(reverse('order'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('order'))
+        self.assertContains(response, '<td align="center">10</td>')
+
+        order = create_order({self.category: 3})
+        self.assertContains(self.client.get(reverse('order')),
+                            '<td align="center">7</td>')
+        order.cancel()
+        self.assertEqual(Inventory.objects.availability(),
+                         {self.category.pk: 10})
+
+        self.category.name = 'Finnkino'
+        self.category.save()
+        self.assertContains(self.client.get(reverse('order')), 'Finnkino')
+
+    def test_availability_snapshot(self):
+        self.assertEqual(Inventory.objects.availability(),
+                         {self.category.pk: 10})
+        with self.assertNumQueries(0):
+            Inventory.objects.availability()
+        order = create_order({self.category: 2})
+        order.pay()
+        self.assertEqual(Inventory.objects.availability(),
+                         {self.category.pk: 8})
+        expired = create_order({self.category: 1}, email='other@example.com')
+        expired.expire()
+        self.assertEqual(Inventory.objects.availability(),
+                         {self.category.pk: 8})
+        Ticket.objects.create(category=self.category,
+                              number='new',
+                              price=500,
+                              expires=datetime.date(2030, 1, 1))
+        self.assertEqual(Inventory.objects.availability(),
+                         {self.category.pk: 9})
+
+    def test_terms_of_service(self):
+        response = self.client.get(reverse('terms_of_service'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self.client.get(reverse('terms_of_service'),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class CacheBackendTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = SharedFileCache(self.dir, {
+            'OPTIONS': {'MAX_ENTRIES': 4, 'CULL_FREQUENCY': 2},
+        })
+        self.cache.CULL_INTERVAL = 1
+
+    def test_lru_eviction(self):
+        for (i, key) in enumerate('abcd'):
+            self.cache.set(key, i)
+            os.utime(self.cache._key_to_file(key), (1000 + i, 1000 + i))
+        # Using an entry keeps it in the cache
+        self.assertEqual(self.cache.get('a'), 0)
+        self.cache.set('e', 4)
+        self.assertEqual([key for key in 'abcde' if self.cache.has_key(key)],
+                         ['a', 'd', 'e'])
+
+    def test_counters(self):
+        self.assertRaises(ValueError, self.cache.incr, 'n')
+        self.assertTrue(self.cache.add('n', 0, 60))
+        self.assertFalse(self.cache.add('n', 5, 60))
+        # The expiry time is pickled in the beginning of the file
+        expiry = open(self.cache._key_to_file('n'), 'rb').read(12)
+        threads = [threading.Thread(target=lambda: [self.cache.incr('n')
+                                                    for j in range(20)])
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.decr('n', 10), 90)
+        # The expiry time is kept
+        self.assertEqual(open(self.cache._key_to_file('n'), 'rb').read(12),
+                         expiry)
+        self.cache.set('n', 1, -1)
+        self.assertRaises(ValueError, self.cache.incr, 'n')
+
+    def test_stats(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('a')
+        self.cache.get('b')
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'misses': 1})
+        self.assertEqual(cache_stats()[os.path.abspath(self.dir)],
+                         {'hits': 2, 'misses': 1})
+
+    def test_stampede(self):
+        cache.clear()
+        builds = []
+        def build():
+            builds.append(1)
+            time.sleep(0.2)
+            return 42
+        results = []
+        def get():
+            results.append(caching.cached('stampede', 60, build))
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(len(builds), 1)
+
+        caching.bump_version('stampede')
+        self.assertEqual(caching.cached('stampede', 60, build), 42)
+        self.assertEqual(len(builds), 2)
+
+
+class CaptureHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class PerformanceMiddlewareTest(TestCase):
+
+    def setUp(self):
+        create_category(name='BioRex')
+        self.handler = CaptureHandler()
+        self.logger = logging.getLogger('leffalippu.performance')
+        self.handlers = self.logger.handlers
+        self.logger.handlers = [self.handler]
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.handlers = self.handlers
+        self.logger.setLevel(logging.WARNING)
+
+    def test_request_log(self):
+        cache.clear()
+        self.client.get(reverse('order'))
+        record = simplejson.loads(self.handler.messages[-1])
+        self.assertEqual(record['view'], 'order')
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['db_queries'], 2)
+        self.assertEqual(len(connection.queries), 0)
+        self.assertNotIn('cursor', connection.__dict__)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('leffalippu_request_seconds_count{view="order"}',
+                      response.content)
+        self.assertIn('leffalippu_request_db_queries_bucket{le="2",view="order"}',
+                      response.content)
+        self.assertEqual(self.client.get(reverse('metrics'),
+                                         REMOTE_ADDR='10.0.0.1').status_code,
+                         404)
+
+    def test_slow_request_log(self):
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with self.settings(SLOW_REQUEST_SECONDS=0, SLOW_REQUEST_LOG=path):
+            self.client.get(reverse('order'))
+        with open(path) as f:
+            record = simplejson.loads(f.readline())
+        self.assertEqual(record['view'], 'order')
+        self.assertEqual(len(record['queries']), record['db_queries'])
+
+    def test_external_timer(self):
+        metrics.begin_request()
+        with metrics.timer('http'):
+            pass
+        with metrics.timer('http'):
+            pass
+        timings = metrics.end_request()
+        self.assertEqual(list(timings), ['http'])
+        self.assertIn('leffalippu_external_seconds_count{kind="http"}',
+                      metrics.render())
+
+    def test_render(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('test_seconds', 'Test.',
+                                       buckets=(0.1, 1))
+        histogram.observe(0.5, view='a"b')
+        registry.counter('test_total', 'Test.').inc(2)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1",view="a\\"b"} 0',
+            'test_seconds_bucket{le="1",view="a\\"b"} 1',
+            'test_seconds_bucket{le="+Inf",view="a\\"b"} 1',
+            'test_seconds_sum{view="a\\"b"} 0.5',
+            'test_seconds_count{view="a\\"b"} 1',
+            '# HELP test_total Test.',
+            '# TYPE test_total counter',
+            'test_total 2',
+        ])
+
+
+class FakeConnection(object):
+
+    def __init__(self, usable=True):
+        self.usable = usable
+        self.closed = False
+        self.rollbacks = 0
+
+    def cursor(self):
+        if not self.usable:
+            raise Exception("Connection lost")
+        return self
+
+    def execute(self, sql):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(TestCase):
+
+    def test_reuse(self):
+        pool = dbpool.ConnectionPool(max_size=2)
+        first = pool.acquire(FakeConnection)
+        pool.release(first)
+        self.assertEqual(first.rollbacks, 1)
+        self.assertIs(pool.acquire(FakeConnection), first)
+        second = pool.acquire(FakeConnection)
+        self.assertIsNot(second, first)
+        self.assertEqual(pool.stats, {'created': 2, 'reused': 1,
+                                      'discarded': 0})
+
+    def test_bounded(self):
+        pool = dbpool.ConnectionPool(max_size=1, timeout=0.05)
+        first = pool.acquire(FakeConnection)
+        self.assertRaises(OperationalError, pool.acquire, FakeConnection)
+        # A connection released by another thread is handed over
+        threading.Timer(0.01, pool.release, [first]).start()
+        pool.timeout = 5
+        self.assertIs(pool.acquire(FakeConnection), first)
+
+    def test_idle_and_health_check(self):
+        pool = dbpool.ConnectionPool(max_size=2, idle_seconds=60,
+                                     check_seconds=10)
+        broken = pool.acquire(lambda: FakeConnection(usable=False))
+        old = pool.acquire(FakeConnection)
+        pool.release(broken)
+        pool.release(old)
+        pool.idle = [(old, time.time() - 120), (broken, time.time() - 20)]
+        # The old connection expires and the broken one fails the check
+        fresh = pool.acquire(FakeConnection)
+        self.assertNotIn(fresh, (broken, old))
+        self.assertTrue(broken.closed and old.closed)
+        self.assertEqual((pool.size, pool.stats['discarded']), (1, 2))
+
+    def test_close(self):
+        pool = dbpool.ConnectionPool(max_size=2)
+        (first, second) = (pool.acquire(FakeConnection),
+                           pool.acquire(FakeConnection))
+        pool.release(first)
+        pool.close()
+        self.assertTrue(first.closed)
+        pool.release(second)
+        self.assertTrue(second.closed)
+        self.assertEqual(pool.size, 0)
+
+
+class PooledBackendTest(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings_dict = dict(connection.settings_dict,
+                                  ENGINE='leffalippu.backends.sqlite3_pool',
+                                  NAME=os.path.join(self.path, 'db.sqlite3'),
+                                  POOL={'MAX_SIZE': 2})
+
+    def tearDown(self):
+        dbpool.close_pools()
+        shutil.rmtree(self.path)
+
+    def wrapper(self):
+        return sqlite3_pool.DatabaseWrapper(self.settings_dict, 'pooltest')
+
+    def test_reuse(self):
+        first = self.wrapper()
+        first.cursor().execute("CREATE TABLE t (x INTEGER)")
+        raw = first.connection
+        first.close()
+        second = self.wrapper()
+        with second.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM t")
+            self.assertEqual(cursor.fetchone(), (0,))
+        self.assertIs(second.connection, raw)
+        second.close()
+        self.assertEqual(dbpool.pool_stats()['pooltest'],
+                         {'created': 1, 'reused': 1, 'discarded': 0,
+                          'open': 1, 'idle': 1})
+        self.assertIn('leffalippu_db_pool_connections_reused_total'
+                      '{alias="pooltest"} 1', metrics.render())
+
+    def test_disabled(self):
+        self.settings_dict['POOL'] = {'MAX_SIZE': 0}
+        first = self.wrapper()
+        first.ensure_connection()
+        raw = first.connection
+        first.close()
+        second = self.wrapper()
+        second.ensure_connection()
+        self.assertIsNot(second.connection, raw)
+        second.close()
+        self.assertNotIn('pooltest', dbpool.pool_stats())
+
+
+@override_settings(WAITING_ROOM_SLOTS=2)
+class WaitingRoomTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_fifo(self):
+        tickets = [waitingroom.enter() for i in range(5)]
+        self.assertEqual([ticket.admitted for ticket in tickets],
+                         [True, True, False, False, False])
+        self.assertEqual([ticket.ahead for ticket in tickets[2:]], [0, 1, 2])
+        # Reusing the place doesn't take a new number
+        self.assertFalse(waitingroom.enter(tickets[3].token).admitted)
+        waitingroom.release(tickets[0])
+        self.assertEqual(waitingroom.in_flight(), 1)
+        self.assertTrue(waitingroom.status(3).admitted)
+        self.assertEqual(waitingroom.in_flight(), 2)
+        self.assertFalse(waitingroom.status(4).admitted)
+        # The slot was given to the first in the queue
+        self.assertFalse(waitingroom.enter(tickets[4].token).admitted)
+        self.assertTrue(waitingroom.enter(tickets[2].token).admitted)
+
+    def test_shared_cache(self):
+        self.assertTrue(waitingroom.enabled())
+        with override_settings(WAITING_ROOM_SLOTS=None):
+            self.assertFalse(waitingroom.enabled())
+        local = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+        }
+        with override_settings(CACHES=local):
+            self.assertRaises(ImproperlyConfigured, waitingroom.enabled)
+
+    def test_single_use(self):
+        ticket = waitingroom.enter()
+        waitingroom.release(ticket)
+        # The used admission doesn't get through again
+        again = waitingroom.enter(ticket.token)
+        self.assertNotEqual(again.number, ticket.number)
+        self.assertIsNone(waitingroom.read_token('1:forged'))
+
+    def test_expiry(self):
+        ticket = waitingroom.enter()
+        with override_settings(WAITING_ROOM_LEASE_SECONDS=0.1):
+            waitingroom.reset()
+            ticket = waitingroom.enter()
+            self.assertTrue(ticket.admitted)
+            time.sleep(0.2)
+            self.assertFalse(waitingroom.status(ticket.number).admitted)
+            # The slot of the abandoned admission is freed
+            self.assertEqual(waitingroom.in_flight(), 0)
+
+    def test_views(self):
+        category = create_category(tickets=10)
+        holders = [waitingroom.enter() for i in range(2)]
+        data = {'email': 'test@example.com',
+                'terms': 'on',
+                'form-TOTAL_FORMS': 1,
+                'form-INITIAL_FORMS': 0,
+                'form-0-category': category.pk,
+                # Rejected in the checkout without calling the receive API
+                'form-0-amount': 0}
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('order'), data)
+        ticket = response.context['ticket']
+        self.assertContains(response, 'name="queue" value="%s"'
+                            % ticket.token)
+        self.assertContains(response,
+                            'name="form-0-category" value="%d"' % category.pk)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('queue_status'),
+                                       {'queue': ticket.token})
+        self.assertEqual(simplejson.loads(response.content),
+                         {'admitted': False, 'waiting': True, 'ahead': 0})
+        self.assertEqual(self.client.get(reverse('queue_status'),
+                                         {'queue': 'forged'}).status_code,
+                         404)
+        waitingroom.release(holders[0])
+        self.assertTrue(simplejson.loads(self.client.get(
+            reverse('queue_status'), {'queue': ticket.token}).content)[
+                'admitted'])
+        response = self.client.post(reverse('order'),
+                                    dict(data, queue=ticket.token))
+        self.assertTemplateUsed(response, 'leffalippu/home.html')
+        # The slot is released after the checkout
+        self.assertEqual(waitingroom.in_flight(), 1)
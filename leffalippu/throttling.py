@@ -0,0 +1,117 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Admission control of the reservations.
+
+Each IP address and each customer email address has a token bucket: a
+reservation attempt takes a token, and the tokens are refilled at a steady
+rate up to the size of the bucket. Attempts without tokens are rejected
+before the forms are validated or anything is written, so floods cost only
+a cache lookup. The buckets are kept in the default cache, so they are
+shared by the worker processes. If the cache fails, the buckets of this
+process are used instead.
+
+The buckets are read and written without locking, so concurrent attempts
+may occasionally get a few extra tokens.
+"""
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+
+BUCKET_KEY = 'leffalippu:throttle:%s:%s'
+
+""" Number of buckets kept in memory when the cache fails """
+MAX_LOCAL_BUCKETS = 10000
+
+# Fallback buckets of this process
+_local_lock = threading.Lock()
+_local = {}
+
+""" Domains which ignore the dots of the local part """
+DOTLESS_DOMAINS = ('gmail.com', 'googlemail.com')
+
+def normalize_email(email):
+    """
+    Return the canonical form of an email address for counting.
+
+    The address is lowercased, a "+tag" suffix of the local part is
+    removed, and so are the dots of Gmail addresses, which all reach the
+    same mailbox.
+    """
+    (local, at, domain) = email.strip().lower().rpartition('@')
+    if not at:
+        return domain
+    local = local.split('+', 1)[0]
+    if domain in DOTLESS_DOMAINS:
+        (local, domain) = (local.replace('.', ''), 'gmail.com')
+    return '%s@%s' % (local, domain)
+
+def _get(key):
+    try:
+        return cache.get(key)
+    except Exception:
+        with _local_lock:
+            return _local.get(key)
+
+def _set(key, state, timeout):
+    try:
+        cache.set(key, state, timeout)
+    except Exception:
+        with _local_lock:
+            if len(_local) >= MAX_LOCAL_BUCKETS:
+                _local.clear()
+            _local[key] = state
+
+def take(scope, identifier, rate):
+    """
+    Take a token from the bucket of an identifier.
+
+    `rate` is a tuple (tokens, seconds): the bucket holds that many tokens
+    and refills them in that many seconds. Returns 0 if a token was taken,
+    otherwise the seconds until the next token.
+    """
+    (capacity, seconds) = rate
+    per_second = float(capacity) / seconds
+    key = BUCKET_KEY % (scope,
+                        hashlib.sha1(force_bytes(identifier)).hexdigest())
+    now = time.time()
+    (tokens, updated) = _get(key) or (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * per_second)
+    if tokens < 1:
+        return (1 - tokens) / per_second
+    _set(key, (tokens - 1, now), seconds)
+    return 0
+
+def admit_order(ip, email):
+    """
+    Take tokens for a reservation attempt from the IP and email buckets.
+
+    Returns 0 if the attempt is admitted, otherwise the seconds after which
+    to retry.
+    """
+    if ip and settings.ORDER_RATE_PER_IP:
+        wait = take('ip', ip, settings.ORDER_RATE_PER_IP)
+        if wait:
+            return wait
+    email = normalize_email(email)
+    if email and settings.ORDER_RATE_PER_EMAIL:
+        return take('email', email, settings.ORDER_RATE_PER_EMAIL)
+    return 0
@@ -0,0 +1,244 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Bulk import of tickets from CSV and XLSX files.
+
+The file has a header row with columns `number`, `expires` and `price`,
+and `category` (the name of the category) unless the category is given
+for the whole file. The rows are read and validated one at a time and the
+tickets are inserted in chunks, so the memory use doesn't depend on the
+size of the file, apart from the set of ticket numbers used for detecting
+duplicates.
+"""
+
+import csv
+import datetime
+
+from django.db import transaction
+
+from leffalippu.models import Category, Ticket, Inventory
+
+""" Number of tickets per INSERT """
+CHUNK_SIZE = 1000
+
+""" Number of row errors included in the report """
+MAX_REPORTED_ERRORS = 100
+
+COLUMNS = ('number', 'expires', 'price')
+
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+
+class TicketImportError(Exception):
+    """
+    The file can't be imported at all, for instance, the header is invalid.
+    """
+    pass
+
+class ImportResult(object):
+    """
+    Summary of an import.
+
+    The result is true if there were no errors. `errors` lists the first
+    MAX_REPORTED_ERRORS errors as (line, message) tuples.
+    """
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.rows = 0
+        self.valid = 0
+        self.created = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def __nonzero__(self):
+        return not self.error_count
+
+    __bool__ = __nonzero__
+
+def read_csv(f):
+    """
+    Read the rows of an UTF-8 encoded CSV file.
+    """
+    for (i, row) in enumerate(csv.reader(f)):
+        if i == 0 and row and row[0].startswith('\xef\xbb\xbf'):
+            # Byte order mark
+            row[0] = row[0][3:]
+        yield [value.decode('utf-8') for value in row]
+
+def read_xlsx(f):
+    """
+    Read the rows of the first sheet of an XLSX file.
+
+    Requires openpyxl.
+    """
+    try:
+        import openpyxl
+    except ImportError:
+        raise TicketImportError("XLSX files require openpyxl")
+    workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+    for row in workbook.active.iter_rows():
+        yield [cell.value for cell in row]
+
+def read_rows(f, filename):
+    """
+    Read the rows of a CSV or XLSX file based on the file name.
+    """
+    if filename.lower().endswith('.xlsx'):
+        return read_xlsx(f)
+    return read_csv(f)
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return unicode(value).strip()
+
+def _date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(_text(value), date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(u"Invalid expiration date: %s" % _text(value))
+
+def _price(value):
+    try:
+        price = float(_text(value))
+    except ValueError:
+        raise ValueError(u"Invalid price: %s" % _text(value))
+    if price < 0 or not price.is_integer():
+        raise ValueError(u"Price must be a non-negative number of cents: %s"
+                         % _text(value))
+    return int(price)
+
+def parse_rows(rows, category=None):
+    """
+    Validate the rows and generate (line, ticket, error) tuples.
+
+    Either the ticket or the error message is None. The tickets are not
+    saved. Ticket numbers that exist in the database or earlier in the
+    file are errors.
+    """
+    rows = iter(rows)
+    try:
+        header = [_text(name).lower() for name in next(rows)]
+    except StopIteration:
+        raise TicketImportError("The file is empty")
+    columns = COLUMNS if category is not None else COLUMNS + ('category',)
+    missing = [name for name in columns if name not in header]
+    if missing:
+        raise TicketImportError("Missing columns: %s" % ', '.join(missing))
+    index = dict((name, header.index(name)) for name in columns)
+
+    categories = {}
+    numbers = {}
+    for (line, row) in enumerate(rows, 2):
+        if not any(_text(value) for value in row):
+            continue
+        row = list(row) + [None] * (len(header) - len(row))
+        try:
+            number = _text(row[index['number']])
+            if not number:
+                raise ValueError(u"Missing ticket number")
+            expires = _date(row[index['expires']])
+            price = _price(row[index['price']])
+            if category is not None:
+                row_category = category
+            else:
+                name = _text(row[index['category']])
+                if name not in categories:
+                    try:
+                        categories[name] = Category.objects.get(name=name)
+                    except Category.DoesNotExist:
+                        categories[name] = None
+                row_category = categories[name]
+                if row_category is None:
+                    raise ValueError(u"Unknown category: %s" % name)
+            if row_category.pk not in numbers:
+                numbers[row_category.pk] = set(
+                    Ticket.objects.filter(
+                        category=row_category
+                    ).values_list('number', flat=True))
+            if number in numbers[row_category.pk]:
+                raise ValueError(u"Duplicate ticket number %s in %s"
+                                 % (number, row_category))
+        except ValueError as e:
+            yield (line, None, unicode(e))
+            continue
+        numbers[row_category.pk].add(number)
+        yield (line,
+               Ticket(category=row_category,
+                      number=number,
+                      price=price,
+                      expires=expires),
+               None)
+
+def import_tickets(rows, category=None, dry_run=False, chunk_size=CHUNK_SIZE):
+    """
+    Validate and insert tickets from the rows of a file.
+
+    The tickets are inserted in chunks in one transaction and the inventory
+    counters are updated in the same transaction. If any row is invalid,
+    nothing is written but the rest of the rows are still validated for the
+    error report. In a dry run, the rows are only validated.
+    """
+    result = ImportResult(dry_run)
+    created = {}
+
+    def write(chunk):
+        Ticket.objects.bulk_create(chunk)
+        for ticket in chunk:
+            created[ticket.category_id] = created.get(ticket.category_id, 0) + 1
+        result.created += len(chunk)
+
+    with transaction.atomic():
+        chunk = []
+        for (line, ticket, error) in parse_rows(rows, category=category):
+            result.rows += 1
+            if error is not None:
+                result.add_error(line, error)
+                chunk = []
+                continue
+            result.valid += 1
+            if dry_run or result.error_count:
+                continue
+            chunk.append(ticket)
+            if len(chunk) >= chunk_size:
+                write(chunk)
+                chunk = []
+        if result.error_count:
+            transaction.set_rollback(True)
+            result.created = 0
+            return result
+        if chunk:
+            write(chunk)
+        # Bulk creation doesn't send the signals that update the counters
+        for (category_pk, amount) in created.items():
+            Inventory.objects.add_tickets(category_pk, amount)
+    return result
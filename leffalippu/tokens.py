@@ -0,0 +1,62 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Public order tokens.
+
+The token of an order is a keyed HMAC-SHA256 of its primary key, truncated
+and encoded in lowercase base32. It is computed once when the order is
+created and stored in the indexed Order.token column, so finding an order by
+its token is a single indexed equality and the key can be rotated without
+breaking the links of existing orders. As the primary key is known only
+after the INSERT, the token is written with a second UPDATE, see
+Order.save.
+"""
+
+import base64
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+""" Length of the tokens in bytes, encoded as 16 base32 characters """
+TOKEN_BYTES = 10
+
+def _keyed_hmac():
+    key = settings.ORDER_TOKEN_KEY or settings.SECRET_KEY
+    return hmac.new(force_bytes('leffalippu.order:' + key),
+                    digestmod=hashlib.sha256)
+
+def _token(keyed, pk):
+    mac = keyed.copy()
+    mac.update(force_bytes(pk))
+    digest = mac.digest()[:TOKEN_BYTES]
+    return base64.b32encode(digest).decode('ascii').lower()
+
+def encode(pk):
+    """
+    Return the token of the order with the given primary key.
+    """
+    return _token(_keyed_hmac(), pk)
+
+def encode_many(pks):
+    """
+    Return a dict from the given primary keys to their tokens.
+
+    The key is set up only once for the whole batch.
+    """
+    keyed = _keyed_hmac()
+    return dict((pk, _token(keyed, pk)) for pk in pks)
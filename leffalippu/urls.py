@@ -1,6 +1,6 @@
 from django.conf.urls import patterns, include, url
 from leffalippu import views
-#from leffalippu import bitcoin
+from leffalippu import bitcoin
 
 # Uncomment the next two lines to enable the admin:
 #from leffalippu import admin
@@ -12,17 +12,20 @@ urlpatterns = patterns('',
     #url(r'^$', 'leffalippu.views.home', name='home'),
     url(r'^$', views.order, name='order'),
     #url(r'^cancel/$', views.cancel, name='cancel'),
+    url(r'^jono/$', views.queue_status, name='queue_status'),
     url(r'^peru/(?P<order_id>.+)/$', views.cancel, name='cancel'),
 #url(r'^pay/(?P<order_id>.+)/$', views.pay, name='pay'),
 #url(r'^delete/(?P<order_id>.+)/$', views.delete, name='delete'),
 
     url(r'^kayttoehdot/$', views.terms_of_service, name='terms_of_service'),
+
+    url(r'^metrics/$', views.metrics_view, name='metrics'),
     
     url(r'^accounts/', include('registration.backends.simple.urls')),
     
     # NOTE: This URL is hardcoded in bitcoin.py in order to be able to use
     # totally different URLs for the callback (for instance, when using SSL)
-    #url(r'^callback/(?P<encrypted_pk>.+)/$', bitcoin.callback, name='callback'),
+    url(r'^callback/(?P<token>\w+)/$', bitcoin.callback, name='callback'),
 #url(r'^accounts/login/$', 'django.contrib.auth.views.login'),
 #url(r'^$', views.OrderView.as_view(), name='order'),
     # url(r'^leffalippu/', include('leffalippu.foo.urls')),
@@ -28,19 +28,29 @@ from django.forms.formsets import formset_factory
 #from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 
-#from django.core import mail
-#from mail_templated import send_mail
-
 from django.conf import settings
 
 from django.views.generic import View, TemplateView
+from django.views.decorators.cache import cache_page
+from django.views.decorators.http import condition
 
 from leffalippu.models import *
 from leffalippu import forms
+from leffalippu import caching
+from leffalippu import bitcoin
+from leffalippu import metrics
+from leffalippu import throttling
+from leffalippu import waitingroom
 
+import datetime
+import hashlib
+import math
+import os
 import string
 import random
 
+import simplejson
+
 def get_client_ip(request):
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
@@ -49,37 +59,49 @@ def get_client_ip(request):
         ip = request.META.get('REMOTE_ADDR')
     return ip
 
+TERMS_OF_SERVICE_TEMPLATE = 'leffalippu/terms_of_service.html'
+
+def terms_of_service_modified(request):
+    """
+    Modification time of the terms of service template.
+    """
+    for directory in settings.TEMPLATE_DIRS:
+        path = os.path.join(directory, TERMS_OF_SERVICE_TEMPLATE)
+        if os.path.exists(path):
+            return datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+    return None
+
+def terms_of_service_etag(request):
+    modified = terms_of_service_modified(request)
+    if modified is None:
+        return None
+    return hashlib.md5(modified.isoformat()).hexdigest()
+
+@condition(etag_func=terms_of_service_etag,
+           last_modified_func=terms_of_service_modified)
+@cache_page(settings.TERMS_CACHE_SECONDS)
 def terms_of_service(request):
-    return render(request, 'leffalippu/terms_of_service.html')
+    return render(request, TERMS_OF_SERVICE_TEMPLATE)
     
+def metrics_view(request):
+    """
+    Serve the metrics of this process in Prometheus text format.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
 #def cancel(request):
 def cancel(request, order_id):
     try:
-        order = Order.objects.get(encrypted_pk=order_id)
+        order = Order.objects.get(token=order_id)
     except Order.DoesNotExist:
         raise Http404
 
-    # Only open orders can be cancelled, so check that orderstatus does not
-    # exist.
-    try:
-        order.status = order.orderstatus.status
-    except OrderStatus.DoesNotExist:
-        orderstatus = OrderStatus(order=order,
-                                  status=OrderStatus.CANCELLED)
-        try:
-            orderstatus.save()
-            order.status = orderstatus.status
-        except:
-            raise Exception("Order could not be cancelled. Handle this situation.")
-
-        ## send_mail('email/cancel.txt',
-        ##           {
-        ##               'order': order,
-        ##               'EMAIL_ADDRESS': settings.EMAIL_ADDRESS,
-        ##           },
-        ##           settings.EMAIL_ADDRESS,
-        ##           [order.email])
-        
+    # Only open orders can be cancelled, otherwise the page tells the status
+    order.cancel()
+
     return render(request,
                   'leffalippu/cancel.html',
                   {
@@ -131,86 +153,158 @@ def cancel(request, order_id):
 ##     except Order.DoesNotExist:
 ##         raise Http404
 
-def order(request):
+def queue_status(request):
+    """
+    Position of a waiting customer in the checkout queue as JSON.
 
-    if request.method == 'POST':
+    Polled by the waiting page, so this uses only the cache.
+    """
+    number = waitingroom.read_token(request.GET.get('queue', ''))
+    if number is None:
+        raise Http404
+    ticket = waitingroom.status(number)
+    return HttpResponse(simplejson.dumps({'admitted': ticket.admitted,
+                                    'waiting': ticket.waiting,
+                                    'ahead': ticket.ahead}),
+                        content_type='application/json')
 
-        # Form set for providing quantities for each ticket category
-        CategoryFormSet = formset_factory(forms.OrderedTicketsForm,
-                                          formset=forms.BaseOrderedTicketsFormSet)
-
-        # Read user input
-        order_form = forms.OrderForm(request.POST)
-        category_formset = CategoryFormSet(request.POST)
-
-        # Validate the input
-        valid_tickets = category_formset.is_valid()
-        valid_order = order_form.is_valid()
-
-        # Set field max values
-        for form in category_formset:
-            try:
-                form.fields['amount'].available = form.instance.category.amount_available()
-                max_value = min(form.fields['amount'].available, 
-                                form.fields['amount'].max_value)
-                max_value = max(0, max_value)
-                form.fields['amount'].max_value = max_value
-            except:
-                pass
-
-        if valid_tickets and valid_order:
-            # Create the order
-            order = order_form.save(commit=False)
-            # Fill-in the missing fields
-            order.ip = get_client_ip(request)
-            # Use temporary values for BTC address and price. They are
-            # overwritten by proper values when saving the formset.
-            order.public_address = ''.join(random.choice(string.ascii_uppercase+string.digits) 
-                                           for x in range(12))
-            order.price_satoshi = 0
-            order.save()
-            if category_formset.save(order):
-                # Order succesfull. Send email and show summary
-                CANCEL_URL = reverse('cancel', args=[order.encrypted_pk])
-                CANCEL_URL = request.build_absolute_uri(CANCEL_URL)
-                ## send_mail('email/order.txt',
-                ##           {
-                ##               'order': order,
-                ##               'CANCEL_URL': CANCEL_URL,
-                ##               'EMAIL_ADDRESS': settings.EMAIL_ADDRESS,
-                ##           },
-                ##           settings.EMAIL_ADDRESS,
-                ##           [order.email])
-                return render(request,
-                              'leffalippu/order.html',
-                              {
-                                  'order': order,
-                              })
-            order.delete()
+def waiting(request, ticket):
+    """
+    Show the waiting page which resubmits the order when it is admitted.
+    """
+    fields = [(name, value)
+              for (name, values) in sorted(request.POST.lists())
+              if name not in ('csrfmiddlewaretoken', 'queue')
+              for value in values]
+    return render(request,
+                  'leffalippu/waiting.html',
+                  {
+                      'ticket': ticket,
+                      'fields': fields,
+                      'poll_seconds': settings.WAITING_ROOM_POLL_SECONDS,
+                  })
 
-    if request.method != 'POST':
-        order_form = forms.OrderForm()
-        
-        # The ticket categories that are for sale
-        #category_list = Category.objects.filter(name__contains='BioRex')
-        category_list = Category.objects.all()
-        num_categories = len(category_list)
-        CategoryFormSet = formset_factory(forms.OrderedTicketsForm, 
-                                          extra=num_categories)
-        category_formset = CategoryFormSet()
-        for (form, category) in zip(category_formset, category_list):
-            form.fields['category'].initial = category
-            form.fields['amount'].available = category.amount_available()
+def checkout(request):
+    """
+    Validate the posted order and reserve the tickets.
+    """
+    # Form set for providing quantities for each ticket category
+    CategoryFormSet = formset_factory(forms.OrderedTicketsForm,
+                                      formset=forms.BaseOrderedTicketsFormSet)
+
+    # Read user input
+    order_form = forms.OrderForm(request.POST)
+    category_formset = CategoryFormSet(request.POST)
+
+    # Validate the input. The tickets are not validated if the customer
+    # can't order, for instance, because of other open orders.
+    valid_order = order_form.is_valid()
+    valid_tickets = valid_order and category_formset.is_valid()
+
+    # Set field max values
+    amounts_available = Inventory.objects.availability()
+    for form in category_formset:
+        try:
+            category_pk = int(form['category'].value())
+            form.fields['amount'].available = amounts_available[category_pk]
             max_value = min(form.fields['amount'].available, 
                             form.fields['amount'].max_value)
             max_value = max(0, max_value)
             form.fields['amount'].max_value = max_value
-    
-    
+        except:
+            pass
+
+    if valid_tickets and valid_order:
+        # Create the order
+        order = order_form.save(commit=False)
+        # Fill-in the missing fields
+        order.ip = get_client_ip(request)
+        # Use temporary values for BTC address and price. They are
+        # overwritten by proper values when saving the formset.
+        order.public_address = ''.join(random.choice(string.ascii_uppercase+string.digits) 
+                                       for x in range(12))
+        order.price_satoshi = 0
+        # The order is saved together with the reservation
+        if category_formset.save(order):
+            # Order succesfull. Send email and show summary
+            CANCEL_URL = reverse('cancel', args=[order.token])
+            CANCEL_URL = request.build_absolute_uri(CANCEL_URL)
+            OutgoingEmail.objects.enqueue('email/order.txt',
+                                          {
+                                              'order': order,
+                                              'CANCEL_URL': CANCEL_URL,
+                                          },
+                                          [order.email])
+            return render(request,
+                          'leffalippu/order.html',
+                          {
+                              'order': order,
+                          })
+        if order.pk is not None:
+            # The payment could not be created, release the address and the
+            # tickets
+            bitcoin.release_address(order)
+            order.delete()
+
+    return render_order_page(request, order_form, category_formset)
+
+def render_order_page(request, order_form, category_formset):
     return render(request, 
                   'leffalippu/home.html',
                   {
                       'order_form': order_form,
                       'category_formset': category_formset,
+                      # The unbound category rows are cached as a fragment
+                      'cache_versions': caching.get_versions('categories',
+                                                             'availability'),
+                      'fragment_seconds': settings.AVAILABILITY_CACHE_SECONDS,
                   })
 
+def order(request):
+
+    if request.method == 'POST':
+
+        # Reject floods before doing any real work. Resubmissions from the
+        # waiting room were counted when the customer entered the queue.
+        queued = (waitingroom.enabled() and
+                  waitingroom.holds_place(request.POST.get('queue')))
+        retry = (not queued and
+                 throttling.admit_order(get_client_ip(request),
+                                        request.POST.get('email', '')))
+        if retry:
+            response = render(request, 'leffalippu/throttled.html',
+                              status=429)
+            response['Retry-After'] = str(int(math.ceil(retry)))
+            return response
+
+        if not waitingroom.enabled():
+            return checkout(request)
+
+        # Only a limited number of checkouts are processed at a time
+        ticket = waitingroom.enter(request.POST.get('queue'))
+        if not ticket.admitted:
+            return waiting(request, ticket)
+        try:
+            return checkout(request)
+        finally:
+            waitingroom.release(ticket)
+
+    order_form = forms.OrderForm()
+
+    # The ticket categories that are for sale
+    #category_list = Category.objects.filter(name__contains='BioRex')
+    category_list = Category.objects.cached_list()
+    amounts_available = Inventory.objects.availability()
+    num_categories = len(category_list)
+    CategoryFormSet = formset_factory(forms.OrderedTicketsForm, 
+                                      extra=num_categories)
+    category_formset = CategoryFormSet()
+    for (form, category) in zip(category_formset, category_list):
+        form.fields['category'].initial = category
+        form.fields['amount'].available = amounts_available.get(category.pk, 0)
+        max_value = min(form.fields['amount'].available, 
+                        form.fields['amount'].max_value)
+        max_value = max(0, max_value)
+        form.fields['amount'].max_value = max_value
+
+    return render_order_page(request, order_form, category_formset)
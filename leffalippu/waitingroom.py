@@ -0,0 +1,247 @@
+# Copyright (C) 2013 Jaakko Luttinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Virtual waiting room in front of the checkout.
+
+At most WAITING_ROOM_SLOTS checkouts are processed at a time. Each checkout
+attempt takes a number from a shared counter and gets it as a signed
+position token. The numbers up to the "serving" pointer are admitted, and
+the pointer is advanced in order as slots become free, so the clients are
+admitted first in, first out. Waiting clients poll the status view, which
+uses only the cache, and resubmit their order with the token when they are
+admitted. When nobody is waiting, a checkout is admitted at once.
+
+The slots taken in each period of WAITING_ROOM_LEASE_SECONDS are counted
+separately. A finished checkout frees its slot, and the slots of clients
+that never come back are freed when their period is two periods old. An
+admission can be used once until the end of the following period.
+
+The state is kept in the default cache, so the cache must be shared by the
+workers and support atomic add and incr (for instance, memcached or
+leffalippu.cache_backends.SharedFileCache).
+"""
+
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache, caches, DEFAULT_CACHE_ALIAS
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+KEY = 'leffalippu:waitingroom:%s'
+
+""" Seconds the advancing lock is held at most """
+LOCK_SECONDS = 5
+
+SALT = 'leffalippu.waitingroom'
+
+class Ticket(object):
+    """
+    A place in the queue.
+
+    If `admitted` is True, the checkout may proceed and the slot must be
+    released afterwards.
+    """
+
+    def __init__(self, number, serving, period=None):
+        self.number = number
+        self.serving = serving
+        self.period = period
+
+    @property
+    def admitted(self):
+        return self.period is not None
+
+    @property
+    def waiting(self):
+        return self.number > self.serving
+
+    @property
+    def ahead(self):
+        """ Number of clients ahead in the queue """
+        return max(self.number - self.serving - 1, 0)
+
+    @property
+    def token(self):
+        return signing.dumps(self.number, salt=SALT)
+
+""" Cache backends which are not shared by the worker processes """
+LOCAL_CACHES = (DummyCache, LocMemCache)
+
+def enabled():
+    """
+    Return True if the waiting room is enabled.
+
+    Raises ImproperlyConfigured if the default cache is not shared, as the
+    slots would be counted in each process separately.
+    """
+    if settings.WAITING_ROOM_SLOTS is None:
+        return False
+    # The default cache is a proxy
+    if isinstance(caches[DEFAULT_CACHE_ALIAS], LOCAL_CACHES):
+        raise ImproperlyConfigured("WAITING_ROOM_SLOTS requires a shared "
+                                   "default cache, for instance, memcached "
+                                   "or leffalippu.cache_backends."
+                                   "SharedFileCache.")
+    return True
+
+def _period():
+    return int(time.time() // settings.WAITING_ROOM_LEASE_SECONDS)
+
+def _timeout():
+    # Long enough for the counters of the previous period
+    return 3 * settings.WAITING_ROOM_LEASE_SECONDS
+
+def _counter(name, default=0, timeout=None):
+    key = KEY % name
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, default, timeout)
+        value = cache.get(key)
+    return value or 0
+
+def in_flight(period=None):
+    """
+    Number of slots taken in the current and the previous period.
+    """
+    if period is None:
+        period = _period()
+    counts = cache.get_many([KEY % ('active:%d' % p)
+                             for p in (period - 1, period)])
+    return max(sum(counts.values()), 0)
+
+def advance():
+    """
+    Admit the next waiting clients to the free slots.
+
+    Only one process advances at a time, the others just read the pointer.
+    Returns the serving pointer.
+    """
+    if not cache.add(KEY % 'lock', 1, LOCK_SECONDS):
+        return _counter('serving')
+    try:
+        issued = _counter('issued')
+        # If the pointer is lost, the numbers issued so far are not admitted
+        # again, as most of them have left
+        serving = _counter('serving', default=issued)
+        period = _period()
+        admit = min(settings.WAITING_ROOM_SLOTS - in_flight(period),
+                    issued - serving)
+        if admit > 0:
+            # The numbers after `start` up to `end` are admitted in this
+            # period
+            cache.add(KEY % ('start:%d' % period), serving, _timeout())
+            _counter('active:%d' % period, timeout=_timeout())
+            cache.incr(KEY % ('active:%d' % period), admit)
+            serving += admit
+            cache.set(KEY % ('end:%d' % period), serving, _timeout())
+            cache.set(KEY % 'serving', serving, None)
+        return serving
+    finally:
+        cache.delete(KEY % 'lock')
+
+def _admission_period(number, period):
+    keys = [KEY % ('%s:%d' % (name, p))
+            for p in (period - 1, period)
+            for name in ('start', 'end')]
+    bounds = cache.get_many(keys)
+    for p in (period - 1, period):
+        start = bounds.get(KEY % ('start:%d' % p))
+        end = bounds.get(KEY % ('end:%d' % p))
+        if start is not None and end is not None and start < number <= end:
+            return p
+    return None
+
+def status(number):
+    """
+    Return the ticket of a number without claiming the admission.
+
+    An admission is valid until the end of the period following the one in
+    which the number was admitted.
+    """
+    serving = advance()
+    if number > serving:
+        return Ticket(number, serving)
+    return Ticket(number, serving, period=_admission_period(number, _period()))
+
+def read_token(token):
+    """
+    Return the number of a position token, or None if it is invalid.
+    """
+    try:
+        return signing.loads(token, salt=SALT,
+                             max_age=settings.WAITING_ROOM_TOKEN_SECONDS)
+    except signing.BadSignature:
+        return None
+
+def holds_place(token):
+    """
+    Return True if a position token is valid and its admission hasn't been
+    used, that is, the request is a resubmission from the queue.
+    """
+    number = read_token(token) if token else None
+    return (number is not None and
+            cache.get(KEY % ('used:%d' % number)) is None)
+
+def _claim(ticket):
+    return cache.add(KEY % ('used:%d' % ticket.number), 1, _timeout())
+
+def enter(token=None):
+    """
+    Return the ticket of a checkout attempt.
+
+    The place of a valid position token is kept. A new number is taken if
+    there is no token, or if its admission is already used or has expired.
+    An admitted ticket is claimed, so that it can't be used again.
+    """
+    number = read_token(token) if token else None
+    if number is not None:
+        ticket = status(number)
+        if ticket.waiting or (ticket.admitted and _claim(ticket)):
+            return ticket
+    if cache.add(KEY % 'issued', 0, None):
+        cache.set(KEY % 'serving', 0, None)
+    ticket = status(cache.incr(KEY % 'issued'))
+    if ticket.admitted:
+        _claim(ticket)
+    return ticket
+
+def release(ticket):
+    """
+    Free the slot of a finished checkout.
+    """
+    try:
+        cache.decr(KEY % ('active:%d' % ticket.period))
+    except ValueError:
+        # The period has already expired
+        pass
+
+def reset():
+    """
+    Empty the queue and free all the slots, for instance, between load
+    tests.
+
+    The numbering continues, so that the admissions of the old numbers are
+    not mixed up with the new ones.
+    """
+    period = _period()
+    cache.delete_many([KEY % 'lock'] +
+                      [KEY % ('%s:%d' % (name, p))
+                       for p in (period - 1, period)
+                       for name in ('active', 'start', 'end')])
+    cache.set(KEY % 'serving', _counter('issued'), None)